@@ -16,13 +16,20 @@ class Client(discord.Client):
 
         next_edit_time = datetime.datetime.now()
         message_content_full = []
-        max_tokens_per_message = 400
+        # tokens arrive in batches (see core.stream), so count characters. discord allows 2000 per message
+        max_chars_per_message = 1900
+        message_chars = 0
         shown_reasoning_text = False
         async with message_obj.channel.typing():
             async for token in token_stream:
-                # if tokens exceed 200, add a new message to target for the edits
-                if len(message_content) >= max_tokens_per_message:
+                if token.get("type") not in ("content", "reasoning"):
+                    continue
+
+                # if the message would get too long, add a new message to target for the edits
+                if message_content and message_chars + len(token.get("content") or "") > max_chars_per_message:
+                    await message_obj.edit(content="".join(message_content))
                     message_content = []
+                    message_chars = 0
                     message_obj = await discord_channel.send("...")
 
                 if token.get("type") == "reasoning":
@@ -32,12 +39,13 @@ class Client(discord.Client):
                         shown_reasoning_text = True
                     continue
 
-                word = token.get("content")
+                word = token.get("content") or ""
                 message_content.append(word)
                 message_content_full.append(word)
+                message_chars += len(word)
 
-                # edit message every few seconds or if token limit reached
-                if datetime.datetime.now() >= next_edit_time or len(message_content) >= max_tokens_per_message:
+                # edit message every few seconds
+                if datetime.datetime.now() >= next_edit_time:
                     await message_obj.edit(content="".join(message_content))
                     next_edit_time = datetime.datetime.now() + datetime.timedelta(seconds=1)
 
@@ -102,7 +110,7 @@ class Discord(core.channel.Channel):
                     await channel.send(msg)
 
     async def run(self):
-        token = core.config.config.get("channels").get("settings").get("discord").get("token")
+        token = core.config.settings().get("channels.settings.discord.token", None)
 
         if not token:
             core.log("error", "discord token not set! set it in config.yaml as discord_token")
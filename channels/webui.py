@@ -141,8 +141,9 @@ class Webui(core.channel.Channel):
         flask_thread = Thread(target=self._run_flask, daemon=True)
         flask_thread.start()
 
-        host = core.config.get("channels").get("settings").get("webui").get("host", "127.0.0.1")
-        port = core.config.get("channels").get("settings").get("webui").get("port", 5000)
+        webui_settings = core.config.settings().channels.settings.webui
+        host = webui_settings.get("host", "127.0.0.1")
+        port = webui_settings.get("port", 5000)
         core.log("webui", f"WebUI started on http://{host}:{port}")
 
         try:
@@ -156,8 +157,9 @@ class Webui(core.channel.Channel):
         """Run Flask in a separate thread."""
         from werkzeug.serving import make_server
 
-        host = core.config.get("channels").get("settings").get("webui").get("host", "127.0.0.1")
-        port = core.config.get("channels").get("settings").get("webui").get("port", 5000)
+        webui_settings = core.config.settings().channels.settings.webui
+        host = webui_settings.get("host", "127.0.0.1")
+        port = webui_settings.get("port", 5000)
 
         self.server = make_server(host, port, app, threaded=True)
         self.server.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -189,6 +191,27 @@ def _run_async(coro):
     future = asyncio.run_coroutine_threadsafe(coro, channel_instance.main_loop)
     return future.result()
 
+def _chat_snapshot():
+    """
+    Read-only view of the current chat, as it was last saved.
+
+    Reading it doesn't hop onto the main loop, so polling never waits on the AI.
+    Anything that changes the chat still goes through _run_async().
+    """
+    return channel_instance.context.chat.snapshot()
+
+def _message_data(msg, index: int):
+    """Convert a message from a chat snapshot to what the frontend expects."""
+    msg = core.storage.thaw(msg)
+    return {
+        'role': msg.get('role', 'user'),
+        'content': msg.get('content', ''),
+        'tool_calls': msg.get('tool_calls'),
+        'tool_call_id': msg.get('tool_call_id'),
+        'reasoning_content': msg.get('reasoning_content'),
+        'index': index
+    }
+
 # =============================================================================
 # Flask Routes
 # =============================================================================
@@ -315,25 +338,13 @@ def get_messages():
     if not channel_instance:
         return jsonify({'messages': [], 'count': 0})
 
-    messages = _run_async(channel_instance.context.chat.get()) or []
-    current_id = _run_async(channel_instance.context.chat.get_id())
-
-    result = []
-    for i, msg in enumerate(messages):
-        msg_data = {
-            'role': msg.get('role', 'user'),
-            'content': msg.get('content', ''),
-            'tool_calls': msg.get('tool_calls'),
-            'tool_call_id': msg.get('tool_call_id'),
-            'reasoning_content': msg.get('reasoning_content'),
-            'index': i
-        }
-        result.append(msg_data)
+    snapshot = _chat_snapshot()
+    result = [_message_data(msg, i) for i, msg in enumerate(snapshot['messages'])]
 
     return jsonify({
         'messages': result,
         'count': len(result),
-        'current_chat_id': current_id
+        'current_chat_id': snapshot['id']
     })
 
 @app.route('/messages/since')
@@ -347,31 +358,18 @@ def get_messages_since():
     except ValueError:
         since_index = 0
 
-    messages = _run_async(channel_instance.context.chat.get()) or []
-    current_id = _run_async(channel_instance.context.chat.get_id())
-    current_title = _run_async(channel_instance.context.chat.get_title())
-    current_tags = _run_async(channel_instance.context.chat.get_tags()) or []
-
-    result = []
-    for i in range(since_index, len(messages)):
-        msg = messages[i]
-        msg_data = {
-            'role': msg.get('role', 'user'),
-            'content': msg.get('content', ''),
-            'tool_calls': msg.get('tool_calls'),
-            'tool_call_id': msg.get('tool_call_id'),
-            'reasoning_content': msg.get('reasoning_content'),
-            'index': i
-        }
-        result.append(msg_data)
+    snapshot = _chat_snapshot()
+    messages = snapshot['messages']
+
+    result = [_message_data(messages[i], i) for i in range(max(since_index, 0), len(messages))]
 
     return jsonify({
         'messages': result,
         'count': len(result),
         'total': len(messages),
-        'current_chat_id': current_id,
-        'current_chat_title': current_title,
-        'current_chat_tags': current_tags
+        'current_chat_id': snapshot['id'],
+        'current_chat_title': snapshot['title'],
+        'current_chat_tags': list(snapshot['tags'])
     })
 
 @app.route('/stream', methods=['POST'])
@@ -414,7 +412,16 @@ def stream_message():
                         token_queue.put(('error', error_content))
                         break
 
-                    token_queue.put(token_data)
+                    # encoded here, once per batch of tokens, so the response thread only has to write it
+                    if isinstance(token_data, dict):
+                        token_queue.put(core.stream.sse_frame(token_data))
+                    else:
+                        token_queue.put(core.stream.sse_frame({'type': 'content', 'text': str(token_data)}))
+
+                if stream_id in stream_cancellations:
+                    # cancelling ends the stream right away, so there was no token left to notice it
+                    stream_cancellations.discard(stream_id)
+                    token_queue.put(('cancelled', True))
             except Exception as e:
                 token_queue.put(('error', {'error': 'exception', 'message': str(e)}))
             finally:
@@ -431,7 +438,7 @@ def stream_message():
             item = token_queue.get()
 
             if item is done:
-                total = len(_run_async(channel_instance.context.chat.get()))
+                total = len(_chat_snapshot()['messages'])
                 yield f"data: {json.dumps({'done': True, 'total': total})}\n\n"
                 break
 
@@ -445,11 +452,8 @@ def stream_message():
                     yield f"data: {json.dumps({'cancelled': True})}\n\n"
                     break
 
-            elif isinstance(item, dict):
-                yield f"data: {json.dumps(item)}\n\n"
-
-            else:
-                yield f"data: {json.dumps({'type': 'content', 'text': str(item)})}\n\n"
+            elif isinstance(item, bytes):
+                yield item
 
         future.result()
 
@@ -491,16 +495,14 @@ def send_message():
             'api_error': True
         }), 500
 
-    messages = _run_async(channel_instance.context.chat.get()) or []
-    current_id = _run_async(channel_instance.context.chat.get_id())
-    current_title = _run_async(channel_instance.context.chat.get_title())
+    snapshot = _chat_snapshot()
 
     return jsonify({
         'response': response,
-        'total': len(messages),
+        'total': len(snapshot['messages']),
         'current_chat': {
-            'id': current_id,
-            'title': current_title
+            'id': snapshot['id'],
+            'title': snapshot['title']
         }
     })
 
@@ -513,18 +515,18 @@ def edit_message():
     index = data.get('index', 0)
     new_content = data.get('content', '')
 
-    messages = _run_async(channel_instance.context.chat.get())
-
-    if 0 <= index < len(messages):
-        if messages[index].get('role') not in ('user', 'assistant'):
-            return jsonify({'success': False, 'error': 'Cannot edit this message type'})
-
-        messages[index]['content'] = new_content
-        _run_async(channel_instance.context.chat.set(messages))
+    # edited on the main loop, in the live chat, so nothing that was added in the meantime gets lost
+    result = _run_async(channel_instance.context.chat.edit(
+        index, new_content,
+        allowed=lambda msg: msg.get('role') in ('user', 'assistant')
+    ))
+    if result and result.get('success'):
         core.log("webui", f"Edited message {index}")
-        return jsonify({'success': True, 'total': len(messages)})
+    return jsonify(result or {'success': False, 'error': 'Channel not available'})
 
-    return jsonify({'success': False, 'error': f'Index {index} out of range'})
+def _deletable(msg):
+    role = msg.get('role', '')
+    return role in ('user', 'assistant', 'command', 'command_response') or role.startswith('announce_')
 
 @app.route('/delete', methods=['POST'])
 def delete_message():
@@ -534,19 +536,10 @@ def delete_message():
     data = request.get_json()
     index = data.get('index', 0)
 
-    messages = _run_async(channel_instance.context.chat.get())
-
-    if 0 <= index < len(messages):
-        if messages[index].get('role') not in ('user', 'assistant', 'command', 'command_response'):
-            if not messages[index].get('role', '').startswith('announce_'):
-                return jsonify({'success': False, 'error': 'Cannot delete this message type'})
-
-        _run_async(channel_instance.context.chat.set(messages[:index]))
-        remaining = len(_run_async(channel_instance.context.chat.get()))
-        core.log("webui", f"Deleted messages from index {index}, {remaining} remaining")
-        return jsonify({'success': True, 'remaining': remaining})
-
-    return jsonify({'success': False, 'error': f'Index {index} out of range'})
+    result = _run_async(channel_instance.context.chat.truncate(index, allowed=_deletable))
+    if result and result.get('success'):
+        core.log("webui", f"Deleted messages from index {index}, {result['remaining']} remaining")
+    return jsonify(result or {'success': False, 'error': 'Channel not available'})
 
 @app.route('/cancel', methods=['POST'])
 def cancel_stream():
@@ -556,11 +549,12 @@ def cancel_stream():
     data = request.get_json()
     stream_id = data.get('id')
 
-    channel_instance.manager.API.cancel_request = True
-
     if stream_id:
         stream_cancellations.add(stream_id)
 
+    # closes the response right away, so the backend stops generating
+    asyncio.run_coroutine_threadsafe(channel_instance.cancel(), channel_instance.main_loop)
+
     return jsonify({'success': True})
 
 @app.route('/upload', methods=['POST'])
@@ -587,7 +581,7 @@ def upload_file():
             channel_instance.main_loop
         ).result()
 
-        total = len(_run_async(channel_instance.context.chat.get()))
+        total = len(_chat_snapshot()['messages'])
         return jsonify({'success': True, 'total': total})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
@@ -604,27 +598,20 @@ def list_chats():
     if not channel_instance:
         return jsonify({'chats': []})
 
-    all_chats = _run_async(channel_instance.context.chat.get_all())
+    all_chats = channel_instance.context.chat.snapshot_all()
+    previews = _run_async(channel_instance.context.chat.get_previews([conv.get('id') for conv in all_chats])) or {}
     chats = []
 
+    # the index has everything but the message previews, those come from the chat files
     for conv in all_chats:
-        messages_preview = []
-        for msg in conv.get('messages', [])[:5]:
-            content = msg.get('content', '')
-            if content:
-                messages_preview.append({
-                    'role': msg.get('role'),
-                    'content': content[:500]
-                })
-
         chats.append({
             'id': conv.get('id'),
             'title': conv.get('title', 'New Chat'),
-            'tags': conv.get('tags', []),
+            'tags': list(conv.get('tags', [])),
             'created': conv.get('created'),
             'updated': conv.get('updated'),
-            'message_count': len(conv.get('messages', [])),
-            'messages': messages_preview
+            'message_count': conv.get('message_count', 0),
+            'messages': previews.get(conv.get('id'), [])
         })
 
     chats.sort(key=lambda x: x.get('updated', ''), reverse=True)
@@ -646,30 +633,17 @@ def load_chat():
     if not success:
         return jsonify({'success': False, 'error': 'Chat not found'})
 
-    messages = _run_async(channel_instance.context.chat.get()) or []
-    title = _run_async(channel_instance.context.chat.get_title())
-    loaded_id = _run_async(channel_instance.context.chat.get_id())
-    tags = _run_async(channel_instance.context.chat.get_tags()) or []
+    snapshot = _chat_snapshot()
 
     # Add index to each message
-    result = []
-    for i, msg in enumerate(messages):
-        msg_data = {
-            'role': msg.get('role', 'user'),
-            'content': msg.get('content', ''),
-            'tool_calls': msg.get('tool_calls'),
-            'tool_call_id': msg.get('tool_call_id'),
-            'reasoning_content': msg.get('reasoning_content'),
-            'index': i
-        }
-        result.append(msg_data)
+    result = [_message_data(msg, i) for i, msg in enumerate(snapshot['messages'])]
 
     return jsonify({
         'success': True,
         'chat': {
-            'id': loaded_id,
-            'title': title or 'New Chat',
-            'tags': tags,
+            'id': snapshot['id'],
+            'title': snapshot['title'] or 'New Chat',
+            'tags': list(snapshot['tags']),
             'messages': result,
             'total': len(result)
         }
@@ -683,39 +657,23 @@ def get_current_chat():
     if not channel_instance:
         return jsonify({'success': False, 'error': 'Channel not available'})
 
-    chat = channel_instance.context.chat
-
-    conv_id = _run_async(chat.get_id())
-    if conv_id is None:
+    snapshot = _chat_snapshot()
+    if snapshot['id'] is None:
         return jsonify({
             'success': True,
             'current_id': None,
             'chat': None
         })
 
-    messages = _run_async(chat.get()) or []
-    title = _run_async(chat.get_title())
-    tags = _run_async(chat.get_tags()) or []
-
     # Add index to each message
-    result = []
-    for i, msg in enumerate(messages):
-        msg_data = {
-            'role': msg.get('role', 'user'),
-            'content': msg.get('content', ''),
-            'tool_calls': msg.get('tool_calls'),
-            'tool_call_id': msg.get('tool_call_id'),
-            'reasoning_content': msg.get('reasoning_content'),
-            'index': i
-        }
-        result.append(msg_data)
+    result = [_message_data(msg, i) for i, msg in enumerate(snapshot['messages'])]
 
     return jsonify({
         'success': True,
         'chat': {
-            'id': conv_id,
-            'title': title or 'New Chat',
-            'tags': tags,
+            'id': snapshot['id'],
+            'title': snapshot['title'] or 'New Chat',
+            'tags': list(snapshot['tags']),
             'messages': result,
             'total': len(result)
         }
@@ -730,7 +688,7 @@ def rename_chat():
         return jsonify({'success': False, 'error': 'Channel not available'})
 
     # Only rename if we have an active chat
-    conv_id = _run_async(channel_instance.context.chat.get_id())
+    conv_id = channel_instance.context.chat.current
     if conv_id is None:
         return jsonify({'success': False, 'error': 'No active chat'})
 
@@ -766,7 +724,7 @@ def new_chat():
     return jsonify({
         'success': True,
         'chat': {
-            'id': _run_async(channel_instance.context.chat.get_id()),
+            'id': channel_instance.context.chat.current,
             'title': title,
             'messages': []
         }
@@ -807,7 +765,7 @@ def get_all_tags():
     if not channel_instance:
         return jsonify({'tags': []})
 
-    all_chats = _run_async(channel_instance.context.chat.get_all()) or []
+    all_chats = channel_instance.context.chat.snapshot_all()
     tags = set()
 
     for chat in all_chats:
@@ -831,7 +789,7 @@ def update_chat_tags():
         return jsonify({'success': False, 'error': 'Tags must be a list'})
 
     # Check if there's a current chat
-    conv_id = _run_async(channel_instance.context.chat.get_id())
+    conv_id = channel_instance.context.chat.current
     if conv_id is None:
         return jsonify({'success': False, 'error': 'No active chat'})
 
@@ -854,7 +812,7 @@ def add_chat_tag():
     if not tag:
         return jsonify({'success': False, 'error': 'Tag cannot be empty'})
 
-    conv_id = _run_async(channel_instance.context.chat.get_id())
+    conv_id = channel_instance.context.chat.current
     if conv_id is None:
         return jsonify({'success': False, 'error': 'No active chat'})
 
@@ -876,7 +834,7 @@ def remove_chat_tag():
     if not tag:
         return jsonify({'success': False, 'error': 'Tag cannot be empty'})
 
-    conv_id = _run_async(channel_instance.context.chat.get_id())
+    conv_id = channel_instance.context.chat.current
     if conv_id is None:
         return jsonify({'success': False, 'error': 'No active chat'})
 
@@ -4,6 +4,10 @@ import core.storage
 import core.module
 import core.commands
 import core.context
+import core.tokenizer
+import core.profiler
+import core.backends
+import core.stream
 import core.toolcalls
 import core.chat
 import core.channel
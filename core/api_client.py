@@ -2,7 +2,196 @@ import core
 import openai
 import asyncio
 import json
+import hashlib
 import inspect
+import collections
+import copy
+import os
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+try:
+    import httpx
+except ImportError:
+    # newer openai versions are built on httpx2, which has the same API
+    import httpx2 as httpx
+
+# errors that mean a backend can't be reached, or dropped the connection
+CONNECTION_ERRORS = (openai.APIConnectionError, httpx.TransportError)
+
+# newer openai clients can send a request body that's already encoded, older ones always encode it themselves
+RAW_BODY = "content" in inspect.signature(openai.AsyncOpenAI.post).parameters
+
+# id(message) -> (message, a copy of its items, its JSON, digest of the JSON). least recently used first.
+# messages are shared with the chat history between requests, so most of them only get encoded once
+_message_json = collections.OrderedDict()
+# the cache keeps the messages alive (so their ids aren't reused), so it's bounded by the size of their JSON
+MESSAGE_JSON_CACHE_BYTES = 32 * 1024 * 1024
+_message_json_bytes = 0
+_tools_json = (None, (), None, None)
+
+def _snapshot(values: tuple) -> tuple:
+    """copies nested values like content lists and tool calls, so editing them in place shows up as a change"""
+    return tuple(
+        (key, copy.deepcopy(value) if isinstance(value, (list, dict)) else value)
+        for key, value in values
+    )
+
+def _encode_message(message: dict) -> bytes:
+    """JSON of a message, cached. a message counts as changed when any of its values was replaced or changed"""
+    global _message_json_bytes
+    values = tuple(message.items())
+    cached = _message_json.get(id(message))
+    # comparing the tuples compares identical values by identity first, and nested values by equality,
+    # so unchanged messages are cheap to check
+    if cached is not None and cached[0] is message and cached[1] == values:
+        _message_json.move_to_end(id(message))
+        return cached[2]
+
+    encoded = json.dumps(message, default=str).encode()
+    if cached is not None:
+        _message_json_bytes -= len(cached[2])
+    # keeping the message in the cache also keeps its id from being reused
+    _message_json[id(message)] = (message, _snapshot(values), encoded, _digest(encoded))
+    _message_json.move_to_end(id(message))
+    _message_json_bytes += len(encoded)
+    while _message_json_bytes > MESSAGE_JSON_CACHE_BYTES and len(_message_json) > 1:
+        _, (_, _, dropped, _) = _message_json.popitem(last=False)
+        _message_json_bytes -= len(dropped)
+    return encoded
+
+def _encode_tools(tools: list) -> bytes:
+    """JSON of the tool schema list, cached until the list or any schema in it is replaced"""
+    global _tools_json
+    cached_tools, cached_items, encoded, _ = _tools_json
+    items = tuple(tools)
+    if cached_tools is tools and cached_items == items:
+        return encoded
+
+    encoded = json.dumps(tools, default=str).encode()
+    _tools_json = (tools, items, encoded, _digest(encoded))
+    return encoded
+
+def _digest(encoded: bytes) -> bytes:
+    return hashlib.blake2b(encoded, digest_size=16).digest()
+
+def _fragment_digest(message, encoded: bytes) -> bytes:
+    """digest of an encoded message (or of the tools, with message None). taken from the caches when it was encoded there"""
+    if message is None:
+        cached = _tools_json
+    else:
+        cached = _message_json.get(id(message))
+    if cached is not None and cached[2] is encoded:
+        return cached[3]
+    return _digest(encoded)
+
+# the http client every API request goes through, and the settings it was made with
+_http = {"client": None, "options": None}
+
+def _http_options() -> dict:
+    settings = core.config.settings()
+    return {
+        "max_connections": int(settings.get("api.http.max_connections", 16)),
+        "max_keepalive": int(settings.get("api.http.max_keepalive", 8)),
+        "keepalive_seconds": float(settings.get("api.http.keepalive_seconds", 60)),
+        "connect_timeout": float(settings.get("api.http.connect_timeout", 5)),
+        "read_timeout": float(settings.get("api.http.read_timeout", 600)),
+        "http2": bool(settings.get("api.http.http2", False))
+    }
+
+def _http_timeout(options: dict):
+    return httpx.Timeout(
+        connect=options["connect_timeout"],
+        read=options["read_timeout"],
+        write=options["read_timeout"],
+        pool=options["read_timeout"]
+    )
+
+def get_http_client():
+    """
+    returns the long-lived http client for API requests, shared by all channels and background tasks,
+    so connections are kept alive and reused. it's only replaced when api.http in the config changes
+    """
+    options = _http_options()
+    client = _http["client"]
+    if client is not None and _http["options"] == options:
+        return client
+
+    limits = httpx.Limits(
+        max_connections=options["max_connections"],
+        max_keepalive_connections=options["max_keepalive"],
+        keepalive_expiry=options["keepalive_seconds"]
+    )
+    try:
+        new_client = openai.DefaultAsyncHttpxClient(limits=limits, timeout=_http_timeout(options), http2=options["http2"])
+    except ImportError:
+        core.log("API", "HTTP/2 needs the h2 package (pip install h2), using HTTP/1.1")
+        new_client = openai.DefaultAsyncHttpxClient(limits=limits, timeout=_http_timeout(options))
+
+    if client is not None:
+        # requests can still be running on the old client, close it once they've had time to finish
+        asyncio.get_running_loop().call_later(options["read_timeout"], lambda: asyncio.ensure_future(client.aclose()))
+
+    _http["client"] = new_client
+    _http["options"] = options
+    core.log("API", f"http client ready: {options['max_connections']} connections, {'HTTP/2' if options['http2'] else 'HTTP/1.1'}")
+    return new_client
+
+class RequestCancelled(Exception):
+    """raised inside a request when its handle got cancelled"""
+
+class RequestHandle:
+    """
+    cancels one request to the LLM, and the requests that follow from it (like the ones after tool calls).
+    cancelling interrupts whatever the request is doing: waiting for a backend, waiting for the response,
+    or streaming it, in which case the http response is closed so the server stops generating
+    """
+    def __init__(self):
+        self.cancelled = False
+        # prompt_tokens the API reported for the last response of this request. per request,
+        # unlike get_usage(), which other channels and scheduled jobs update as well
+        self.prompt_tokens = None
+        self._tasks = set()
+        self._responses = set()
+
+    async def run(self, coro):
+        """runs a step of the request in a task of its own, so cancel() can interrupt it"""
+        if self.cancelled:
+            coro.close()
+            raise RequestCancelled()
+
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            # only turn it into RequestCancelled if it was us, not the caller being cancelled
+            caller_cancelled = getattr(asyncio.current_task(), "cancelling", lambda: 0)()
+            if self.cancelled and task.cancelled() and not caller_cancelled:
+                raise RequestCancelled() from None
+            raise
+        finally:
+            self._tasks.discard(task)
+
+    def attach(self, response):
+        """a response that's being streamed, to be closed on cancel"""
+        self._responses.add(response)
+
+    def detach(self, response):
+        self._responses.discard(response)
+
+    async def cancel(self) -> bool:
+        if self.cancelled:
+            return False
+        self.cancelled = True
+
+        for task in list(self._tasks):
+            task.cancel()
+        for response in list(self._responses):
+            try:
+                await response.close()
+            except Exception as e:
+                core.log_error("error while closing response", e)
+        return True
 
 class APIClient():
     """
@@ -13,12 +202,24 @@ class APIClient():
         self.manager = manager
 
         self.connected = False
-        self._AI = None # replaced later using .connect()
+        self._AI = None # replaced later using .connect(). the client of the first working backend
+
+        # the API servers requests are spread over, see core.backends
+        self.backends = core.backends.BackendPool()
+        self._health_task = None
 
         self._model = None
         self._messages = []
 
-        self.cancel_request = False
+        # handles of the requests that are running, see cancel()
+        self._handles = set()
+
+        # token usage the API reported, per model
+        self.usage = {}
+
+        # what the previous request looked like, and how much of its prefix the next one could reuse. see _track_prefix()
+        self._prefix = None
+        self.prefix_stats = {}
 
         self._connection_error = None
         self._last_connection_attempt = None
@@ -39,33 +240,81 @@ class APIClient():
         self._model = core.config.get("model").get("name")
         self._connection_attempts += 1
 
-        api_config = core.config.get("api")
-
-        # initialize connection to the API
+        # initialize connections to the API servers. backends that were checked recently aren't checked again
         try:
-            self._AI = openai.AsyncOpenAI(
-                base_url=api_config.get("url"),
-                api_key=api_config.get("key")
-            )
-            await self._AI.models.list()
-        except openai.AuthenticationError as e:
-            self._connection_error = "Invalid API key. Please check your configuration."
-            core.log("API", f"Authentication failed: {e}")
-            return False
-        except openai.APIConnectionError as e:
-            self._connection_error = f"Could not reach API server at {api_config.get('url')}"
-            core.log("API", f"Connection failed: {e}")
-            return False
+            self.backends.configure(self._make_client, get_http_client())
+            errors = await self.backends.check_all()
         except Exception as e:
             self._connection_error = f"Connection error: {str(e)}"
             return False
 
+        if not self.backends.healthy():
+            self._connection_error = self._describe_errors(errors)
+            core.log("API", f"Connection failed: {self._connection_error}")
+            return False
+
+        for backend, error in errors:
+            core.log("API", f"backend {backend.name} is unreachable, continuing without it: {error}")
+
+        self._AI = self.backends.healthy()[0].client
         self.connected = True
         self._connection_error = None
         self._connection_attempts = 0
-        core.log("API", "Successfully connected to API")
+        self._watch_backends()
+        core.log("API", f"Successfully connected to API ({len(self.backends.healthy())}/{len(self.backends.backends)} backends)")
         return True
 
+    def _make_client(self, url: str, key: str, http_client, failover: bool = False):
+        return openai.AsyncOpenAI(
+            base_url=url,
+            api_key=key,
+            http_client=http_client,
+            # the openai client applies its own timeout to every request, so it has to match the pool
+            timeout=_http_timeout(_http["options"]),
+            # with other backends to fail over to, retrying a failed one only makes the user wait
+            max_retries=0 if failover else openai.DEFAULT_MAX_RETRIES
+        )
+
+    def _describe_errors(self, errors: list) -> str:
+        """a connection error message for the user, from the errors of the backends"""
+        if not errors:
+            return "No API backend configured."
+
+        backend, error = errors[0]
+        if isinstance(error, openai.AuthenticationError):
+            message = "Invalid API key. Please check your configuration."
+        elif isinstance(error, CONNECTION_ERRORS):
+            message = f"Could not reach API server at {backend.url}"
+        else:
+            message = f"Connection error: {str(error)}"
+
+        if len(errors) > 1:
+            message += f" (and {len(errors) - 1} more backends failed)"
+        return message
+
+    def _watch_backends(self):
+        """starts the background health checks of the backends, if they aren't running yet"""
+        if self._health_task is not None and not self._health_task.done():
+            return
+
+        self._health_task = asyncio.create_task(self._watch(), name="api_health")
+        # the manager cancels its tasks on restart
+        self.manager._async_tasks.add(self._health_task)
+        self._health_task.add_done_callback(self.manager._remove_async_task)
+
+    async def _watch(self):
+        """keeps checking the backends. connected follows whether any of them works"""
+        async def on_check():
+            healthy = self.backends.healthy()
+            if healthy and not self.connected:
+                core.log("API", "a backend is reachable again, reconnected")
+            self.connected = bool(healthy)
+            if healthy:
+                self._AI = healthy[0].client
+                self._connection_error = None
+
+        await self.backends.watch(on_check)
+
     def _validate_config(self):
         """Validate that API configuration is present and valid."""
         result = {"valid": False, "error": None}
@@ -75,16 +324,18 @@ class APIClient():
             result["error"] = "API configuration not found in config file"
             return result
 
-        url = api_config.get("url")
-        key = api_config.get("key")
+        backends = api_config.get("backends") or [{"url": api_config.get("url"), "key": api_config.get("key")}]
+        for backend in backends:
+            url = backend.get("url")
+            key = backend.get("key") or api_config.get("key")
 
-        if not url:
-            result["error"] = "API URL not configured. Please set 'url' in config."
-            return result
+            if not url:
+                result["error"] = "API URL not configured. Please set 'url' in config."
+                return result
 
-        if not key:
-            result["error"] = "API key not configured. Please set 'key' in config."
-            return result
+            if not key:
+                result["error"] = "API key not configured. Please set 'key' in config."
+                return result
 
         model_config = core.config.get("model")
         if not model_config or not model_config.get("name"):
@@ -107,12 +358,17 @@ class APIClient():
             "url_configured": bool(api_config.get("url")),
             "key_configured": bool(api_config.get("key")),
             "model_configured": bool(model_config.get("name")),
+            "backends": self.backends.status(),
+            "queue": self.backends.queue_status()
         }
 
     async def disconnect(self):
         """Properly disconnect from the API."""
         self.connected = False
         self._AI = None
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
         core.log("API", "Disconnected from API")
         return True
 
@@ -126,117 +382,333 @@ class APIClient():
 
     def set_model(self, name: str):
         self._model = name
+        core.tokenizer.warm_up(name)
         return self._model
 
+    def get_usage(self, model: str = None) -> dict:
+        """token usage the API reported for a model. prompt_tokens is the size of the last prompt"""
+        return self.usage.get(model or self._model, {})
+
+    def _record_usage(self, usage):
+        """stores the usage data of a response. returns the prompt token count, if there was any"""
+        prompt_tokens = getattr(usage, "prompt_tokens", None)
+        if not prompt_tokens:
+            return None
+
+        model_usage = self.usage.setdefault(self._model, {"requests": 0, "prompt_tokens_total": 0, "completion_tokens_total": 0})
+        model_usage["requests"] += 1
+        model_usage["prompt_tokens"] = prompt_tokens
+        model_usage["completion_tokens"] = getattr(usage, "completion_tokens", None) or 0
+        model_usage["prompt_tokens_total"] += prompt_tokens
+        model_usage["completion_tokens_total"] += model_usage["completion_tokens"]
+        return prompt_tokens
+
+    def _track_prefix(self, model, context: list, fragments: list, tools_json: bytes):
+        """
+        compares a request with the previous one. servers like llama.cpp keep the processed prompt in a cache,
+        and only have to process it again from the first change onward, so everything before that is reused.
+        tools come first, most chat templates put them at the start of the system prompt.
+        works on the encoded messages and the digests cached with them, so sizes are in bytes of JSON
+        (the same as characters, json.dumps escapes everything else)
+        """
+        parts = [("tools", tools_json or b"")]
+        parts += [(message.get("role"), fragment) for message, fragment in zip(context, fragments)]
+        digests = [_fragment_digest(None, parts[0][1])]
+        digests += [_fragment_digest(message, fragment) for message, fragment in zip(context, fragments)]
+        # rolling[i] covers parts 0 to i, so the first change can be found without comparing every part
+        rolling = []
+        state = b""
+        for digest in digests:
+            state = _digest(state + digest)
+            rolling.append(state)
+        total = sum(len(fragment) for _, fragment in parts)
+
+        previous = self._prefix
+        self._prefix = (model, parts, rolling)
+
+        stats = self.prefix_stats
+        stats["requests"] = stats.get("requests", 0) + 1
+        stats["prefix_hash"] = rolling[-1][:8].hex()
+        stats["total_chars"] = total
+
+        if previous is None or previous[0] != model:
+            # nothing in the cache to compare with
+            stats.update({"reused_chars": 0, "invalidated_chars": total, "changed_at": "first request" if previous is None else "model changed"})
+            return stats
+
+        _, previous_parts, previous_rolling = previous
+        # binary search for the first part that differs
+        low, high = 0, min(len(rolling), len(previous_rolling))
+        while low < high:
+            middle = (low + high) // 2
+            if rolling[middle] == previous_rolling[middle]:
+                low = middle + 1
+            else:
+                high = middle
+        reused = sum(len(fragment) for _, fragment in parts[:low])
+        changed_at = None
+        if low < len(parts) and low < len(previous_parts):
+            # the change is somewhere in this part, find out where
+            role, fragment = parts[low]
+            common = os.path.commonprefix([fragment, previous_parts[low][1]])
+            reused += len(common)
+            changed_at = self._describe_change(low, (role, fragment), common.decode(errors="replace"))
+
+        stats["reused_chars"] = reused
+        stats["invalidated_chars"] = total - reused
+        stats["changed_at"] = changed_at
+        stats["reused_chars_total"] = stats.get("reused_chars_total", 0) + reused
+        stats["total_chars_total"] = stats.get("total_chars_total", 0) + total
+        return stats
+
+    def _describe_change(self, index: int, part: tuple, common: str) -> str:
+        role, text = part
+        if index == 0:
+            return "tools"
+
+        description = f"message {index - 1} ({role})"
+        if role == "system":
+            # name the system prompt section that changed
+            headers = [line for line in common.replace("\\n", "\n").split("\n") if line.startswith("# ")]
+            if headers:
+                description += f", section '{headers[-1][2:]}'"
+        return description
+
     def get_last_error(self):
         """Get the last connection error message."""
         return self._connection_error
 
-    async def _request(self, context, tools=None, stream=False):
-        """send a request to the LLM and return the response object"""
+    async def _request(self, context, tools=None, stream=False, model=None, track_prefix=True, exclude=(), priority=core.backends.INTERACTIVE, handle=None):
+        """
+        send a request to the LLM. returns the response object and the backend it came from, which has to be released
+        with self.backends.release() once the response was read. errors are returned as (error dict, None).
+        backends that fail are left out and the request goes to the next one, as do backends in exclude.
+        if all backends are busy, it waits its turn in the queue, by priority (see core.backends)
+        """
+        if handle is None:
+            handle = RequestHandle()
+        if handle.cancelled:
+            return self._cancelled(), None
 
         if not self.connected:
             # attempt to connect
             connected = await self.connect()
             if not connected:
-                return {"error": "not_connected", "message": self._connection_error}
+                return {"error": "not_connected", "message": self._connection_error}, None
 
-        if not core.config.get("model").get("use_tools"):
+        settings = core.config.settings()
+        debug = settings.get("channels.debug", False)
+
+        if not settings.model.use_tools:
             # allow switching tools off globally
             tools = None
 
         req = {
-            "model": self._model,
+            "model": model or self._model,
             "messages": context,
             "tools": tools,
             "stream": stream,
-            "temperature": core.config.get("model").get("temperature", 0.2)
+            "temperature": settings.model.temperature
         }
 
         if stream:
             req["stream_options"] = {"include_usage": True}
 
-        if core.config.get("channels").get("debug"):
-            core.log("debug:request", str(req))
+        # only messages that weren't sent before get encoded
+        fragments = [_encode_message(message) for message in context]
+        tools_json = _encode_tools(tools) if tools else None
 
-        try:
-            response = await self._AI.chat.completions.create(**req)
-        except openai.AuthenticationError as e:
-            core.log_error("Authentication error - disconnecting", e)
-            self.connected = False
-            self._connection_error = "Authentication failed. Please check your API key."
-            return {"error": "auth_failed", "message": str(e)}
-        except openai.APIConnectionError as e:
-            core.log_error("Connection error - disconnecting", e)
-            self.connected = False
-            self._connection_error = "Lost connection to API server."
-            return {"error": "connection_lost", "message": str(e)}
-        except openai.RateLimitError as e:
-            core.log_error("Rate limit exceeded", e)
-            return {"error": "rate_limit", "message": "Rate limit exceeded. Please wait and try again."}
-        except openai.APIStatusError as e:
-            core.log_error("API status error", e)
-            return {"error": "api_error", "message": f"API error: {e.message}"}
-        except Exception as e:
-            core.log_error("error while sending request to AI", e)
-            self.connected = False
-            return {"error": "unknown", "message": str(e)}
-
-        if core.config.get("channels").get("debug"):
-            core.log("debug:response", str(response))
+        if track_prefix:
+            self._track_prefix(req["model"], context, fragments, tools_json)
 
-        return response
+        if debug:
+            core.log("debug:request", str(req))
 
-    async def send(self, context: list, system_prompt=True, use_tools=True, tools=None, **kwargs):
-        """send a message to the LLM. returns a string or error dict"""
+        queue_timeout = settings.get("api.queue.timeout", 300) or None
+        exclude = list(exclude)
+        error = None
+        while True:
+            try:
+                backend = await handle.run(self.backends.acquire(req["model"], priority, exclude, timeout=queue_timeout))
+            except RequestCancelled:
+                return self._cancelled(), None
+            except asyncio.TimeoutError:
+                core.log("API", f"gave up on a request after waiting {queue_timeout}s for a free backend")
+                return {"error": "queue_timeout", "message": "All API servers are busy. Please try again later."}, None
+            if backend is None:
+                break
+
+            try:
+                response = await handle.run(self._create(backend.client, req, fragments, tools_json))
+            except RequestCancelled:
+                # closes the connection, so the backend stops working on it
+                self.backends.release(backend)
+                return self._cancelled(), None
+            except openai.AuthenticationError as e:
+                core.log_error(f"Authentication error on {backend.name}", e)
+                backend.mark_down(e)
+                self._connection_error = "Authentication failed. Please check your API key."
+                error = {"error": "auth_failed", "message": str(e)}
+            except CONNECTION_ERRORS as e:
+                core.log_error(f"Connection error on {backend.name}", e)
+                backend.mark_down(e)
+                self._connection_error = "Lost connection to API server."
+                error = {"error": "connection_lost", "message": str(e)}
+            except openai.RateLimitError as e:
+                # the backend works, it's just busy
+                core.log_error(f"Rate limit exceeded on {backend.name}", e)
+                error = {"error": "rate_limit", "message": "Rate limit exceeded. Please wait and try again."}
+            except openai.APIStatusError as e:
+                # the request itself is the problem, another backend won't do better
+                self.backends.release(backend)
+                core.log_error("API status error", e)
+                return {"error": "api_error", "message": f"API error: {e.message}"}, None
+            except Exception as e:
+                core.log_error(f"error while sending request to {backend.name}", e)
+                backend.mark_down(e)
+                error = {"error": "unknown", "message": str(e)}
+            else:
+                if debug:
+                    core.log("debug:response", str(response))
+                return response, backend
+
+            self.backends.release(backend)
+            exclude.append(backend)
+            core.log("API", f"request to {backend.name} failed, trying the next backend")
+
+        if not self.backends.healthy():
+            core.log("API", "no backend left - disconnecting")
+            self.connected = False
+            self._connection_error = self._connection_error or "Lost connection to API server."
 
-        self.cancel_request = False
+        if error:
+            return error, None
+        if not self.connected:
+            return {"error": "connection_lost", "message": self._connection_error}, None
+        return {"error": "no_backend", "message": f"No available backend serves the model {req['model']}."}, None
+
+    def _cancelled(self) -> dict:
+        return {"error": "cancelled", "message": "The request was cancelled."}
+
+    async def _create(self, client, req: dict, fragments: list, tools_json: bytes):
+        """creates a chat completion, with a request body joined from the pre-encoded messages and tools"""
+        if not RAW_BODY:
+            return await client.chat.completions.create(**req)
+
+        body = [b'{"messages":[', b",".join(fragments), b"]"]
+        if tools_json:
+            body += [b',"tools":', tools_json]
+        for key, value in req.items():
+            if key not in ("messages", "tools") and value is not None:
+                body += [b",", json.dumps(key).encode(), b":", json.dumps(value).encode()]
+        body.append(b"}")
+
+        return await client.post(
+            "/chat/completions",
+            cast_to=ChatCompletion,
+            content=b"".join(body),
+            options={"headers": {"Content-Type": "application/json"}},
+            stream=bool(req.get("stream")),
+            stream_cls=openai.AsyncStream[ChatCompletionChunk]
+        )
+
+    async def send(self, context: list, system_prompt=True, use_tools=True, tools=None, model=None, record_usage=True,
+                   priority=core.backends.INTERACTIVE, handle=None, **kwargs):
+        """
+        send a message to the LLM. returns a string or error dict
+
+        model overrides the configured model for this one request.
+        background requests (like summaries) pass record_usage=False, so they don't count as the last prompt,
+        and a lower priority, so they wait while the backends are busy with requests users are waiting for.
+        handle is a RequestHandle to cancel the request with
+        """
 
         # use default tools if not specified. allow overrides
         if not tools:
             tools = self.manager.tools
 
-        response = await self._request(context, tools=(tools if use_tools else None))
+        handle = handle or RequestHandle()
+        self._handles.add(handle)
+        try:
+            response, backend = await self._request(context, tools=(tools if use_tools else None), model=model, track_prefix=record_usage, priority=priority, handle=handle)
+        finally:
+            self._handles.discard(handle)
 
         # Check for error response
         if isinstance(response, dict) and "error" in response:
             return response
 
         try:
-            result = await self._recv(response)
+            result = await self._recv(response, record_usage=record_usage, handle=handle)
             return result
         except Exception as e:
             core.log_error("error while processing response from AI", e)
             return {"error": "processing_failed", "message": str(e)}
+        finally:
+            self.backends.release(backend)
 
-    async def send_stream(self, context: list, use_tools=True, tools=None):
-        """send a message to the LLM. is an iterable async generator"""
-
-        self.cancel_request = False
+    async def send_stream(self, context: list, use_tools=True, tools=None, priority=core.backends.INTERACTIVE, handle=None):
+        """
+        send a message to the LLM. is an iterable async generator.
+        handle is a RequestHandle to cancel the request with. a cancelled stream just ends
+        """
 
         # use default tools if not specified. allow overrides
         if not tools:
             tools = self.manager.tools
 
-        response = await self._request(context, tools=(tools if use_tools else None), stream=True)
+        handle = handle or RequestHandle()
+        self._handles.add(handle)
+        try:
+            failed = []
+            while True:
+                response, backend = await self._request(context, tools=(tools if use_tools else None), stream=True, track_prefix=not failed, exclude=failed, priority=priority, handle=handle)
+
+                # Check for error response
+                if isinstance(response, dict) and "error" in response:
+                    if response["error"] != "cancelled":
+                        yield {"type": "error", "content": response}
+                    return
 
-        # Check for error response
-        if isinstance(response, dict) and "error" in response:
-            yield {"type": "error", "content": response}
-            return
+                handle.attach(response)
+                completed = False
+                try:
+                    if handle.cancelled:
+                        # cancelled right before it could be attached, the finally below closes it
+                        return
 
-        try:
-            async for token in self._recv_stream(response):
-                yield token
-        except Exception as e:
-            core.log_error("error while sending request to AI", e)
-            yield {"type": "error", "content": {"error": "stream_failed", "message": str(e)}}
+                    async for token in self._recv_stream(response, handle):
+                        yield token
+                    completed = not handle.cancelled
+                    return
+                except CONNECTION_ERRORS as e:
+                    # the backend went away before sending anything, so the request can still go to another one
+                    core.log_error(f"{backend.name} dropped the stream, trying the next backend", e)
+                    backend.mark_down(e)
+                    failed.append(backend)
+                except Exception as e:
+                    core.log_error("error while sending request to AI", e)
+                    yield {"type": "error", "content": {"error": "stream_failed", "message": str(e)}}
+                    return
+                finally:
+                    handle.detach(response)
+                    if not completed:
+                        # also when the caller stopped reading. otherwise the backend keeps generating on a slot that counts as free
+                        try:
+                            await response.close()
+                        except Exception as e:
+                            core.log_error("error while closing response", e)
+                    self.backends.release(backend)
+        finally:
+            self._handles.discard(handle)
 
     async def cancel(self):
-        self.cancel_request = True
+        """cancels every running request, of all channels. to cancel a single one, use its RequestHandle"""
+        for handle in list(self._handles):
+            await handle.cancel()
         return True
 
-    async def _recv(self, response, use_tools=True):
+    async def _recv(self, response, use_tools=True, record_usage=True, handle=None):
         """takes a response object and extracts the message from it, handling tool calls if needed"""
 
         final_content = None
@@ -256,13 +728,18 @@ class APIClient():
         if reasoning_content:
             core.log("debug:reasoning", reasoning_content)
 
+        if record_usage:
+            self._record_usage(getattr(response, "usage", None))
+        if handle is not None:
+            handle.prompt_tokens = getattr(getattr(response, "usage", None), "prompt_tokens", None)
+
         # extract message content
         # replace with reasoning if message was blank
         final_content = response_main.message.content or reasoning_content or ""
 
         # handle tool calls, if any
         tool_calls = None
-        if use_tools and core.config.get("model").get("use_tools", False) and response_main.message.tool_calls:
+        if use_tools and core.config.settings().model.use_tools and response_main.message.tool_calls:
             tool_calls = response_main.message.tool_calls
 
         result = {}
@@ -277,7 +754,7 @@ class APIClient():
         # Return content (reasoning is stored in context but not returned to caller)
         return result
 
-    async def _recv_stream(self, response, use_tools=True):
+    async def _recv_stream(self, response, handle=None, use_tools=True):
         """takes a response object and extracts the message from it, handling tool calls if needed. streaming version"""
         final_tool_calls = []
         tool_call_buffer = {}
@@ -285,16 +762,16 @@ class APIClient():
         reasoning_tokens = []
 
         token_usage = None
+        received = False
 
         if not response:
             return
 
         try:
             async for chunk in response:
-                if self.cancel_request:
-                    # allow cancelling the stream
-                    if hasattr(response, "close"):
-                        await response.close()
+                received = True
+                if handle is not None and handle.cancelled:
+                    # the handle closes the response, this only skips what was already received
                     return
 
                 if chunk.choices:
@@ -327,27 +804,36 @@ class APIClient():
 
                 # if response has usage data, save it so we can use it to trim context!
                 if hasattr(chunk, 'usage') and chunk.usage is not None:
-                    token_usage = chunk.usage.prompt_tokens
+                    token_usage = self._record_usage(chunk.usage)
 
             if use_tools:
                 for index, tool_call in tool_call_buffer.items():
                     final_tool_calls.append(tool_call)
 
                 # handle tool calls, if any
-                if final_tool_calls and use_tools and core.config.get("model").get("use_tools", False):
+                if final_tool_calls and use_tools and core.config.settings().model.use_tools:
                     yield {"type": "tool_calls", "content": final_tool_calls}
 
             yield {"type": "token_usage", "content": token_usage}
 
         except Exception as e:
-            core.log_error("error while receiving response from AI", e)
+            if handle is not None and handle.cancelled:
+                # reading fails once the handle closed the response
+                return
+            if not isinstance(e, CONNECTION_ERRORS):
+                core.log_error("error while receiving response from AI", e)
+                return
+            if not received:
+                # nothing was streamed yet, let send_stream() retry on another backend
+                raise
+            core.log_error("connection lost while receiving response from AI", e)
 
     async def list_models(self):
         if not self.connected:
             return []
 
         try:
-            models = await self._AI.models.list()
+            models = await self.backends.list_models()
         except Exception as e:
             core.log_error("error while retrieving model list", e)
             return []
@@ -0,0 +1,353 @@
+"""
+the API servers requests can go to. with api.backends in the config, requests are spread over several servers
+(e.g. a few llama.cpp instances), otherwise api.url and api.key are the only backend.
+
+every request goes to the backend with the fewest requests in flight for its weight, among the healthy ones
+that serve the model. backends that fail are left out until a background health check finds them working again.
+
+every backend takes a limited number of requests at once (max_concurrency). requests beyond that wait in a queue,
+and the most urgent ones get the next free slot: what a user is waiting for first, then scheduled jobs,
+then background maintenance like summaries
+"""
+
+import core
+import asyncio
+import heapq
+import itertools
+import time
+import types
+import urllib.parse
+
+# request priorities, most urgent first
+INTERACTIVE = 0
+SCHEDULED = 1
+BACKGROUND = 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", SCHEDULED: "scheduled", BACKGROUND: "background"}
+
+class Backend:
+    """one API server, with its own client on the shared http connection pool"""
+    def __init__(self, name: str, url: str, key: str, weight: float = 1.0, models=(), max_concurrency: int = 0):
+        self.name = name
+        self.url = url
+        self.key = key
+        self.weight = max(0.01, float(weight or 1.0))
+        # models this backend serves. empty means any
+        self.models = tuple(models or ())
+        # 0 means no limit
+        self.max_concurrency = int(max_concurrency or 0)
+
+        self.client = None
+        # what the client was made with, see BackendPool.configure()
+        self.client_options = None
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+
+        self.healthy = False
+        self.error = None
+        # time.monotonic() of the last successful health check
+        self.checked = None
+
+    def key_of(self) -> tuple:
+        """backends with the same key are the same server, so they keep their state when the config is reloaded"""
+        return (self.url, self.key)
+
+    def serves(self, model: str) -> bool:
+        return not self.models or model in self.models
+
+    def full(self) -> bool:
+        return bool(self.max_concurrency) and self.in_flight >= self.max_concurrency
+
+    def load(self) -> float:
+        return self.in_flight / self.weight
+
+    def acquire(self):
+        self.in_flight += 1
+        self.requests += 1
+
+    def release(self):
+        self.in_flight = max(0, self.in_flight - 1)
+
+    def mark_up(self):
+        self.healthy = True
+        self.error = None
+        self.checked = time.monotonic()
+
+    def mark_down(self, error):
+        if self.healthy:
+            core.log("API", f"backend {self.name} is down: {error}")
+        self.healthy = False
+        self.error = str(error)
+        self.checked = None
+        self.failures += 1
+
+    def status(self) -> dict:
+        return {
+            "name": self.name,
+            "url": self.url,
+            "healthy": self.healthy,
+            "error": self.error,
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "weight": self.weight,
+            "models": list(self.models),
+            "requests": self.requests,
+            "failures": self.failures
+        }
+
+    def __repr__(self):
+        return f"<Backend {self.name} {'up' if self.healthy else 'down'}, {self.in_flight} in flight>"
+
+def _options() -> list:
+    """the configured backends as dicts. falls back to api.url and api.key"""
+    api_config = core.config.get("api", {})
+    configured = api_config.get("backends") or []
+    max_concurrency = core.config.settings().get("api.queue.max_concurrency", 0)
+
+    options = []
+    for index, backend in enumerate(configured):
+        if not backend or not backend.get("url"):
+            continue
+        url = backend.get("url")
+        options.append({
+            "name": backend.get("name") or urllib.parse.urlparse(url).netloc or f"backend{index + 1}",
+            "url": url,
+            "key": backend.get("key") or api_config.get("key"),
+            "weight": backend.get("weight", 1),
+            "models": backend.get("models") or (),
+            "max_concurrency": backend.get("max_concurrency", max_concurrency)
+        })
+
+    if not options and api_config.get("url"):
+        options.append({"name": "default", "url": api_config.get("url"), "key": api_config.get("key"), "max_concurrency": max_concurrency})
+
+    return options
+
+class Waiter:
+    """a request waiting for a free backend"""
+    def __init__(self, model: str, priority: int, exclude):
+        self.model = model
+        self.priority = priority
+        self.exclude = exclude
+        self.queued = time.monotonic()
+        self.future = asyncio.get_running_loop().create_future()
+
+class BackendPool:
+    def __init__(self):
+        self.backends = []
+        # the backend the last request went to. on a tie it gets the next one too, so its prompt cache stays warm
+        self._last = None
+
+        # (priority, order, waiter). waiters that got a backend or gave up stay in here until they come up
+        self._queue = []
+        self._order = itertools.count()
+        # priority -> how many requests waited and for how long
+        self.queue_stats = {}
+
+    def configure(self, make_client, http_client) -> list:
+        """
+        (re)builds the backend list from the config. make_client(url, key, http_client, failover) creates the API client
+        of a backend, failover is True when there are other backends to go to.
+        backends that are still configured keep their state and requests in flight
+        """
+        existing = {backend.key_of(): backend for backend in self.backends}
+        configured = _options()
+        backends = []
+        for options in configured:
+            backend = Backend(**options)
+            previous = existing.get(backend.key_of())
+            if previous is not None:
+                # settings like the weight may have changed, the state stays
+                previous.name, previous.weight, previous.models, previous.max_concurrency = \
+                    backend.name, backend.weight, backend.models, backend.max_concurrency
+                backend = previous
+            client_options = (http_client, len(configured) > 1)
+            if backend.client is None or backend.client_options != client_options:
+                backend.client = make_client(backend.url, backend.key, *client_options)
+                backend.client_options = client_options
+            backends.append(backend)
+
+        self.backends = backends
+        return backends
+
+    def healthy(self) -> list:
+        return [backend for backend in self.backends if backend.healthy]
+
+    def candidates(self, model: str, exclude=()) -> list:
+        """the healthy backends that serve a model, whether they're busy or not"""
+        return [
+            backend for backend in self.backends
+            if backend.healthy and backend.serves(model) and backend not in exclude
+        ]
+
+    def pick(self, model: str, exclude=()):
+        """the backend for the next request: the least loaded one with a free slot. None if they're all busy"""
+        candidates = [backend for backend in self.candidates(model, exclude) if not backend.full()]
+        if not candidates:
+            return None
+
+        backend = min(candidates, key=lambda backend: (backend.load(), backend is not self._last))
+        self._last = backend
+        return backend
+
+    async def acquire(self, model: str, priority: int = INTERACTIVE, exclude=(), timeout: float = None):
+        """
+        reserves a slot on a backend for a request, waiting in the queue if they're all busy.
+        returns the backend, to be given back with release(). None if no working backend serves the model.
+        raises asyncio.TimeoutError after waiting for timeout seconds
+        """
+        waiter = Waiter(model, priority, exclude)
+        heapq.heappush(self._queue, (priority, next(self._order), waiter))
+        # gets a slot right away if one is free and nothing more urgent is waiting for it
+        self.dispatch()
+        queued = not waiter.future.done()
+
+        try:
+            backend = await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.future.done() and not waiter.future.cancelled() and waiter.future.result() is not None:
+                # got a backend right as it gave up, so give it back
+                self.release(waiter.future.result())
+            else:
+                waiter.future.cancel()
+            if isinstance(e, asyncio.TimeoutError):
+                self._stats(priority)["timeouts"] += 1
+            raise
+
+        if backend is not None:
+            self._record_wait(priority, time.monotonic() - waiter.queued if queued else 0.0, queued)
+        return backend
+
+    def release(self, backend: Backend):
+        """gives back the slot of a finished request, and hands it to the next one in the queue"""
+        backend.release()
+        self.dispatch()
+
+    def dispatch(self):
+        """gives free slots to the waiting requests, most urgent first"""
+        if not self._queue:
+            return
+
+        waiting = []
+        while self._queue:
+            entry = heapq.heappop(self._queue)
+            waiter = entry[2]
+            if waiter.future.done():
+                continue
+
+            if not self.candidates(waiter.model, waiter.exclude):
+                # the backends for this model went down while it waited
+                waiter.future.set_result(None)
+                continue
+
+            backend = self.pick(waiter.model, waiter.exclude)
+            if backend is None:
+                # busy. requests for other models can still get a slot
+                waiting.append(entry)
+                continue
+
+            backend.acquire()
+            waiter.future.set_result(backend)
+
+        for entry in waiting:
+            heapq.heappush(self._queue, entry)
+
+    def _stats(self, priority: int) -> dict:
+        stats = self.queue_stats.get(priority)
+        if stats is None:
+            stats = self.queue_stats[priority] = {
+                "requests": 0, "queued": 0, "timeouts": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0, "last_wait_seconds": 0.0
+            }
+        return stats
+
+    def _record_wait(self, priority: int, seconds: float, queued: bool):
+        stats = self._stats(priority)
+        stats["requests"] += 1
+        if queued:
+            stats["queued"] += 1
+        stats["wait_seconds"] += seconds
+        stats["max_wait_seconds"] = max(stats["max_wait_seconds"], seconds)
+        stats["last_wait_seconds"] = seconds
+
+    def queue_status(self) -> dict:
+        """queue depth per priority and how long requests waited"""
+        depth = {name: 0 for name in PRIORITY_NAMES.values()}
+        for _, _, waiter in self._queue:
+            if not waiter.future.done():
+                depth[PRIORITY_NAMES.get(waiter.priority, str(waiter.priority))] += 1
+
+        waits = {}
+        for priority, stats in sorted(self.queue_stats.items()):
+            waits[PRIORITY_NAMES.get(priority, str(priority))] = {
+                **stats,
+                "average_wait_seconds": stats["wait_seconds"] / stats["requests"] if stats["requests"] else 0.0
+            }
+
+        return {
+            "waiting": sum(depth.values()),
+            "depth": depth,
+            "in_flight": sum(backend.in_flight for backend in self.backends),
+            "waits": waits
+        }
+
+    async def check(self, backend: Backend, force: bool = False) -> bool:
+        """lists the models of a backend to see if it works. skipped if that succeeded recently"""
+        max_age = core.config.settings().get("api.http.health_check_seconds", 60)
+        if not force and backend.healthy and backend.checked and time.monotonic() - backend.checked < max_age:
+            return True
+
+        try:
+            await backend.client.models.list()
+        except Exception as e:
+            backend.mark_down(e)
+            raise
+
+        if not backend.healthy and backend.failures:
+            core.log("API", f"backend {backend.name} is back up")
+        backend.mark_up()
+        return True
+
+    async def check_all(self, force: bool = False) -> list:
+        """checks every backend at once. returns the errors, as (backend, exception)"""
+        results = await asyncio.gather(*[self.check(backend, force) for backend in self.backends], return_exceptions=True)
+        return [(backend, result) for backend, result in zip(self.backends, results) if isinstance(result, BaseException)]
+
+    async def list_models(self):
+        """the models of all healthy backends, in the shape of the openai model list"""
+        backends = self.healthy()
+        results = await asyncio.gather(*[backend.client.models.list() for backend in backends], return_exceptions=True)
+
+        models = {}
+        for backend, result in zip(backends, results):
+            if isinstance(result, BaseException):
+                core.log_error(f"error while retrieving model list from {backend.name}", result)
+                continue
+            for model in result.data:
+                if backend.serves(model.id):
+                    models.setdefault(model.id, model)
+
+        return types.SimpleNamespace(data=list(models.values()))
+
+    def status(self) -> list:
+        return [backend.status() for backend in self.backends]
+
+    async def watch(self, on_check=None):
+        """
+        background task. checks all backends regularly, so failed ones come back once they work again.
+        on_check is awaited after every round
+        """
+        while True:
+            interval = float(core.config.settings().get("api.http.health_check_seconds", 60))
+            # failed backends are tried more often
+            if any(not backend.healthy for backend in self.backends):
+                interval = min(interval, 10)
+            await asyncio.sleep(max(1, interval))
+
+            try:
+                await self.check_all(force=True)
+                # backends that came back can take waiting requests
+                self.dispatch()
+                if on_check:
+                    await on_check()
+            except Exception as e:
+                core.log_error("error while checking API backends", e)
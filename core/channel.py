@@ -18,6 +18,9 @@ class Channel:
 
         self.tc_manager = core.toolcalls.ToolcallManager(self)
 
+        # handles of the requests this channel is waiting for, see cancel()
+        self._requests = set()
+
     async def _set_as_active_channel(self):
         self.manager.channel = self
 
@@ -77,7 +80,17 @@ class Channel:
                 return self._get_disconnection_message()
 
             # then request AI response and add it to context
-            response = await self.manager.API.send(context)
+            basis = self.context.chat.usage_basis(context)
+            handle = core.api_client.RequestHandle()
+            self._requests.add(handle)
+            try:
+                response = await self.manager.API.send(context, handle=handle)
+            finally:
+                self._requests.discard(handle)
+
+            if handle.prompt_tokens:
+                # the real prompt size, keeps trimming and token counts accurate
+                await self.context.chat.record_usage(basis, handle.prompt_tokens)
 
             # Handle error responses
             if isinstance(response, dict) and "error" in response:
@@ -89,7 +102,15 @@ class Channel:
             return response
 
     async def send_stream(self, message: dict):
-        """sends a message to the AI from within the current channel, streaming version"""
+        """
+        sends a message to the AI from within the current channel, streaming version.
+        tokens come in batches, as set in channels.settings.{name}.stream_window_ms (see core.stream)
+        """
+        window_ms, max_bytes = core.stream.settings_for(self)
+        async for token in core.stream.coalesce(self._send_stream(message), window_ms, max_bytes):
+            yield token
+
+    async def _send_stream(self, message: dict):
 
         # as soon as user sends a message in this channel, set current channel (tracked in the manager) to this one
         await self._set_as_active_channel()
@@ -127,36 +148,46 @@ class Channel:
             tc_response = None
             tool_calls_occurred = False
 
-            async for token in self.manager.API.send_stream(context):
-                token_type = token.get("type")
-
-                # Handle error tokens
-                if token_type == "error":
-                    error_data = token.get("content", {})
-                    error_msg = error_data.get("message", "Unknown error")
-                    yield {"type": "content", "content": f"API Error: {error_msg}"}
-                    return
-
-                if token_type == "content":
-                    # this is a normal piece of streamed text
-                    final_content.append(token.get("content"))
-                    yield token
-                elif token_type == "reasoning":
-                    final_reasoning.append(token.get("content"))
-                    yield token
-                elif token_type == "tool_calls":
-                    tool_calls_occurred = True
-                    # Pass accumulated content to be included in tool_calls message
-
-                    async for sub_token in self.tc_manager.process(
-                        token.get("content"),
-                        initial_content="".join(final_content)
-                    ):
-                        yield sub_token
-                    # tc_manager.process() will loop until the AI no longer deems tool calls necessary
-                elif token_type == "usage":
-                    # this is the final token usage count, also emitted at the end of the stream
-                    pass
+            # counted now, tool calls add to the chat before the usage of this request comes in
+            basis = self.context.chat.usage_basis(context)
+
+            # lets /stop cancel this request, and the tool call requests that follow from it
+            handle = core.api_client.RequestHandle()
+            self._requests.add(handle)
+            try:
+                async for token in self.manager.API.send_stream(context, handle=handle):
+                    token_type = token.get("type")
+
+                    # Handle error tokens
+                    if token_type == "error":
+                        error_data = token.get("content", {})
+                        error_msg = error_data.get("message", "Unknown error")
+                        yield {"type": "content", "content": f"API Error: {error_msg}"}
+                        return
+
+                    if token_type == "content":
+                        # this is a normal piece of streamed text
+                        final_content.append(token.get("content"))
+                        yield token
+                    elif token_type == "reasoning":
+                        final_reasoning.append(token.get("content"))
+                        yield token
+                    elif token_type == "tool_calls":
+                        tool_calls_occurred = True
+                        # Pass accumulated content to be included in tool_calls message
+
+                        async for sub_token in self.tc_manager.process(
+                            token.get("content"),
+                            initial_content="".join(final_content),
+                            handle=handle
+                        ):
+                            yield sub_token
+                        # tc_manager.process() will loop until the AI no longer deems tool calls necessary
+                    elif token_type == "token_usage":
+                        # this is the final token usage count, emitted at the end of the stream
+                        await self.context.chat.record_usage(basis, token.get("content"))
+            finally:
+                self._requests.discard(handle)
 
             # add AI's response to context as well
             if not tool_calls_occurred:
@@ -170,6 +201,13 @@ class Channel:
 
                 await self.context.chat.add(new_message)
 
+    async def cancel(self) -> bool:
+        """cancels the requests this channel is waiting for. requests of other channels keep going"""
+        cancelled = False
+        for handle in list(self._requests):
+            cancelled = await handle.cancel() or cancelled
+        return cancelled
+
     async def announce(self, message: str, type=None):
         """called externally to announce things in this channel, such as a reminder sent by the AI"""
         if not type:
@@ -1,132 +1,365 @@
 import core
+import os
+import copy
 import ulid
+import asyncio
+import msgpack
+import json
+import hashlib
+import collections
 import datetime
 
+# token counts per (tokenizer, message content hash), shared by all chats. least recently used first
+_token_cache = collections.OrderedDict()
+TOKEN_CACHE_SIZE = 20000
+# (tools list, its items, tokenizer name, token count) of the tool schemas last counted
+_tools_tokens = (None, (), None, 0)
+
 class Chat:
     DEFAULT_DATA = {
         "title": "",
         "tags": []
     }
 
-    """contains openAI messages array, and can save and load sets of messages from files"""
+    # the first few messages of every chat, so chat lists can be searched without sending every chat. see get_previews()
+    PREVIEW_MESSAGES = 5
+    PREVIEW_LENGTH = 500
+
+    """
+    contains openAI messages array, and can save and load sets of messages from files
+
+    every chat is stored in its own file in data/chats/{channel}/, next to a small index with
+    the title, tags, dates and message count of each chat. saving only writes the current chat,
+    and listing chats only needs the index.
+
+    at startup only the index gets loaded. messages are loaded when a chat is opened, and only
+    the last few opened chats (storage.resident_chats) are kept in memory
+    """
     def __init__(self, channel):
-        self.data = core.storage.StorageList(f"{channel.name}_chats", "json")
         self.channel = channel
-        self.current = None
+        self.data_dir = os.path.join("data", "chats", channel.name)
+        self.index = core.storage.StorageDict("index", "json", data_dir=self.data_dir, snapshots=True)
+        # (ID, messages) of the current chat
+        self._view = (None, None)
+        # chat ID -> message list, least recently used first
+        self._resident = collections.OrderedDict()
+
+        # token count of every message in the current chat, and their sum. see count_tokens()
+        self._token_counts = []
+        self._token_total = 0
+        self._token_source = (None, None)
+        # (messages, model, prompt_tokens, local count) of the last request the API reported usage for
+        self._usage = (None, None, 0, 0)
+        # chat ID -> running compaction task, see compact()
+        self._compacting = {}
+        # chat ID -> (updated, preview), see get_previews()
+        self._previews = {}
+
+        self._migrate()
+        self._drop_index_previews()
+
+    def _migrate(self):
+        """one-shot import of the old {channel}_chats.json file, which had every chat in it"""
+        legacy_name = f"{self.channel.name}_chats"
+        legacy_path = core.get_path(os.path.join("data", f"{legacy_name}.json"))
+        if not os.path.exists(legacy_path):
+            return False
+
+        legacy = core.storage.StorageList(legacy_name, "json", write_behind=False)
+        for chat in legacy:
+            if not isinstance(chat, dict) or not chat.get("id"):
+                continue
+
+            if self._find_id(chat["id"]) is not None:
+                # short IDs can collide, and the chats would end up merged into one file
+                new_id = self._new_id()
+                core.log("storage", f"chat ID {chat['id']} is already taken, migrating it as {new_id}")
+                chat = {**chat, "id": new_id}
+
+            messages = self._open(chat["id"])
+            messages.extend(chat.get("messages") or [])
+            messages.flush()
+            self.index[chat["id"]] = self._metadata(chat, messages)
+        self.index.flush()
+
+        os.replace(legacy_path, f"{legacy_path}.migrated")
+        core.log("storage", f"migrated {len(legacy)} chats from {legacy_name}.json to {self.data_dir}")
+        return True
+
+    def _drop_index_previews(self):
+        """older indexes kept message previews, which made rewriting the index after every message slow"""
+        if not any("preview" in chat for chat in self.index.values()):
+            return False
+
+        for chat in self.index.values():
+            chat.pop("preview", None)
+        self.index.save()
+        return True
+
+    @property
+    def current(self):
+        """ID of the current chat"""
+        return self._view[0]
+
+    @property
+    def messages(self):
+        return self._view[1]
+
+    def _switch(self, id, messages):
+        # a single assignment, so other threads never see the ID of one chat with the messages of another
+        self._view = (id, messages)
+
+    def _open(self, id: str):
+        """opens the message file of a chat. json message files from older versions get converted on first open"""
+        return core.storage.StorageList(id, "compressed", data_dir=self.data_dir, snapshots=True)
+
+    def _paths(self, id: str):
+        """the message file of a chat, and the files of older versions that _open() would convert"""
+        base_path = core.get_path(os.path.join(self.data_dir, id))
+        return [f"{base_path}.{ext}" for ext in ("mpz", "mp", "json")]
+
+    async def _aopen(self, id: str):
+        return await core.storage.StorageList.aopen(id, "compressed", data_dir=self.data_dir, snapshots=True)
+
+    async def _get_resident(self, id: str):
+        """returns the messages of a chat, loading them from disk if they aren't in memory yet"""
+        messages = self._resident.get(id)
+        if messages is None:
+            messages = await self._aopen(id)
+            await self._make_resident(id, messages)
+        else:
+            self._resident.move_to_end(id)
+
+        return messages
+
+    async def _make_resident(self, id: str, messages):
+        self._resident[id] = messages
+        self._resident.move_to_end(id)
+
+        # forget the least recently used chats
+        limit = max(1, int(core.config.settings().get("storage.resident_chats", 8)))
+        evicted = []
+        for resident_id in list(self._resident.keys()):
+            if len(self._resident) <= limit:
+                break
+            if resident_id != self.current:
+                evicted.append(self._resident.pop(resident_id))
+
+        # their unsaved changes have to be on disk before they can be loaded again
+        for evicted_messages in evicted:
+            await evicted_messages.aclose()
+
+    def _metadata(self, chat: dict, messages: list):
+        metadata = {key: chat.get(key, default_value) for key, default_value in self.DEFAULT_DATA.items()}
+        metadata.update({
+            "id": chat.get("id"),
+            "created": chat.get("created"),
+            "updated": chat.get("updated"),
+        })
+        self._update_metadata(metadata, messages)
+        return metadata
 
-        # find any missing metadata fields and add them
-        for index, chat in enumerate(self.data):
-            for key, default_value in self.DEFAULT_DATA.items():
-                if key not in chat.keys():
-                    self.data[index][key] = default_value
+    def _update_metadata(self, metadata: dict, messages: list):
+        metadata["message_count"] = len(messages)
 
-    def _find_index(self, id: str):
-        """find index of the chat with that ID"""
-        for index, chat in enumerate(self.data):
-            if chat.get("id", "").upper() == id.upper():
-                return index
+    def _preview(self, messages: list):
+        return [
+            {"role": msg.get("role"), "content": str(msg.get("content"))[:self.PREVIEW_LENGTH]}
+            for msg in messages[:self.PREVIEW_MESSAGES]
+            if msg.get("content")
+        ]
+
+    def _find_id(self, id: str):
+        """find the stored ID of the chat with that ID, case insensitive"""
+        for chat_id in self.index.keys():
+            if chat_id.upper() == id.upper():
+                return chat_id
 
         return None
 
+    def _new_id(self):
+        # the start of a ULID is its timestamp, so chats created within the same second would share an ID.
+        # the end is random
+        id = str(ulid.ULID())[-8:]
+        while self._find_id(id) is not None:
+            id = str(ulid.ULID())[-8:]
+        return id
+
     async def new(self, title: str = "New chat"):
         """create a new chat"""
         now = datetime.datetime.utcnow().isoformat()
+        id = self._new_id()
 
-        self.data.append({
-            "id": str(ulid.ULID())[:8],
+        self.index[id] = {
+            "id": id,
             "title": title,
             "tags": [],
-            "messages": [],
             "created": now,
-            "updated": now
-        })
-        index = len(self.data) - 1
-        self.current = index
+            "updated": now,
+            "message_count": 0
+        }
+        self._switch(id, await self._aopen(id))
+        await self._make_resident(id, self.messages)
 
-        self.data.save()
+        await self.index.asave()
         return True
     async def clear(self):
         if self.current is None:
             return False
 
-        self.data[self.current]["messages"] = []
+        self.messages.clear()
         await self.save()
 
         return True
     async def delete(self, id: str):
         """delete an entire chat"""
 
-        index = self._find_index(id)
+        id = self._find_id(id)
 
-        if index is None:
+        if id is None:
             return False
 
-        self.data.pop(index)
-        self.data.save()
+        ids = list(self.index.keys())
+        position = ids.index(id)
+
+        del self.index[id]
+        self._previews.pop(id, None)
+        await self.index.asave()
+
+        messages = self._resident.pop(id, None)
+        if messages is not None:
+            # also drops its pending writes, so they can't bring the file back
+            messages.delete()
+        else:
+            # not in memory, so nothing is waiting to be written. no need to load the chat just to delete it
+            for path in self._paths(id):
+                if os.path.exists(path):
+                    os.remove(path)
+
+        if self.current == id:
+            # deleted the current chat, so move on to the chat that took its place
+            ids.remove(id)
+            if ids:
+                next_id = ids[min(position, len(ids) - 1)]
+                self._switch(next_id, await self._get_resident(next_id))
+            else:
+                self._switch(None, None)
 
-        # Adjust current index if needed
-        if self.current == index:
-            # Deleted the current chat - reset or move to previous
-            self.current = min(index, len(self.data) - 1) if self.data else None
-        elif self.current > index:
-            # Current was after deleted item, shift down
-            self.current -= 1
-
-        return self.current
+        return True
 
     async def save(self):
         if self.current is None:
             await self.new()
 
-        return self.data.save()
+        metadata = self.index[self.current]
+        metadata["updated"] = datetime.datetime.utcnow().isoformat()
+        self._update_metadata(metadata, self.messages)
+
+        await self.index.asave()
+        return await self.messages.asave()
     async def load(self, id: str):
-        index = self._find_index(id)
+        id = self._find_id(id)
 
-        if index is None:
+        if id is None:
             return False
 
-        self.current = index
+        if id != self.current:
+            self._switch(id, await self._get_resident(id))
 
         return True
 
+    def snapshot(self):
+        """
+        read-only view of the current chat as it was last saved: its ID, title, tags and messages.
+        meant for other threads (like the webui), it doesn't need the event loop or any locks
+        """
+        id, messages = self._view
+        metadata = (self.index.snapshot().get(id) or {}) if id else {}
+
+        return {
+            "id": id,
+            "title": metadata.get("title"),
+            "tags": metadata.get("tags", ()),
+            "messages": messages.snapshot() if messages is not None else core.storage.Snapshot.of([])
+        }
+
+    def snapshot_all(self):
+        """read-only view of the index of all chats, as it was last saved. safe to call from any thread"""
+        return tuple(self.index.snapshot().data.values())
+
     async def get_all(self):
-        """returns all chats in the storage"""
-        return self.data
+        """returns the index entries of all chats in the storage, without their messages"""
+        # missing metadata fields are filled in here instead of in the stored index, so nothing has to be rewritten
+        return [{**copy.deepcopy(self.DEFAULT_DATA), **chat} for chat in self.index.values()]
+
+    async def get_messages(self, id: str):
+        """returns the message history of any chat, without switching to it"""
+        id = self._find_id(id)
+        if id is None:
+            return None
+        if id in self._resident:
+            return self._resident[id]
+
+        # don't make it resident, searching through all chats would push everything else out
+        return await self._aopen(id)
+
+    async def get_previews(self, ids: list):
+        """
+        the first few messages of these chats, shortened. read from the chat files,
+        and kept in memory until a chat gets updated. returns a dict of chat ID -> preview
+        """
+        previews = {}
+        for id in ids:
+            metadata = self.index.get(id)
+            if metadata is None:
+                continue
+
+            cached = self._previews.get(id)
+            if cached is not None and cached[0] == metadata.get("updated"):
+                previews[id] = cached[1]
+                continue
+
+            messages = await self.get_messages(id) or []
+            previews[id] = self._preview(messages)
+            self._previews[id] = (metadata.get("updated"), previews[id])
+
+        return previews
 
     async def get_title(self):
         if self.current is None:
             return None
-        return self.data[self.current].get("title")
+        return self.index[self.current].get("title")
 
     async def set_title(self, title: str):
         if self.current is None:
             return False
 
-        self.data[self.current]["title"] = title
-        await self.save()
+        self.index[self.current]["title"] = title
+        await self.index.asave()
         return True
 
     async def set_tags(self, tags: list):
         if self.current is None:
             return False
 
-        self.data[self.current]["tags"] = tags
-        await self.save()
+        self.index[self.current]["tags"] = tags
+        await self.index.asave()
         return True
 
     async def get_tags(self):
         if self.current is None:
             return False
 
-        return self.data[self.current].get("tags", [])
+        return self.index[self.current].get("tags", [])
 
     async def add_tag(self, tag: str):
         if self.current is None:
             return False
 
-        if tag not in self.data[self.current]["tags"]:
-            self.data[self.current]["tags"].append(tag)
-            await self.save()
+        tags = self.index[self.current].setdefault("tags", [])
+        if tag not in tags:
+            tags.append(tag)
+            await self.index.asave()
             return True
 
         return False
@@ -135,9 +368,10 @@ class Chat:
         if self.current is None:
             return False
 
-        if tag in self.data[self.current]["tags"]:
-            self.data[self.current]["tags"].remove(tag)
-            await self.save()
+        tags = self.index[self.current].setdefault("tags", [])
+        if tag in tags:
+            tags.remove(tag)
+            await self.index.asave()
             return True
 
         return False
@@ -147,21 +381,50 @@ class Chat:
         if self.current is None:
             return None
 
-        return self.data[self.current].get("messages", [])
+        return self.messages
     async def get_id(self):
-        if self.current is None:
-            return None
-
-        return self.data[self.current].get("id", None)
+        return self.current
 
     async def set(self, messages: list):
         """overwrite message history of current chat"""
         if self.current is None:
             await self.new()
 
-        self.data[self.current]["messages"] = messages
+        # copy first, messages might be the current message list itself
+        messages = list(messages)
+        self.messages.clear()
+        self.messages.extend(messages)
+        self._recount_tokens()
         await self.save()
         return True
+    async def edit(self, index: int, content: str, allowed=None):
+        """
+        changes the content of one message of the current chat. works on the live message list,
+        so messages added in the meantime are kept. allowed(message) can refuse the edit
+        """
+        if self.current is None or not 0 <= index < len(self.messages):
+            return {"success": False, "error": f"Index {index} out of range"}
+        if allowed is not None and not allowed(self.messages[index]):
+            return {"success": False, "error": "Cannot edit this message type"}
+
+        self._sync_token_counts()
+        message = {**self.messages[index], "content": content}
+        self.messages[index] = message
+        num_tokens = self._message_tokens(message)
+        self._token_total += num_tokens - self._token_counts[index]
+        self._token_counts[index] = num_tokens
+
+        await self.save()
+        return {"success": True, "total": len(self.messages)}
+    async def truncate(self, index: int, allowed=None):
+        """removes a message of the current chat and everything after it. allowed(message) can refuse it"""
+        if self.current is None or not 0 <= index < len(self.messages):
+            return {"success": False, "error": f"Index {index} out of range"}
+        if allowed is not None and not allowed(self.messages[index]):
+            return {"success": False, "error": "Cannot delete this message type"}
+
+        await self.set(self.messages[:index])
+        return {"success": True, "remaining": len(self.messages)}
     async def add(self, message: dict, temporary = False):
         """add message to current chat"""
         if self.current is None:
@@ -172,9 +435,13 @@ class Chat:
             message["temporary"] = True
 
         await self.trim() # automatically trim chat history
+        self._start_compaction() # or summarize the oldest messages in the background, if enabled
         await self._insert_blank_user_msg(message)
-        self.data[self.current]["messages"].append(message)
-        index = len(self.data[self.current]["messages"]) - 1
+        self._sync_token_counts()
+        self.messages.append(message)
+        self._token_counts.append(self._message_tokens(message))
+        self._token_total += self._token_counts[-1]
+        index = len(self.messages) - 1
 
         await self.save()
         return index
@@ -183,63 +450,240 @@ class Chat:
         if self.current is None:
             await self.new()
 
-        self.data[self.current]["messages"].pop(index)
-        index = len(self.data[self.current]["messages"]) - 1
+        self._sync_token_counts()
+        if index is None:
+            index = -1
+        self.messages.pop(index)
+        self._token_total -= self._token_counts.pop(index)
+        index = len(self.messages) - 1
         await self.save()
         return index
 
     async def trim(self, max_messages: int = None, max_tokens: int = None, num_tokens: int = None):
-        """trims chat history to keep token consumption low"""
+        """
+        trims chat history to keep token consumption low
+
+        drops temporary messages, then works out in one pass how many of the oldest messages have to go.
+        the cut never lands between an assistant message with tool_calls and its tool replies,
+        and pinned messages at the start (the summary left by compact()) are never cut.
+        the result is applied as one slice, saved once and announced once
+        """
+        settings = core.config.settings()
         if not max_messages:
-            max_messages = int(core.config.get("api").get("max_messages", 200))
+            max_messages = settings.api.max_messages
         if not max_tokens:
-            max_tokens = int(core.config.get("api").get("max_context", 8192))
+            max_tokens = settings.api.max_context
 
         messages = await self.get()
         if not messages:
             return 0 # no messages, so length is 0
 
-        # get rid of temporary messages
-        for index, msg in enumerate(messages):
-            if msg.get("temporary"):
-                await self.pop(index)
-
+        # get rid of temporary messages. the counts add() and pop() keep up to date are reused,
+        # so a trim doesn't have to look up every message of the history again
+        self._sync_token_counts()
+        encoding = self._encoding()
+        kept = []
+        counts = []
+        for msg, count in zip(messages, self._token_counts):
+            if not msg.get("temporary"):
+                kept.append(msg)
+                counts.append(count)
         if not num_tokens:
-            # fall back to counting messages list using tiktoken
-            num_tokens = await self.count_tokens()
-
-        # re-fetch messages, cuz we popped
-        messages = await self.get()
+            # what the API reported for the last request, adjusted by what changed since.
+            # falls back to counting messages locally
+            num_tokens = self._context_tokens(sum(counts)) if kept else 0
+
+        # local counts are off by a model specific factor, correct them so cuts are planned in real tokens
+        factor = core.tokenizer.correction(self.channel.manager.API._model)
+        pinned = self._pinned_count(kept)
+        cut = self._plan_cut(kept[pinned:], [count * factor for count in counts[pinned:]], num_tokens, max_messages, max_tokens)
+
+        if cut or len(kept) != len(messages):
+            remaining = kept[:pinned] + kept[pinned + cut:]
+            self.messages.clear()
+            self.messages.extend(remaining)
+            self._token_counts = counts[:pinned] + counts[pinned + cut:]
+            self._token_total = sum(self._token_counts)
+            self._token_source = (self.messages, encoding.name)
+            await self.save()
 
-        request_too_big = False
-        context_trimmed = False
-        tokens_exceeded = (num_tokens >= max_tokens)
-        message_count_exceeded = (len(messages) >= max_messages)
-        num_tokens = await self.count_tokens()
-
-        # need to recalculate it cuz this is a while loop
-        while len(messages) >= max_messages or num_tokens >= max_tokens:
-            # pop!
-            await self.pop(0)
-
-            # keep re-fetching
-            messages = await self.get()
-            if not messages:
-                request_too_big = True
-                # we've exhausted all messages. handle it later in this function
+        if cut:
+            if cut == len(kept) - pinned:
+                # the entire thing was too big including user's input! inform them
+                await self.channel.announce("Your request exceeds the max amount of tokens allowed. Please send a smaller request!", "error")
+            else:
+                details = []
+                if len(kept) >= max_messages:
+                    details.append(f"Amount of messages: {len(kept)}\nMax messages allowed: {max_messages}")
+                if num_tokens >= max_tokens:
+                    details.append(f"Tokens: {int(num_tokens)}\nMax allowed tokens: {max_tokens}")
+                details = "\n\n".join(details)
+                await self.channel.announce(f"Context size trimmed, removed the {cut} oldest messages.\n\n{details}", "error")
+
+        return len(kept) - cut <= max_messages
+
+    def _pinned_count(self, messages: list) -> int:
+        """number of pinned messages at the start of a message list"""
+        count = 0
+        while count < len(messages) and messages[count].get("pinned"):
+            count += 1
+        return count
+
+    def _plan_cut(self, messages: list, counts: list, num_tokens: int, max_messages: int, max_tokens: int) -> int:
+        """
+        returns how many messages to remove from the start, so that both the message count and
+        the token count end up below their limits. counts are the token counts of each message
+        """
+        cut = 0
+        removed_tokens = 0
+        while cut < len(messages):
+            within_limits = (len(messages) - cut < max_messages) and (num_tokens - removed_tokens < max_tokens)
+            # tool replies belong to the assistant message before them, so never start with one
+            if within_limits and messages[cut].get("role") != "tool":
                 break
 
-            # keep recalculating tokens
-            num_tokens = await self.count_tokens()
+            removed_tokens += counts[cut]
+            cut += 1
 
-            if request_too_big:
-                # the entire thing was too big including user's input! inform them
-                await self.channel.announce("Your request exceeds the max amount of tokens allowed. Please send a smaller request!", "error")
-            elif message_count_exceeded:
-                await self.channel.announce(f"You exceeded the max amount of messages set in your settings! Context size trimmed.\n\nAmount of messages: {len(messages)}\nMax messages allowed: {max_messages}", "error")
-            elif context_trimmed:
-                await self.channel.announce("Input was too large! Context size trimmed.\n\nSent tokens: {num_tokens}\nMax allowed tokens: {max_tokens}", "error")
-        return len(messages) <= max_messages
+        return cut
+
+    def _start_compaction(self):
+        """starts compact() in the background when the current chat gets close to its limits"""
+        settings = core.config.settings()
+        if not settings.get("api.compaction.enabled", False) or not self.messages:
+            return None
+
+        running = self._compacting.get(self.current)
+        if running is not None and not running.done():
+            return None
+
+        threshold = settings.get("api.compaction.threshold", 0.75)
+        if (
+            len(self.messages) < settings.api.max_messages * threshold
+            and self._context_tokens(self._local_tokens()) < settings.api.max_context * threshold
+        ):
+            return None
+
+        chat_id = self.current
+        task = asyncio.create_task(self.compact())
+        self._compacting[chat_id] = task
+
+        def finished(task):
+            if self._compacting.get(chat_id) is task:
+                del self._compacting[chat_id]
+        task.add_done_callback(finished)
+        return task
+
+    async def compact(self):
+        """
+        folds the oldest messages of the current chat into a summary, written by the AI.
+
+        the summary is kept as a pinned system message at the start of the chat, so it's saved with the
+        chat and never trimmed. later compactions only summarize the new spill-over, together with the
+        previous summary, so nothing gets summarized twice
+        """
+        settings = core.config.settings()
+        chat_id, messages = self._view
+        if not messages:
+            return False
+
+        pinned = self._pinned_count(messages)
+        rest = list(messages[pinned:])
+        counts = self._count_messages(rest)
+        factor = core.tokenizer.correction(self.channel.manager.API._model)
+
+        target = settings.get("api.compaction.target", 0.5)
+        cut = self._plan_cut(
+            rest,
+            [count * factor for count in counts],
+            self._context_tokens(self._local_tokens()) if messages is self.messages else sum(counts) * factor,
+            max(1, int(settings.api.max_messages * target)),
+            max(1, int(settings.api.max_context * target))
+        )
+        # the summary is followed by a user message, so the history after it starts with a proper turn
+        while 0 < cut < len(rest) - 1 and rest[cut].get("role") != "user":
+            cut += 1
+        # always keep the latest message, the AI is about to answer it
+        cut = min(cut, len(rest) - 1)
+        if cut < 2:
+            return False
+
+        block = rest[:cut]
+        previous = messages[0] if pinned else None
+        # what the summary replaces, captured before the request. edit() swaps in new message dicts,
+        # so comparing identities afterwards catches edits, truncates and trims made in the meantime
+        replaced = list(messages[:pinned]) + block
+        count = len(messages)
+        summary = await self._summarize(block, previous.get("content") if previous else None)
+        if not summary:
+            return False
+
+        # the chat changed while the summary was written (cleared, trimmed, edited, reloaded..), so it doesn't fit anymore.
+        # new messages at the end are fine, they're kept after the summary
+        if chat_id not in self.index or self._resident.get(chat_id) is not messages or len(messages) < count or any(
+            current is not original for current, original in zip(messages[:pinned + cut], replaced)
+        ):
+            core.log("chat", f"chat {chat_id} changed while it was being compacted, discarding summary")
+            return False
+
+        summarized = (previous.get("summary", {}).get("messages", 0) if previous else 0) + cut
+        messages[:pinned + cut] = [{
+            "role": "system",
+            "content": summary,
+            "pinned": True,
+            "summary": {
+                "messages": summarized,
+                "updated": datetime.datetime.utcnow().isoformat()
+            }
+        }]
+
+        if messages is self.messages:
+            self._recount_tokens()
+            await self.save()
+        else:
+            # the user switched to another chat in the meantime
+            self._update_metadata(self.index[chat_id], messages)
+            await self.index.asave()
+            await messages.asave()
+
+        core.log("chat", f"compacted {cut} messages of chat {chat_id} into a summary ({summarized} messages summarized so far)")
+        return True
+
+    async def _summarize(self, messages: list, previous: str = None):
+        """asks the AI for a summary of these messages, continuing a previous summary if there is one"""
+        transcript = []
+        for msg in messages:
+            if msg.get("temporary"):
+                continue
+            content = msg.get("content")
+            if msg.get("tool_calls"):
+                calls = ", ".join(str(call.get("function", {}).get("name")) for call in msg["tool_calls"] if isinstance(call, dict))
+                content = f"{content or ''}\n(called tools: {calls})".strip()
+            if content:
+                transcript.append(f"{msg.get('role')}: {content}")
+
+        if not transcript:
+            return None
+
+        request = "Summarize the conversation below, so that it can be continued without it. Keep facts, decisions, names, open tasks and anything the user asked to remember. Write only the summary."
+        if previous:
+            request += f"\n\nThis is the summary of what came before it. Merge it into your summary:\n{previous}"
+        request += "\n\n" + "\n\n".join(transcript)
+
+        settings = core.config.settings()
+        response = await self.channel.manager.API.send(
+            [{"role": "user", "content": request}],
+            use_tools=False,
+            model=settings.get("api.compaction.model") or None,
+            record_usage=False,
+            priority=core.backends.BACKGROUND
+        )
+
+        if not isinstance(response, dict) or response.get("error") or not response.get("content"):
+            core.log("chat", f"could not summarize chat history: {response.get('message') if isinstance(response, dict) else response}")
+            return None
+
+        return f"[Summary of the earlier conversation]:\n{response['content'].strip()}"
 
     async def _insert_blank_user_msg(self, message: dict):
         messages = await self.get()
@@ -262,30 +706,172 @@ class Chat:
 
     async def count_tokens(self, messages: list = None) -> int:
         """
-        Counts tokens locally using tiktoken.
+        Counts tokens locally, with the tokenizer of the current model (see core.tokenizer).
         Used as a fallback if the API doesn't return usage data.
+
+        token counts are cached per message, and the total of the current chat is kept up to date
+        by add(), pop() and set(), so counting the current chat doesn't encode anything
         """
-        import tiktoken
-        try:
-            # Try to get the specific tokenizer for the model (e.g. gpt-4)
-            encoding = tiktoken.encoding_for_model(self.channel.manager.API._model)
-        except KeyError:
-            # Fallback to a standard encoding for unknown/custom models
-            encoding = tiktoken.get_encoding("cl100k_base")
-
-        num_tokens = 0
-        _messages = messages if messages else await self.get()
-        if not _messages:
+        num_tokens = self._local_tokens(messages)
+        if not num_tokens:
             return 0
 
-        for message in _messages:
-            # OpenAI message format overhead is ~4 tokens per message
-            # <im_start>{role/name}\n{content}<im_end>\n
-            num_tokens += 4
-            for key, value in message.items():
-                if value:
-                    num_tokens += len(encoding.encode(str(value)))
+        # corrected by what the API reported for earlier requests, see core.tokenizer.calibrate()
+        num_tokens *= core.tokenizer.correction(self.channel.manager.API._model)
 
         # Add 2-3 tokens for the assistant priming at the end
         num_tokens += 2
         return int(num_tokens)
+
+    def _local_tokens(self, messages: list = None) -> int:
+        """uncorrected local count of these messages, or of the current chat"""
+        if messages is None or messages is self.messages:
+            if not self.messages:
+                return 0
+            self._sync_token_counts()
+            return self._token_total
+
+        if not messages:
+            return 0
+        return sum(self._count_messages(messages, self._encoding()))
+
+    def usage_basis(self, context: list) -> tuple:
+        """
+        the local counts of a request, taken right when it's built: (messages, model, count of the context, count of the chat).
+        hand it to record_usage() once the API reported the prompt size, the chat may have grown by then (tool calls)
+        """
+        chat_tokens = self._local_tokens()
+        context_tokens = chat_tokens
+        if self.messages:
+            # the context shares its message dicts with the chat, so the running total covers most of it.
+            # only what's just in the request gets counted: the system prompt and the message the end prompt went into.
+            # pinned messages and the message the end prompt replaced are left out of it
+            in_chat = {id(message) for message in self.messages}
+            in_context = {id(message) for message in context}
+            context_tokens -= sum(count for message, count in zip(self.messages, self._token_counts) if id(message) not in in_context)
+            extra = [message for message in context if id(message) not in in_chat]
+        else:
+            extra = context
+        if extra:
+            context_tokens += sum(self._count_messages(extra, self._encoding()))
+
+        return (self.messages, self.channel.manager.API._model, context_tokens, chat_tokens)
+
+    async def record_usage(self, basis: tuple, prompt_tokens: int):
+        """
+        called with the prompt_tokens the API reported for a request, and the usage_basis() of that request.
+        calibrates the local token count of the model, and remembers the real size of the prompt,
+        so trim() can work with it instead of an estimate
+        """
+        if not prompt_tokens or not basis:
+            return False
+
+        messages, model, context_tokens, chat_tokens = basis
+        if not context_tokens:
+            return False
+
+        # the tool schemas are part of prompt_tokens too. left out, their fixed size would end up in the
+        # per token factor, and short chats would be corrected by far too much
+        await core.tokenizer.calibrate(model, context_tokens + self._tools_tokens() + 2, prompt_tokens)
+        # the chat count of the request itself, what was added since is counted on top of prompt_tokens
+        self._usage = (messages, model, prompt_tokens, chat_tokens)
+        return True
+
+    async def context_tokens(self) -> int:
+        """size of the full prompt of the current chat: system prompt, tools, messages and end prompt"""
+        if not self.messages:
+            return 0
+        return int(self._context_tokens(self._local_tokens()))
+
+    def _context_tokens(self, local_tokens: int) -> float:
+        """
+        the prompt_tokens of the last request, plus the corrected local count of what was added
+        or removed since. before the API reported anything, the corrected local count of the messages and tool schemas
+        """
+        model = self.channel.manager.API._model
+        factor = core.tokenizer.correction(model)
+        messages, usage_model, prompt_tokens, usage_local = self._usage
+        if messages is not self.messages or usage_model != model:
+            return (local_tokens + self._tools_tokens()) * factor + 2
+
+        return max(0, prompt_tokens + (local_tokens - usage_local) * factor)
+
+    def _encoding(self):
+        return core.tokenizer.get(self.channel.manager.API._model)
+
+    def _tools_tokens(self) -> int:
+        """uncorrected local count of the tool schemas sent with every request. only counted again when the tools change"""
+        global _tools_tokens
+        tools = self.channel.manager.tools
+        if not tools or not core.config.settings().model.use_tools:
+            return 0
+
+        encoding = self._encoding()
+        cached_tools, cached_items, encoding_name, num_tokens = _tools_tokens
+        items = tuple(tools)
+        if cached_tools is tools and cached_items == items and encoding_name == encoding.name:
+            return num_tokens
+
+        num_tokens = encoding.count(json.dumps(tools, default=str))
+        _tools_tokens = (tools, items, encoding.name, num_tokens)
+        return num_tokens
+
+    def _message_tokens(self, message: dict, encoding=None) -> int:
+        return self._count_messages([message], encoding)[0]
+
+    def _count_messages(self, messages: list, encoding=None) -> list:
+        """
+        returns the token count of each message. cached messages aren't encoded again,
+        the rest get encoded in one batch, which uses threads for long histories
+        """
+        if encoding is None:
+            encoding = self._encoding()
+
+        counts = []
+        missing = []
+        for message in messages:
+            key = (encoding.name, hashlib.blake2b(msgpack.packb(message, default=str), digest_size=16).digest())
+            num_tokens = _token_cache.get(key)
+            if num_tokens is not None:
+                _token_cache.move_to_end(key)
+            else:
+                missing.append((len(counts), key, [str(value) for value in message.values() if value]))
+            counts.append(num_tokens)
+
+        if missing:
+            texts = [text for _, _, message_texts in missing for text in message_texts]
+            text_counts = iter(encoding.count_batch(texts))
+            for index, key, message_texts in missing:
+                # OpenAI message format overhead is ~4 tokens per message
+                # <im_start>{role/name}\n{content}<im_end>\n
+                num_tokens = 4 + sum(next(text_counts) for _ in message_texts)
+                counts[index] = num_tokens
+                _token_cache[key] = num_tokens
+
+            while len(_token_cache) > TOKEN_CACHE_SIZE:
+                _token_cache.popitem(last=False)
+
+        return counts
+
+    def _recount_tokens(self):
+        """recounts the current chat from the cache. only messages that were never counted get encoded"""
+        messages = self.messages if self.messages is not None else []
+        encoding = self._encoding() if messages else None
+        self._token_counts = self._count_messages(messages, encoding) if messages else []
+        self._token_total = sum(self._token_counts)
+        self._token_source = (self.messages, encoding.name if encoding else None)
+
+    def _sync_token_counts(self):
+        """makes sure the running total belongs to the current chat and model"""
+        messages, encoding_name = self._token_source
+        if (
+            messages is not self.messages
+            or len(self._token_counts) > len(self.messages or ())
+            or (self.messages and encoding_name != self._encoding().name)
+        ):
+            self._recount_tokens()
+        elif self.messages and len(self._token_counts) < len(self.messages):
+            # messages were appended to the list directly, only count those
+            added = self._count_messages(self.messages[len(self._token_counts):], self._encoding())
+            self._token_counts.extend(added)
+            self._token_total += sum(added)
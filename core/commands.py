@@ -67,6 +67,7 @@ class Commands:
 /module                 enable/disable a module by name
 /tools                  list tools available to the AI
 /status                 show status info
+/cost                   show what each module costs per request
 /restart                restarts the server
 /stop                   stops the AI in it's tracks
 /help                   this help
@@ -82,6 +83,31 @@ class Commands:
 
         return "\n\n".join(output)
 
+    def _format_costs(self, rows: list):
+        if not rows:
+            return "no modules loaded"
+
+        max_context = core.config.settings().api.max_context
+        total = sum(row["request_tokens"] for row in rows)
+        lines = [f"== Cost per module ==\nmodules add {total} of {max_context} tokens to every request"]
+        for row in rows:
+            lines.append("")
+            lines.append(f"# {row['module']}: {row['request_tokens']} tokens per request")
+            lines.append(f"system prompt: {row['system_prompt_tokens']} tokens, end prompt: {row['end_prompt_tokens']} tokens, tool schemas: {row['schema_tokens']} tokens")
+            if row["hook_calls"]:
+                uncached = row["hook_calls"] - row["hook_cached"]
+                average = row["hook_ms"] / uncached if uncached else 0
+                lines.append(f"hooks: {row['hook_calls']} calls ({row['hook_cached']} cached), {average:.1f} ms average, {row['hook_max_ms']:.1f} ms max")
+            if row["tool_calls"]:
+                lines.append(f"tool calls: {row['tool_calls']}, {row['tool_ms'] / row['tool_calls']:.0f} ms and {row['tool_result_tokens'] // row['tool_calls']} result tokens on average")
+            for name, tool in row["tools"].items():
+                line = f"- {name}: {tool['schema_tokens']} schema tokens"
+                if tool.get("calls"):
+                    line += f", {tool['calls']} calls, {tool['result_tokens'] // tool['calls']} result tokens on average, {tool['max_result_tokens']} max"
+                lines.append(line)
+
+        return "\n".join(lines)
+
     def _check_if_temporary(self, cmd: str):
         # set temporary flag on temporary commands so that they disappear upon the next user message
         if (
@@ -92,7 +118,7 @@ class Commands:
             core.module.command_is_temporary(cmd)
             or
             # just make them all temporary if tool usage is turned off
-            not core.config.get("model").get("use_tools")
+            not core.config.settings().model.use_tools
         ):
             return True
         return False
@@ -170,6 +196,42 @@ class Commands:
                 if status['error']:
                     lines.append(f"Last error: {status['error']}")
 
+                usage = self.channel.manager.API.get_usage()
+                if usage:
+                    lines.append(f"Last prompt: {usage['prompt_tokens']} tokens")
+                    lines.append(f"Token count correction: x{core.tokenizer.correction(status['model'])}")
+
+                prefix = self.channel.manager.API.prefix_stats
+                if prefix:
+                    lines.append("")
+                    lines.append("== Prompt cache ==")
+                    lines.append(f"Last prompt: {prefix['reused_chars']} of {prefix['total_chars']} characters reused, {prefix['invalidated_chars']} invalidated")
+                    if prefix.get("changed_at"):
+                        lines.append(f"First change: {prefix['changed_at']}")
+                    if prefix.get("total_chars_total"):
+                        lines.append(f"Reused overall: {prefix['reused_chars_total'] * 100 // prefix['total_chars_total']}% over {prefix['requests']} requests")
+                    lines.append(f"Prefix hash: {prefix['prefix_hash']}")
+
+                queue = status.get("queue")
+                if queue and queue["waits"]:
+                    lines.append("")
+                    lines.append("== Request queue ==")
+                    lines.append(f"In flight: {queue['in_flight']}, waiting: {queue['waiting']}")
+                    for name, waits in queue["waits"].items():
+                        lines.append(
+                            f"{name}: {waits['requests']} requests, {waits['queued']} queued, "
+                            f"{waits['average_wait_seconds'] * 1000:.0f}ms average wait, {waits['max_wait_seconds'] * 1000:.0f}ms max"
+                            + (f", {waits['timeouts']} timed out" if waits["timeouts"] else "")
+                        )
+
+                costs = [row for row in core.profiler.report(self.channel.manager) if row["request_tokens"]]
+                if costs:
+                    lines.append("")
+                    lines.append("== Cost per request ==")
+                    for row in costs[:5]:
+                        lines.append(f"{row['module']}: {row['request_tokens']} tokens")
+                    lines.append("see /cost for details")
+
                 return "\n".join(lines)
             case "modules":
                 modules_str = "\n".join(core.config.get("modules").get("enabled"))
@@ -220,13 +282,15 @@ class Commands:
                     tool_map_display.append(f"== {module_name} ==\n{tools_display}")
 
                 return "\n\n".join(tool_map_display)
+            case "cost":
+                return self._format_costs(core.profiler.report(self.channel.manager))
             case "restart":
                 #await core.restart(self.channel)
                 await self.channel.manager.restart()
                 return "restarting.."
             case "stop":
-                # just use restart for now until i figure out how to kill the asyncio tasks
-                await self.channel.manager.API.cancel()
+                # only stops this channel's requests. the responses get closed, so the backend stops generating too
+                await self.channel.cancel()
                 return "stopped!"
             case _:
                 # handle module commands by using their decorated methods
@@ -1,17 +1,56 @@
 import os
+import copy
 import yaml
 import core
 import modules
 import channels
 
-config = core.storage.StorageDict("config", "yaml", data_dir="config", autoreload=True)
+# how often (in milliseconds) the config file is checked for outside changes
+RELOAD_INTERVAL = 1000
+
+# the config is written immediately, since users and the webui expect the file to be up to date
+config = core.storage.StorageDict("config", "yaml", data_dir="config", autoreload=True, autoreload_interval=RELOAD_INTERVAL, write_behind=False)
 
 default_config = {
     "api": {
         "url": "http://localhost:5001/v1",
         "key": "KEY_HERE",
         "max_context": 8192,
-        "max_messages": 200
+        "max_messages": 200,
+        # spread requests over several API servers instead of just url. each one is a dict like:
+        # {"url": "http://localhost:5002/v1", "key": "", "weight": 1, "models": [], "max_concurrency": 0}
+        # key defaults to the key above, an empty models list means any model, max_concurrency defaults to queue.max_concurrency
+        "backends": [],
+        "compaction": {
+            # summarize the oldest messages instead of just removing them when a chat gets near its limits
+            "enabled": False,
+            # leave empty to summarize with the main model
+            "model": "",
+            # start compacting at this fraction of max_context / max_messages..
+            "threshold": 0.75,
+            # ..and fold enough old messages into the summary to get back down to this fraction
+            "target": 0.5
+        },
+        "queue": {
+            # requests a backend gets at once, unless its entry in backends sets max_concurrency. 0 means no limit.
+            # more requests wait in a queue, and the ones users wait for go first
+            "max_concurrency": 4,
+            # seconds a request waits for a free backend before it fails. 0 waits forever
+            "timeout": 300
+        },
+        "http": {
+            # one connection pool is shared by every channel and background task
+            "max_connections": 16,
+            "max_keepalive": 8,
+            "keepalive_seconds": 60,
+            "connect_timeout": 5,
+            # local models on CPU can take minutes before the first token
+            "read_timeout": 600,
+            # needs the h2 package
+            "http2": False,
+            # a successful connection check is trusted this long, so reconnecting doesn't always list the models
+            "health_check_seconds": 60
+        }
     },
     "model": {
         "name": "MODEL_HERE",
@@ -22,12 +61,23 @@ default_config = {
         "enabled": ["cli", "webui"],
         "disabled": [],
         "settings": {
+            # stream_window_ms: streamed tokens are batched for this long before they're passed on,
+            # or until a batch holds stream_max_bytes. fewer, bigger updates, at the cost of a little latency
+            "cli": {
+                "stream_window_ms": 0,
+                "stream_max_bytes": 4096
+            },
             "webui": {
                 "host": "localhost",
-                "port": 5000
+                "port": 5000,
+                "stream_window_ms": 30,
+                "stream_max_bytes": 4096
             },
             "discord": {
-                "token": "TOKEN_HERE"
+                "token": "TOKEN_HERE",
+                # discord rate limits message edits, so there's no point in updating more often
+                "stream_window_ms": 1000,
+                "stream_max_bytes": 1900
             }
         }
     },
@@ -40,6 +90,19 @@ default_config = {
                 "sandbox_folder": "~/sandbox"
             }
         }
+    },
+    "storage": {
+        "write_behind": True,
+        "write_window_ms": 250,
+        "fsync": "always",
+        "journal_compact_kb": 1024,
+        "io_threads": 2,
+        "resident_chats": 8
+    },
+    "tokenizer": {
+        "dir": "data/tokenizers",
+        "threads": 4,
+        "models": {}
     }
 }
 
@@ -98,20 +161,186 @@ for module in modules.get_all(respect_config=False):
         default_config["modules"]["disabled"].append(module_name)
 
 if not config:
-    config.load(default_config)
+    # copy, so changing the config never changes the defaults (settings are typed after them)
+    config.load(copy.deepcopy(default_config))
     config.save()
     print()
     print(f"A new configuration file has been created. You can use the WebUI to easily change your settings, or manually edit it at {config.path}.")
 else:
     user_config = dict(config)
-    synced_config = sync_config(user_config, default_config)
+    synced_config = sync_config(user_config, copy.deepcopy(default_config))
     if synced_config != user_config:
         config.clear()
         config.update(synced_config)
         config.save()
         core.log("core", "Your configuration file was updated with new settings")
 
+class SettingsError(KeyError):
+    """raised when a setting doesn't exist. the message contains the full dotted path"""
+
+    def __str__(self):
+        return str(self.args[0]) if self.args else ""
+
+_MISSING = object()
+
+class SettingsNode:
+    """frozen, read-only branch of the settings tree. access values using attributes, [] or dotted paths"""
+    __slots__ = ("_path", "_values")
+
+    def __init__(self, path: str, values: dict):
+        object.__setattr__(self, "_path", path)
+        object.__setattr__(self, "_values", values)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"settings are read-only, tried to set {self._full_path(name)}. use core.config.config to change them")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"settings are read-only, tried to delete {self._full_path(name)}")
+
+    def _full_path(self, key: str):
+        return f"{self._path}.{key}" if self._path else key
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            raise SettingsError(f"setting {self._full_path(key)} does not exist") from None
+
+    def get(self, path: str, default=_MISSING):
+        """
+        resolves a dotted path like "channels.settings.webui.port".
+        raises SettingsError naming the full path if it doesn't exist, unless a default is given
+        """
+        node = self
+        for key in path.split("."):
+            if not isinstance(node, SettingsNode) or key not in node._values:
+                if default is not _MISSING:
+                    return default
+                raise SettingsError(f"setting {self._full_path(path)} does not exist")
+            node = node._values[key]
+        return node
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def keys(self):
+        return self._values.keys()
+
+    def items(self):
+        return self._values.items()
+
+    def to_dict(self):
+        """converts back into plain (mutable) dicts and lists"""
+        return _thaw(self)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self._path or 'root'}: {', '.join(self._values)}>"
+
+class Settings(SettingsNode):
+    """root of the settings tree. compiled once per config generation, see settings()"""
+    __slots__ = ("generation",)
+
+    def __init__(self, values: dict, generation: int):
+        super().__init__("", values)
+        object.__setattr__(self, "generation", generation)
+
+    def is_stale(self):
+        """true if the config changed since this snapshot was compiled"""
+        return self.generation != generation()
+
+def _coerce(value, default):
+    """casts a user value to the type of its default value, if possible"""
+    if default is None or value is None or isinstance(value, type(default)):
+        return value
+
+    try:
+        if isinstance(default, bool):
+            if isinstance(value, str):
+                return value.strip().lower() in ("true", "yes", "on", "1")
+            return bool(value)
+        if isinstance(default, int):
+            return int(value)
+        if isinstance(default, float):
+            return float(value)
+        if isinstance(default, str) and isinstance(value, (int, float)):
+            return str(value)
+    except (TypeError, ValueError):
+        pass
+
+    return value
+
+def _freeze(value, default, path: str):
+    """recursively turns dicts into SettingsNodes and lists into tuples"""
+    if isinstance(value, dict):
+        defaults = default if isinstance(default, dict) else {}
+        values = {}
+        # keep the order of the defaults, then anything the user added themselves
+        for key in list(defaults.keys()) + [key for key in value.keys() if key not in defaults]:
+            child_path = f"{path}.{key}" if path else str(key)
+            values[key] = _freeze(value.get(key, defaults.get(key)), defaults.get(key), child_path)
+        return SettingsNode(path, values)
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item, None, path) for item in value)
+
+    return _coerce(value, default)
+
+def _thaw(value):
+    if isinstance(value, SettingsNode):
+        return {key: _thaw(child) for key, child in value.items()}
+    if isinstance(value, tuple):
+        return [_thaw(item) for item in value]
+    return value
+
+_settings = None
+
+def settings() -> Settings:
+    """
+    returns a frozen snapshot of the config, typed after default_config.
+    only gets recompiled when the config changed, so it's cheap to call in hot paths.
+    """
+    global _settings
+
+    config.reload()
+    if _settings is None or _settings.generation != config.generation:
+        node = _freeze(dict(config), default_config, "")
+        _settings = Settings(node._values, config.generation)
+
+    return _settings
+
+def _apply_storage_settings(*args):
+    storage_settings = settings().storage
+    core.storage.configure(
+        write_behind=storage_settings.write_behind,
+        write_window_ms=storage_settings.write_window_ms,
+        fsync=storage_settings.fsync,
+        journal_compact_kb=storage_settings.journal_compact_kb,
+        io_threads=storage_settings.io_threads
+    )
+
+_apply_storage_settings()
+config.subscribe(_apply_storage_settings)
+
 def get(*args, **kwargs):
     """shorthand for accessing config values"""
 
     return config.get(*args, **kwargs)
+
+def generation():
+    """returns a number that increases every time the config changes. cheap to compare against"""
+    config.reload()
+    return config.generation
+
+def subscribe(callback):
+    """calls callback(config) whenever the config changes, either on disk or through config.save()"""
+    return config.subscribe(callback)
@@ -1,5 +1,4 @@
 import core
-import copy
 
 class Context:
     def __init__(self, channel):
@@ -32,8 +31,21 @@ class Context:
         # insert message history
         messages_orig = await self.chat.get()
         if messages_orig:
-            # deepcopy so we dont end up modifying the original messages array
-            messages = copy.deepcopy(messages_orig)
+            # the message dicts are shared with the chat, not copied. they're never modified here:
+            # the one message that gets changed (for the end prompt) is replaced by a copy of itself
+            messages = list(messages_orig)
+
+            # pinned messages at the start (the summary of compacted history) go right below the system prompt,
+            # merged into it so the turn order stays intact
+            pinned = []
+            while messages and messages[0].get("pinned"):
+                pinned.append(str(messages.pop(0).get("content")))
+            if pinned:
+                if context:
+                    context[0]["content"] += "\n\n" + "\n\n".join(pinned)
+                else:
+                    context.append({"role": "system", "content": "\n\n".join(pinned)})
+
             context.extend(messages)
 
         """
@@ -54,7 +66,7 @@ class Context:
 
                 # or, if we're in the very first message of a chat, we put it in the system prompt instead, just at the beginning, so that it has the information right at the start
                 if len(context) == 1:
-                    context[0]["content"] += f"\n\n{histend}"
+                    context[0] = {**context[0], "content": f"{context[0].get('content')}\n\n{histend}"}
                 else:
                     # otherwise we search for the last user message and merge the endprompt into it
                     for i in range(len(context) - 1, -1, -1):
@@ -62,28 +74,28 @@ class Context:
                         # saves a ton of time
 
                         if context[i].get("role") == "user":
-                            # found it, use it immediately
-                            context[i]["content"] += f"\n\n[SYSTEM INFO]:\n{histend}"
+                            # found it, use it immediately. a shallow copy with the end prompt added,
+                            # so the original message (and any frontend channel showing it) stays the same
+                            context[i] = {**context[i], "content": f"{context[i].get('content')}\n\n[SYSTEM INFO]:\n{histend}"}
                             break
 
-                    # since we're working with a deepcopy, this won't be visible to any frontend channels!
-
         return context
 
     async def get_size(self):
-        message_history = await self.get(system_prompt=False)
+        # every part is built and counted once. the total is their sum, instead of counting the whole context again
         sysprompt = await self.channel.manager.get_system_prompt()
         histend = await self.channel.manager.get_end_prompt()
+        messages = await self.chat.get() or []
+
         sysprompt_size_tokens = await self.chat.count_tokens([{"role": "system", "content": sysprompt}])
         sysprompt_size_words = len(str(sysprompt).split())
-        message_hist_size_tokens = await self.chat.count_tokens(await self.chat.get())
-        message_hist_size_words = len(str(message_history).split())
-        histend_size_tokens = await self.chat.count_tokens([{"role": "user", "content": histend}])
+        message_hist_size_tokens = await self.chat.count_tokens(messages)
+        message_hist_size_words = sum(len(str(msg.get("content") or "").split()) for msg in messages)
+        histend_size_tokens = await self.chat.count_tokens([{"role": "user", "content": histend}]) if histend else 0
         histend_size_words = len(str(histend).split())
 
         combined_size_words = message_hist_size_words+sysprompt_size_words+histend_size_words
-
-        token_usage = await self.chat.count_tokens(await self.get(system_prompt=True))
+        token_usage = sysprompt_size_tokens + message_hist_size_tokens + histend_size_tokens
 
         return {
             "system prompt size": f"{sysprompt_size_tokens} tokens | {sysprompt_size_words} words",
@@ -18,6 +18,9 @@ async def restart(channel = None):
         await channel.announce("restarting server..")
     log("core", "restarting server..")
 
+    # execv skips atexit handlers, so write pending data first
+    await core.storage.aflush_all(final=True)
+
     time.sleep(0.1)
     os.execv(sys.argv[0], sys.argv)
 
@@ -4,6 +4,7 @@ import os
 import sys
 import platform
 import datetime
+import time
 import asyncio
 import json
 import json_repair
@@ -26,6 +27,13 @@ class Manager:
 
         self._restart_requested = False
 
+        # module name -> how often its system prompt changed. used for modules that don't declare prompt_volatility
+        self._prompt_stats = {}
+        # (module name, hook) -> cached result of a prompt hook, see core.module.Module.prompt_cache
+        self._hook_cache = {}
+        # the last assembled system and end prompts, with the sections they were made of
+        self._assembled = {}
+
     def _remove_async_task(self, task):
         self._async_tasks.discard(task)
         core.log("task", f"background task completed: {task.get_name()}")
@@ -34,9 +42,13 @@ class Manager:
         """main loop"""
 
         core.log("core", "starting opticlaw..")
+        settings = core.config.settings()
+
+        # load the tokenizer in the background while everything else starts
+        core.tokenizer.warm_up(settings.model.name)
 
         # load channels
-        if not core.config.get("channels").get("enabled"):
+        if not settings.channels.enabled:
             print("ERROR: At least one channel must be enabled in the config! Try the `cli` channel for a basic terminal UI.")
             exit(1)
 
@@ -45,7 +57,7 @@ class Manager:
         for channel in channels.get_all():
             # only load enabled channels
             channel_name_snakecase = core.modules.get_name(channel)
-            if channel_name_snakecase in core.config.get("channels").get("enabled", []):
+            if channel_name_snakecase in settings.channels.enabled:
                 chan = channel(self)
                 self.channels[channel_name_snakecase] = chan
 
@@ -61,13 +73,13 @@ class Manager:
                 self.channel = self.channels[last_channel]
 
         # load modules
-        if core.config.get("modules").get("enabled"):
+        if settings.modules.enabled:
             core.log("core", "loading modules")
             loaded_module_names = []
             for module in modules.get_all():
                 # only load enabled modules
                 module_name_snakecase = core.modules.get_name(module)
-                if module_name_snakecase in core.config.get("modules").get("enabled", []):
+                if module_name_snakecase in settings.modules.enabled:
                     loaded_module = await self.add_module_class(module)
                     # run startup methods
                     if hasattr(loaded_module, "on_ready"):
@@ -90,14 +102,17 @@ class Manager:
         # run everything
         core.log("core", "startup complete")
 
-        if "webui" in core.config.get("channels").get("enabled"):
-            host = core.config.get("channels").get("settings").get("webui").get("host")
-            port = core.config.get("channels").get("settings").get("webui").get("port")
+        if "webui" in settings.channels.enabled:
+            host = settings.get("channels.settings.webui.host")
+            port = settings.get("channels.settings.webui.port")
             print()
             print(f"Please open the WebUI at http://{host}:{port}")
 
         await asyncio.gather(*self._async_tasks, return_exceptions=True)
 
+        # write anything that's still waiting in the write-behind queue
+        await core.storage.aflush_all(final=True)
+
         if self._restart_requested:
             return "restart"
         return None
@@ -109,6 +124,9 @@ class Manager:
 
         self._restart_requested = True
 
+        # make sure pending writes hit the disk before anything shuts down
+        await core.storage.aflush_all(final=True)
+
         # shutdown channels
         for channel_name, channel in self.channels.items():
             if hasattr(channel, "shutdown"):
@@ -167,59 +185,151 @@ class Manager:
         """Get current API connection status for display."""
         return self.API.get_connection_status()
 
+    # order of the system prompt sections, most stable first. see core.module.Module.prompt_volatility
+    PROMPT_VOLATILITY = ("static", "stable", "volatile")
+
     async def get_system_prompt(self):
+        """
+        builds the system prompt from the prompts of all modules.
+
+        servers like llama.cpp and koboldcpp only reprocess a prompt from the first changed token onward,
+        so sections are ordered by how often they change, and volatile ones go to the end prompt instead
+        """
         # Allow generating system prompt even when disconnected
         # (modules may still need to provide context)
-        nonagentic_modules = ("characters", "time")
-        system_prompt = []
-
-        # automatically insert system prompts returned by modules (such as memory)
-        sysprompt_top = []
-        sysprompt_middle = []
-        sysprompt_bottom = []
-        for module_name, module in self.modules.items():
-            if not core.config.get("model").get("use_tools", False) and module_name not in nonagentic_modules:
-                # skip most prompts if tools are turned off
+        chunks = []
+        for position, (module_name, module) in enumerate(self.modules.items()):
+            volatility = self._prompt_volatility(module_name, module)
+            if volatility == "volatile":
                 continue
 
-            module_sysprompt = await module.on_system_prompt()
-
-            if module_sysprompt and (module_name not in core.config.get("modules").get("disabled_prompts", [])):
-                # default to module name
-                sysprompt_header = ' '.join(module_name.split('_')).capitalize()
-                if hasattr(module, "_header") and module._header:
-                    # but allow overriding the header
-                    sysprompt_header = module._header
-                prompt_chunk = f"# {sysprompt_header}\n{str(module_sysprompt).strip()}"
-
+            prompt_chunk = await self._module_system_prompt(module_name, module)
+            if prompt_chunk:
+                # memory and identity used to come first, time and system last. keep that order within each group
                 if module_name in ("memory", "identity"):
-                    sysprompt_top.append(prompt_chunk)
+                    group = 0
                 elif module_name in ("time", "system"):
-                    sysprompt_bottom.append(prompt_chunk)
+                    group = 2
                 else:
-                    sysprompt_middle.append(prompt_chunk)
-
-        system_prompt = sysprompt_top+sysprompt_middle+sysprompt_bottom
+                    group = 1
+                chunks.append((self.PROMPT_VOLATILITY.index(volatility), group, position, module_name, prompt_chunk))
 
-        if system_prompt:
-            return "\n\n".join(system_prompt)
-        else:
-            return ""
+        system_prompt = [chunk[-2:] for chunk in sorted(chunks)]
+        return self._assemble("system", system_prompt)
 
     async def get_end_prompt(self):
         # automatically insert system prompts returned by modules (such as memory)
         histend_prompt = []
+        disabled_end_prompts = core.config.settings().get("modules.disabled_end_prompts", ())
         for module_name, module in self.modules.items():
-            module_sysprompt = await module.on_end_prompt()
+            # system prompts that change every turn go here, so they don't invalidate the cached prompt prefix
+            if self._prompt_volatility(module_name, module) == "volatile":
+                prompt_chunk = await self._module_system_prompt(module_name, module)
+                if prompt_chunk:
+                    histend_prompt.append((module_name, prompt_chunk))
+
+            module_sysprompt = await self._call_prompt_hook(module_name, module, "on_end_prompt")
 
-            if module_sysprompt and (module_name not in core.config.get("modules").get("disabled_end_prompts", [])):
+            if module_sysprompt and (module_name not in disabled_end_prompts):
                 prompt_chunk = f"# {' '.join(module_name.split('_')).capitalize()}\n{str(module_sysprompt).strip()}"
-                histend_prompt.append(prompt_chunk)
+                histend_prompt.append((module_name, prompt_chunk))
 
-        if histend_prompt:
-            return "\n\n".join(histend_prompt)
-        else:
-            return ""
+        return self._assemble("end", histend_prompt)
+
+    def _assemble(self, name: str, sections: list) -> str:
+        """
+        joins prompt sections, given as (module name, section). if they're the same as last time,
+        the previous prompt is returned as is
+        """
+        sections = tuple(sections)
+        previous = self._assembled.get(name)
+        if previous and previous[0] == sections:
+            return previous[1]
+
+        prompt = "\n\n".join(section for _, section in sections)
+        self._assembled[name] = (sections, prompt)
+        # what each module adds to the prompt, as it's really sent. see /cost
+        core.profiler.record_prompt(name, sections, self.API._model)
+        return prompt
+
+    async def _call_prompt_hook(self, module_name: str, module, hook: str):
+        """calls a prompt hook of a module, or returns its cached result if its cache policy allows"""
+        policy = (getattr(module, "prompt_cache", None) or {}).get(hook)
+        if policy:
+            key = self._prompt_cache_key(module, policy.get("events", ()))
+            cached = self._hook_cache.get((module_name, hook))
+            if cached is not None and cached["key"] == key:
+                ttl = policy.get("ttl")
+                if not ttl or time.monotonic() - cached["time"] < ttl:
+                    core.profiler.record_hook(module_name, hook, 0, cached=True)
+                    return cached["result"]
+
+        start = time.perf_counter()
+        result = await getattr(module, hook)()
+        core.profiler.record_hook(module_name, hook, time.perf_counter() - start)
+
+        if policy:
+            self._hook_cache[(module_name, hook)] = {"key": key, "time": time.monotonic(), "result": result}
+        return result
+
+    def _prompt_cache_key(self, module, events) -> tuple:
+        """a key that changes when any of these events happened to the module"""
+        key = []
+        if "storage" in events:
+            storages = (core.storage.StorageList, core.storage.StorageDict, core.storage.StorageText, core.storage.StorageCollection)
+            key.append(tuple(core.storage.changes(value) for value in vars(module).values() if isinstance(value, storages)))
+        if "channel" in events:
+            key.append(id(module.channel))
+        if "config" in events:
+            key.append(core.config.settings().generation)
+        return tuple(key)
+
+    def invalidate_prompts(self, module_name: str = None):
+        """drops cached prompt hook results, of one module or all of them"""
+        for cache_key in list(self._hook_cache.keys()):
+            if module_name is None or cache_key[0] == module_name:
+                del self._hook_cache[cache_key]
+
+    async def _module_system_prompt(self, module_name: str, module):
+        """returns the system prompt section of a module, with its header. None if it has nothing to add"""
+        nonagentic_modules = ("characters", "time")
+        settings = core.config.settings()
+
+        if not settings.model.use_tools and module_name not in nonagentic_modules:
+            # skip most prompts if tools are turned off
+            return None
+
+        module_sysprompt = await self._call_prompt_hook(module_name, module, "on_system_prompt")
+        self._track_prompt(module_name, module_sysprompt)
+
+        if not module_sysprompt or module_name in settings.modules.disabled_prompts:
+            return None
+
+        # default to module name
+        sysprompt_header = ' '.join(module_name.split('_')).capitalize()
+        if hasattr(module, "_header") and module._header:
+            # but allow overriding the header
+            sysprompt_header = module._header
+        return f"# {sysprompt_header}\n{str(module_sysprompt).strip()}"
+
+    def _track_prompt(self, module_name: str, prompt):
+        stats = self._prompt_stats.setdefault(module_name, {"prompt": None, "builds": 0, "changes": 0})
+        if stats["builds"] and prompt != stats["prompt"]:
+            stats["changes"] += 1
+        stats["builds"] += 1
+        stats["prompt"] = prompt
+
+    def _prompt_volatility(self, module_name: str, module) -> str:
+        declared = getattr(module, "prompt_volatility", None)
+        if declared in self.PROMPT_VOLATILITY:
+            return declared
+
+        # not declared, so go by how often it actually changed. the prompt is built a few times per turn,
+        # so changing in more than a third of the builds means it changes about every turn
+        stats = self._prompt_stats.get(module_name)
+        if stats and stats["builds"] >= 6 and stats["changes"] * 3 > stats["builds"]:
+            return "volatile"
+        return "stable"
 
     async def get_status(self):
         status_list = []
@@ -238,9 +348,18 @@ class Manager:
             if not api_status["key_configured"]:
                 status_list.append("  Warning: API key not configured")
 
-        status_list.append("API server: " + str(core.config.get("api").get("url", "Not configured")))
-        if "webui" in core.config.get("channels").get("enabled"):
-            status_list.append(f"WebUI: {core.config.get('channels').get('settings').get('webui').get('host')}:{core.config.get('channels').get('settings').get('webui').get('port')}")
+        settings = core.config.settings()
+        backends = api_status.get("backends") or []
+        if len(backends) > 1:
+            status_list.append("API servers:")
+            for backend in backends:
+                state = "up" if backend["healthy"] else f"down ({backend['error']})"
+                limit = f"/{backend['max_concurrency']}" if backend["max_concurrency"] else ""
+                status_list.append(f"  {backend['name']}: {state}, {backend['in_flight']}{limit} in flight, {backend['requests']} requests")
+        else:
+            status_list.append("API server: " + str(settings.api.url or "Not configured"))
+        if "webui" in settings.channels.enabled:
+            status_list.append(f"WebUI: {settings.get('channels.settings.webui.host')}:{settings.get('channels.settings.webui.port')}")
         status_list.append("AI model: " + str(self.API.get_model() or "Not set"))
 
         if self.channel is not None:
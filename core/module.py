@@ -6,6 +6,20 @@ import json
 class Module:
     """Base class for modules/plugins"""
 
+    # how often the output of on_system_prompt() changes:
+    # "static" (never while running), "stable" (now and then, like when a memory is added) or "volatile" (every turn, like countdowns).
+    # stable prompts go after static ones, volatile ones are moved to the end prompt, so they don't invalidate the prompt cache of the server.
+    # None means it's measured while running
+    prompt_volatility = None
+
+    # how the manager caches the output of on_system_prompt() and on_end_prompt(), per hook. a policy is a dict with:
+    # "static": True - called once, the result is kept until restart
+    # "ttl": seconds - called again after that many seconds
+    # "events": ("storage", "channel", "config") - called again when any storage object of the module changes,
+    #   when the module switches to another channel, or when the config changes
+    # ttl and events can be combined. hooks without a policy are called every time
+    prompt_cache = {}
+
     def __init__(self, manager, channel=None):
         self.manager = manager
         self.channel = channel # later set by the channel base class, _set_as_active_channel()
@@ -0,0 +1,134 @@
+"""
+per-module cost accounting. keeps running totals of what every module costs per request:
+the tokens of its sections in the prompts that were actually sent, the latency of its prompt hooks,
+the size of its tool schemas, and the size and latency of its tool results.
+
+recording is cheap (a few additions, tokens are only counted when a text changed), and so is reading,
+since nothing gets recomputed for a report. see /cost
+"""
+
+import core
+import json
+
+# module name -> {"hooks": {hook: stats}, "tools": {tool name: stats}}
+_modules = {}
+# prompt name ("system", "end") -> {module name: (section, model, tokens)}, as last assembled
+_prompts = {}
+# tools list and model the schema sizes were counted for, and the sizes
+_schemas = (None, None, {})
+
+def _module(module_name: str) -> dict:
+    stats = _modules.get(module_name)
+    if stats is None:
+        stats = _modules[module_name] = {"hooks": {}, "tools": {}}
+    return stats
+
+def _count(text, model: str) -> int:
+    """token count of a text, with the tokenizer the chat uses for the model and its correction (see core.tokenizer)"""
+    if not text:
+        return 0
+    return int(core.tokenizer.get(model).count(str(text)) * core.tokenizer.correction(model))
+
+def record_hook(module_name: str, hook: str, seconds: float, cached: bool = False):
+    """records one call of a prompt hook (on_system_prompt, on_end_prompt). cached calls cost no time"""
+    stats = _module(module_name)["hooks"].get(hook)
+    if stats is None:
+        stats = _module(module_name)["hooks"][hook] = {"calls": 0, "cached": 0, "seconds": 0.0, "max_seconds": 0.0}
+
+    stats["calls"] += 1
+    if cached:
+        stats["cached"] += 1
+    else:
+        stats["seconds"] += seconds
+        stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+def record_prompt(prompt_name: str, sections: list, model: str):
+    """
+    records the sections of an assembled prompt, as (module name, section) pairs. this is what gets sent,
+    so disabled prompts and system prompts that were moved to the end prompt are counted where they really are
+    """
+    previous = _prompts.get(prompt_name, {})
+    counted = {}
+    for module_name, section in sections:
+        cached = previous.get(module_name)
+        # only count tokens when a section changed
+        tokens = cached[2] if cached is not None and cached[:2] == (section, model) else _count(section, model)
+        counted[module_name] = (section, model, tokens)
+    _prompts[prompt_name] = counted
+
+def record_tool(module_name: str, tool_name: str, result, seconds: float, model: str):
+    """records one tool call and the size of its result"""
+    stats = _module(module_name)["tools"].get(tool_name)
+    if stats is None:
+        stats = _module(module_name)["tools"][tool_name] = {
+            "calls": 0, "seconds": 0.0, "max_seconds": 0.0, "result_tokens": 0, "max_result_tokens": 0
+        }
+
+    tokens = _count(result, model)
+    stats["calls"] += 1
+    stats["seconds"] += seconds
+    stats["max_seconds"] = max(stats["max_seconds"], seconds)
+    stats["result_tokens"] += tokens
+    stats["max_result_tokens"] = max(stats["max_result_tokens"], tokens)
+
+def schema_tokens(tools: list, module_names, model: str) -> dict:
+    """tokens of the schema of every tool, by module. only counted again when the tools list or the model changed"""
+    global _schemas
+    cached_tools, cached_model, sizes = _schemas
+    if cached_tools is tools and cached_model == model:
+        return sizes
+
+    # tool names are {module}_{method}, and module names can contain underscores themselves
+    module_names = sorted(module_names, key=len, reverse=True)
+    sizes = {}
+    for tool in tools:
+        name = tool.get("function", {}).get("name", "")
+        module_name = next((module for module in module_names if name.startswith(f"{module}_")), name.split("_")[0])
+        sizes.setdefault(module_name, {})[name] = _count(json.dumps(tool), model)
+
+    _schemas = (tools, model, sizes)
+    return sizes
+
+def report(manager) -> list:
+    """
+    cost per module, most expensive first. request_tokens is what the module adds to every request
+    (its prompts and tool schemas). tool calls, their time and result tokens are totals
+    """
+    tools = manager.tools if core.config.settings().model.use_tools else []
+    schemas = schema_tokens(tools, manager.modules.keys(), manager.API._model)
+
+    system_prompt = _prompts.get("system", {})
+    end_prompt = _prompts.get("end", {})
+
+    rows = []
+    for module_name in set(manager.modules.keys()) | set(_modules.keys()) | set(schemas.keys()):
+        stats = _modules.get(module_name, {"hooks": {}, "tools": {}})
+        hooks = stats["hooks"]
+        row = {
+            "module": module_name,
+            "system_prompt_tokens": system_prompt.get(module_name, (None, None, 0))[2],
+            "end_prompt_tokens": end_prompt.get(module_name, (None, None, 0))[2],
+            "schema_tokens": sum(schemas.get(module_name, {}).values()),
+            "hook_calls": sum(hook["calls"] for hook in hooks.values()),
+            "hook_cached": sum(hook["cached"] for hook in hooks.values()),
+            "hook_ms": sum(hook["seconds"] for hook in hooks.values()) * 1000,
+            "hook_max_ms": max((hook["max_seconds"] for hook in hooks.values()), default=0) * 1000,
+            "tool_calls": sum(tool["calls"] for tool in stats["tools"].values()),
+            "tool_ms": sum(tool["seconds"] for tool in stats["tools"].values()) * 1000,
+            "tool_result_tokens": sum(tool["result_tokens"] for tool in stats["tools"].values()),
+            "tools": {
+                name: {**stats["tools"].get(name, {}), "schema_tokens": tokens}
+                for name, tokens in schemas.get(module_name, {}).items()
+            }
+        }
+        row["request_tokens"] = row["system_prompt_tokens"] + row["end_prompt_tokens"] + row["schema_tokens"]
+        rows.append(row)
+
+    rows.sort(key=lambda row: row["request_tokens"], reverse=True)
+    return rows
+
+def reset():
+    global _schemas
+    _modules.clear()
+    _prompts.clear()
+    _schemas = (None, None, {})
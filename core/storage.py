@@ -1,14 +1,433 @@
 import core
 import os
+import copy
+import time
 import json
+import zlib
 import yaml
 import msgpack
+import atexit
+import asyncio
+import sqlite3
+import datetime
+import threading
+import functools
+import itertools
+import types
+import concurrent.futures
+
+# zstd compresses faster and smaller than zlib, but it's an optional dependency
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# write-behind: save() only marks storage objects as dirty, and all dirty objects
+# get written in one go after write_window_ms. see configure()
+_write_behind = {
+    "enabled": False,
+    "window": 0.25,
+    # "always" fsyncs every write, "exit" only when flushing on restart/exit, "never" leaves it to the OS
+    "fsync": "always"
+}
+# journal files get compacted into a snapshot once they grow past this size
+_journal = {
+    "compact_bytes": 1024 * 1024
+}
+# async loads and saves run their disk io and (de)serialization in a small, bounded thread pool
+_io = {
+    "threads": 2
+}
+_io_executor = None
+_dirty = {}
+_dirty_lock = threading.Lock()
+_flush_handle = None
+_flush_tasks = set()
+# storage objects a background flush took out of _dirty, until they're written
+_flushing = {}
+# io jobs submitted to _io_executor that haven't finished
+_io_pending = set()
+
+# last change of every file and collection, from a counter shared by all of them. see changes()
+_changes = {}
+_change_counter = itertools.count(1)
+
+def configure(write_behind: bool = None, write_window_ms: int = None, fsync: str = None, journal_compact_kb: int = None, io_threads: int = None):
+    """changes how storage objects are written to disk"""
+    global _io_executor
+
+    if io_threads is not None and max(1, int(io_threads)) != _io["threads"]:
+        _io["threads"] = max(1, int(io_threads))
+        if _io_executor is not None:
+            # let running jobs finish, new ones go to a pool of the new size
+            _io_executor.shutdown(wait=False)
+            _io_executor = None
+    if journal_compact_kb is not None:
+        _journal["compact_bytes"] = max(1, int(journal_compact_kb)) * 1024
+    if write_behind is not None:
+        _write_behind["enabled"] = bool(write_behind)
+    if write_window_ms is not None:
+        _write_behind["window"] = max(0, int(write_window_ms)) / 1000
+    if fsync is not None:
+        if fsync not in ("always", "exit", "never"):
+            core.log("warning", f"unknown fsync policy {fsync}, using 'always'")
+            fsync = "always"
+        _write_behind["fsync"] = fsync
+
+    if not _write_behind["enabled"]:
+        flush_all()
+
+def _mark_dirty(storage):
+    """queues a storage object to be written at the end of the current write window"""
+    global _flush_handle
+
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # no event loop to schedule the write on (startup, other threads), so just write now
+        return storage.flush()
+
+    with _dirty_lock:
+        _dirty[id(storage)] = storage
+        if _flush_handle is None:
+            _flush_handle = loop.call_later(_write_behind["window"], _start_flush)
+
+    return True
+
+def _discard(storage):
+    """drops a pending write-behind write of a storage object. returns whether there was one"""
+    with _dirty_lock:
+        return _dirty.pop(id(storage), None) is not None
+
+def _start_flush():
+    """end of the write window. writes everything in the background, without blocking the event loop"""
+    task = asyncio.create_task(aflush_all())
+    _flush_tasks.add(task)
+    task.add_done_callback(_flush_tasks.discard)
+
+async def aflush_all(final: bool = False):
+    """
+    async version of flush_all(). serialization and disk io run in the storage thread pool.
+    final=True also waits for background flushes and io jobs that are still running
+    """
+    global _flush_handle
+
+    token = object()
+    with _dirty_lock:
+        pending = list(_dirty.values())
+        _dirty.clear()
+        # out of _dirty but not written yet, flush_all(final=True) has to know about them
+        _flushing[token] = pending
+        handle = _flush_handle
+        _flush_handle = None
+
+    if handle is not None:
+        handle.cancel()
+
+    fsync = _write_behind["fsync"] == "always" or (final and _write_behind["fsync"] == "exit")
+    try:
+        results = await asyncio.gather(*(storage.aflush(fsync=fsync) for storage in pending), return_exceptions=True)
+    finally:
+        with _dirty_lock:
+            _flushing.pop(token, None)
+    for storage, result in zip(pending, results):
+        if isinstance(result, Exception):
+            core.log_error(f"error writing {storage.name}", result)
+
+    if final:
+        current = asyncio.current_task()
+        await asyncio.gather(*(task for task in list(_flush_tasks) if task is not current), return_exceptions=True)
+        await asyncio.gather(*(asyncio.wrap_future(future) for future in list(_io_pending)), return_exceptions=True)
+
+    return len(pending)
+
+def flush_all(final: bool = False):
+    """
+    writes all dirty storage objects to disk. final=True is used on restart/exit: it also writes what background
+    flushes took but haven't written yet, and waits for io jobs that are still running
+    """
+    global _flush_handle
+
+    with _dirty_lock:
+        pending = dict(_dirty)
+        _dirty.clear()
+        if final:
+            for batch in _flushing.values():
+                for storage in batch:
+                    pending.setdefault(id(storage), storage)
+        handle = _flush_handle
+        _flush_handle = None
+
+    if handle is not None:
+        handle.cancel()
+
+    fsync = _write_behind["fsync"] == "always" or (final and _write_behind["fsync"] == "exit")
+    for storage in pending.values():
+        storage.flush(fsync=fsync)
+
+    if final:
+        # older writes still running in the pool can't overwrite these, see _write_job()
+        concurrent.futures.wait(list(_io_pending))
+
+    return len(pending)
+
+atexit.register(flush_all, True)
+
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+def _compress(data: bytes) -> bytes:
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return zlib.compress(data, 1)
+
+def _decompress(data: bytes) -> bytes:
+    """the frame header tells which compressor was used, so files stay readable when zstandard gets (un)installed"""
+    if data[:4] == _ZSTD_MAGIC:
+        if zstandard is None:
+            raise RuntimeError("file is zstd compressed, install the zstandard package to read it")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+async def _run_io(func, *args):
+    """runs blocking storage work in the storage thread pool"""
+    global _io_executor
+
+    if _io_executor is None:
+        _io_executor = concurrent.futures.ThreadPoolExecutor(max_workers=_io["threads"], thread_name_prefix="storage")
+
+    future = _io_executor.submit(functools.partial(func, *args))
+    _io_pending.add(future)
+    future.add_done_callback(_io_pending.discard)
+    return await asyncio.wrap_future(future)
+
+def _snapshot(data, copy_data: bool = True):
+    """
+    returns a function that gives back a copy of data as it is right now, so that a worker thread
+    can serialize it while the original keeps changing. packing with msgpack is a lot faster than
+    copy.deepcopy, and the unpacking happens in the worker
+    """
+    if not copy_data:
+        return lambda: data
+
+    try:
+        packed = msgpack.packb(data)
+        return lambda: msgpack.unpackb(packed, strict_map_key=False)
+    except Exception:
+        copied = copy.deepcopy(data)
+        return lambda: copied
+
+def _write_job(storage, job):
+    """wraps a prepared write so that an older snapshot can never overwrite a newer one"""
+    storage._io_seq += 1
+    seq = storage._io_seq
+
+    def run():
+        with storage._io_lock:
+            if seq < storage._io_written:
+                return True
+            storage._io_written = seq
+            return job()
+
+    return run
+
+def _atomic_write(path: str, content, binary: bool = False, fsync: bool = None):
+    """writes to a temporary file first and then swaps it in, so a crash never leaves a half-written file"""
+    if fsync is None:
+        fsync = _write_behind["fsync"] == "always"
+
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb" if binary else "w") as f:
+        f.write(content)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def _journal_record(*op):
+    """encodes a journal operation as a length-prefixed msgpack record"""
+    packed = msgpack.packb(list(op))
+    return len(packed).to_bytes(4, "big") + packed
+
+def _replay_journal_records(data: bytes):
+    """rebuilds a list from journal records. returns (items, valid_size, snapshot_size)"""
+    items = []
+    valid_size = 0
+    snapshot_size = 0
+    for op, end in _journal_records(data):
+        if op[0] == "snapshot":
+            snapshot_size = end
+        items = _apply_journal_op(items, op)
+        valid_size = end
+
+    return items, valid_size, snapshot_size
+
+def _apply_journal_op(items: list, op) -> list:
+    """applies one journal operation to a plain list. returns the list, which is a new one for snapshot and clear"""
+    match op[0]:
+        case "snapshot":
+            items = list(op[1])
+        case "append":
+            items.append(op[1])
+        case "extend":
+            items.extend(op[1])
+        case "insert":
+            items.insert(op[1], op[2])
+        case "pop":
+            items.pop(op[1])
+        case "set":
+            items[op[1]] = op[2]
+        case "clear":
+            items = []
+    return items
+
+def _journal_records(data: bytes):
+    """
+    decodes journal records. yields (op, end_offset) tuples.
+    stops at the first incomplete record, which is what a crash in the middle of a write leaves behind
+    """
+    offset = 0
+    while offset + 4 <= len(data):
+        length = int.from_bytes(data[offset:offset+4], "big")
+        end = offset + 4 + length
+        if end > len(data):
+            break
+        try:
+            op = msgpack.unpackb(data[offset+4:end])
+        except Exception:
+            break
+        yield op, end
+        offset = end
+
+class Snapshot:
+    """
+    read-only view of a storage object as it was when it was last saved or loaded.
+    safe to read from any thread without locks or the event loop: saving publishes a new
+    Snapshot instead of changing this one.
+
+    the data is kept msgpack-packed and only decoded when it's first read. lists become
+    tuples and dicts become read-only mappings, so one reader can't change what another sees.
+    copy() returns a private, mutable copy
+    """
+    __slots__ = ("version", "_packed", "_data")
+
+    def __init__(self, version: int, packed: bytes):
+        self.version = version
+        self._packed = packed
+        self._data = _MISSING
+
+    @classmethod
+    def of(cls, data, version: int = 0):
+        return cls(version, msgpack.packb(data))
+
+    @property
+    def data(self):
+        # two threads decoding at the same time both get an equal result, so no lock is needed
+        if self._data is _MISSING:
+            self._data = msgpack.unpackb(self._packed, use_list=False, object_hook=types.MappingProxyType, strict_map_key=False)
+        return self._data
+
+    def copy(self):
+        return msgpack.unpackb(self._packed, strict_map_key=False)
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+def thaw(value):
+    """turns data read from a Snapshot back into plain lists and dicts, e.g. to serialize it"""
+    if isinstance(value, (dict, types.MappingProxyType)):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [thaw(item) for item in value]
+    return value
+
+def _change_key(storage):
+    if isinstance(storage, StorageCollection):
+        return f"{storage.db.path}#{storage.name}"
+    return storage.path
+
+def _note_change(storage):
+    # next() on an itertools.count is atomic, so this is safe from worker threads
+    _changes[_change_key(storage)] = next(_change_counter)
+
+def changes(storage) -> int:
+    """
+    returns a number that changes whenever the data behind a storage object changes (saved, loaded, written..),
+    through this object or any other one opened on the same file or collection. 0 if it never changed.
+    a cheap way to tell if something built from the data has to be rebuilt
+    """
+    return _changes.get(_change_key(storage), 0)
+
+def _publish(storage, data):
+    """publishes a new Snapshot of a storage object, if it was created with snapshots=True"""
+    # every publish follows a change of the data
+    _note_change(storage)
+
+    if not storage.snapshots:
+        return None
+
+    try:
+        version = storage._snapshot.version + 1 if storage._snapshot is not None else 1
+        storage._snapshot = Snapshot(version, msgpack.packb(data))
+    except Exception as e:
+        core.log("error", f"error creating a snapshot of {storage.name}: {e}")
+
+    return storage._snapshot
 
 class StorageList(list):
-    """subclassed list that handles storage of data. supports a variety of storage formats."""
-    def __init__(self, file_path, type: str, manager=None, data_dir=None, *args):
+    """
+    subclassed list that handles storage of data. supports a variety of storage formats.
+
+    the "journal" type only appends the operations (append, pop, setitem..) that happened since the last save,
+    instead of rewriting the entire file. it gets compacted into a snapshot in the background once it grows too big.
+    changes to nested items aren't tracked, so reassign the item (lst[i] = item) to journal it.
+    save() compares the list with the last save plus the tracked operations, and if anything else
+    changed (like lst[0]["a"] = 2), the whole list gets written as a snapshot instead.
+
+    the "compressed" type is msgpack, compressed with zstd (if the zstandard package is installed) or zlib.
+    the most compact format, meant for big lists that are rewritten as a whole, like chat histories.
+
+    journal and compressed files automatically import an existing msgpack/json file with the same name.
+
+    with snapshots=True, every save and load also publishes an immutable Snapshot (see snapshot()),
+    for readers in other threads
+    """
+    def __init__(self, file_path, type: str, manager=None, data_dir=None, write_behind=None, snapshots=False, *args):
         super().__init__(*args)
 
+        self.snapshots = snapshots
+        self._snapshot = None
+
+        self._journaling = False
+        self._journal_ops = []
+        self._journal_ops_saved = 0
+        self._journal_full = False
+        # msgpack of the list as of the last save or load, to find changes the operations don't account for
+        self._journal_packed = None
+        self._journal_size = 0
+        self._journal_snapshot_size = 0
+        self._journal_lock = threading.Lock()
+        self._compacting = False
+        self._compaction_id = 0
+
+        self._io_lock = threading.Lock()
+        self._io_seq = 0
+        self._io_written = 0
+
+        # None follows the global setting (see configure()), False always writes immediately
+        self.write_behind = write_behind
+
         if not data_dir:
             data_dir = "data"
 
@@ -16,7 +435,7 @@ class StorageList(list):
         data_dir = core.get_path(data_dir)
 
         if not os.path.exists(data_dir):
-            os.mkdir(data_dir)
+            os.makedirs(data_dir, exist_ok=True)
 
         self.path = core.get_path(os.path.join(data_dir, file_path))
         self.name = os.path.basename(self.path)
@@ -39,6 +458,12 @@ class StorageList(list):
             case "msgpack":
                 file_ext = "mp"
                 self.binary = True
+            case "journal":
+                file_ext = "jrn"
+                self.binary = True
+            case "compressed":
+                file_ext = "mpz"
+                self.binary = True
 
         self.type = file_type
         self.ext = file_ext
@@ -50,14 +475,248 @@ class StorageList(list):
 
         if os.path.exists(self.path):
             self.load()
+        elif file_type in ("journal", "compressed") and self._migrate_legacy():
+            pass
         else:
             self.save()
 
-    def _write(self, content):
+        self._journaling = (file_type == "journal")
+        self._journal_remember()
+        _publish(self, list(self))
+
+    @classmethod
+    async def aopen(cls, *args, **kwargs):
+        """creates and loads a StorageList in a worker thread, so opening a big file doesn't block the event loop"""
+        return await _run_io(functools.partial(cls, *args, **kwargs))
+
+    def _migrate_legacy(self):
+        """
+        imports an existing msgpack or json file with the same name into a new journal or compressed file.
+        the old file gets renamed to *.migrated afterwards
+        """
+        base_path = self.path[:-len(f".{self.ext}")]
+        for ext, loader, mode in (("mp", msgpack.unpackb, "rb"), ("json", json.loads, "r")):
+            legacy_path = f"{base_path}.{ext}"
+            if not os.path.exists(legacy_path):
+                continue
+
+            try:
+                with open(legacy_path, mode) as f:
+                    list.extend(self, loader(f.read()))
+            except Exception as e:
+                core.log("error", f"error migrating {legacy_path} to {self.type}: {e}")
+                return False
+
+            if self.type == "journal":
+                self._compact_journal()
+            elif not self.flush():
+                return False
+
+            os.replace(legacy_path, f"{legacy_path}.migrated")
+            core.log("storage", f"migrated {os.path.basename(legacy_path)} to {self.name}")
+            return True
+
+        return False
+
+    # --- journal tracking ---
+    def _journal_op(self, *op):
+        if self._journaling:
+            self._journal_ops.append(op)
+
+    def _journal_reset(self):
+        """an untracked change happened, so the next save has to write a full snapshot"""
+        if self._journaling:
+            self._journal_full = True
+
+    def append(self, item):
+        super().append(item)
+        self._journal_op("append", item)
+
+    def extend(self, items):
+        items = list(items)
+        super().extend(items)
+        self._journal_op("extend", items)
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def insert(self, index, item):
+        super().insert(index, item)
+        self._journal_op("insert", index, item)
+
+    def pop(self, index=-1):
+        if index is None:
+            index = -1
+        if index < 0:
+            index += len(self)
+        item = super().pop(index)
+        self._journal_op("pop", index)
+        return item
+
+    def clear(self):
+        super().clear()
+        self._journal_op("clear")
+
+    def __setitem__(self, index, item):
+        super().__setitem__(index, item)
+        if isinstance(index, int):
+            self._journal_op("set", index if index >= 0 else index + len(self), item)
+        else:
+            self._journal_reset()
+
+    def __delitem__(self, index):
+        if isinstance(index, int):
+            self.pop(index)
+        else:
+            super().__delitem__(index)
+            self._journal_reset()
+
+    def remove(self, item):
+        super().remove(item)
+        self._journal_reset()
+
+    def __deepcopy__(self, memo):
+        # copies are plain lists. the file, locks and pending writes belong to this object only
+        return copy.deepcopy(list(self), memo)
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self._journal_reset()
+
+    def reverse(self):
+        super().reverse()
+        self._journal_reset()
+
+    def _flush_journal(self, fsync=None):
+        """appends pending operations to the journal, or writes a snapshot if needed"""
+        if fsync is None:
+            fsync = _write_behind["fsync"] == "always"
+
+        if self._journal_full or not os.path.exists(self.path):
+            return self._compact_journal(fsync=fsync)
+
+        if not self._journal_ops:
+            return True
+
+        try:
+            records = b"".join(_journal_record(*op) for op in self._journal_ops)
+        except Exception as e:
+            core.log("error", f"error encoding {self.name}: {e}")
+            return self._compact_journal(fsync=fsync)
+
+        self._journal_ops = []
+        self._journal_ops_saved = 0
+
+        try:
+            with self._journal_lock:
+                with open(self.path, "ab") as f:
+                    f.write(records)
+                    if fsync:
+                        f.flush()
+                        os.fsync(f.fileno())
+                self._journal_size += len(records)
+        except Exception as e:
+            core.log("error", f"error writing {self.name}: {e}")
+            return False
+
+        # compact once the journal has grown well past the data it describes
+        if self._journal_size > max(_journal["compact_bytes"], self._journal_snapshot_size * 2):
+            self._compact_journal(background=True)
+
+        return True
+
+    def _compact_journal(self, fsync=None, background=False):
+        """replaces the journal with a single snapshot record"""
+        if fsync is None:
+            fsync = _write_behind["fsync"] == "always"
+
+        if background and self._compacting:
+            return True
+
+        if background:
+            self._compacting = True
+            threading.Thread(
+                target=self._prepare_compaction(fsync),
+                name=f"compact {self.name}",
+                daemon=True
+            ).start()
+            return True
+
+        # encode on the calling thread, so the list can't change while it's being serialized
+        snapshot = _journal_record("snapshot", list(self))
+        self._journal_ops = []
+        self._journal_ops_saved = 0
+        self._journal_full = False
+
+        # a newer compaction makes any one still running in the background obsolete
+        self._compaction_id += 1
+
+        with self._journal_lock:
+            try:
+                _atomic_write(self.path, snapshot, binary=True, fsync=fsync)
+            except Exception as e:
+                core.log("error", f"error writing {self.name}: {e}")
+                return False
+            self._journal_size = self._journal_snapshot_size = len(snapshot)
+        return True
+
+    def _prepare_compaction(self, fsync: bool):
+        """
+        encodes a snapshot of the list right now, and returns a function that writes it.
+        that function can run in another thread, records appended in the meantime are carried over
+        """
+        # encode on the calling thread, so the list can't change while it's being serialized
+        snapshot = _journal_record("snapshot", list(self))
+        self._journal_ops = []
+        self._journal_ops_saved = 0
+        self._journal_full = False
+
+        # a newer compaction makes any one still running in the background obsolete
+        self._compaction_id += 1
+
+        with self._journal_lock:
+            offset = self._journal_size if os.path.exists(self.path) else None
+
+        return functools.partial(self._write_compacted_journal, snapshot, offset, fsync, self._compaction_id)
+
+    def _write_compacted_journal(self, snapshot: bytes, offset, fsync: bool, compaction_id: int):
+        """the write of a compaction. records appended while this runs are carried over. offset None means there was no file"""
+        tmp_path = f"{self.path}.{compaction_id}.compact"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(snapshot)
+
+            with self._journal_lock:
+                if compaction_id != self._compaction_id:
+                    os.remove(tmp_path)
+                    return True
+
+                tail = b""
+                if offset is not None and os.path.exists(self.path):
+                    with open(self.path, "rb") as f:
+                        f.seek(offset)
+                        tail = f.read()
+                with open(tmp_path, "ab") as f:
+                    f.write(tail)
+                    if fsync:
+                        f.flush()
+                        os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+                self._journal_size = len(snapshot) + len(tail)
+                self._journal_snapshot_size = len(snapshot)
+            return True
+        except Exception as e:
+            core.log("error", f"error compacting {self.name}: {e}")
+            # the next save tries again
+            self._journal_full = True
+            return False
+        finally:
+            self._compacting = False
+
+    def _write(self, content, fsync=None):
         try:
-            write_mode = "wb" if self.binary else "w"
-            with open(self.path, write_mode) as f:
-                f.write(content)
+            _atomic_write(self.path, content, self.binary, fsync)
         except Exception as e:
             core.log("error", f"error writing {self.name}: {e}")
             return False
@@ -74,41 +733,193 @@ class StorageList(list):
             core.log("error", f"error reading {self.name}: {e}")
             return False
 
+    def _journal_remember(self):
+        """remembers the list as it is now, see _track_journal_save()"""
+        if not self._journaling:
+            return
+        try:
+            self._journal_packed = msgpack.packb(list(self))
+        except Exception:
+            self._journal_packed = None
+
+    def _track_journal_save(self):
+        if not self._journaling:
+            return
+
+        if len(self._journal_ops) == self._journal_ops_saved:
+            # saved without any tracked changes, so something nested was modified
+            self._journal_full = True
+        elif not self._journal_full:
+            # tracked changes, but something nested might have been modified as well.
+            # the last save plus the operations since has to give the list as it is now
+            try:
+                expected = msgpack.unpackb(self._journal_packed, strict_map_key=False)
+                for op in self._journal_ops[self._journal_ops_saved:]:
+                    expected = _apply_journal_op(expected, op)
+                if msgpack.packb(expected) != msgpack.packb(list(self)):
+                    self._journal_full = True
+            except Exception:
+                self._journal_full = True
+
+        self._journal_ops_saved = len(self._journal_ops)
+        self._journal_remember()
+
+    def snapshot(self):
+        """returns the content as it was at the last save or load. safe to call from any thread"""
+        if not self.snapshots:
+            raise RuntimeError(f"{self.name} was opened without snapshots=True")
+        return self._snapshot
+
     def save(self):
-        """save content to file"""
+        """save content to file. with write-behind enabled, the write is delayed and merged with other saves"""
+        self._track_journal_save()
+        _publish(self, list(self))
 
+        if _write_behind["enabled"] and self.write_behind is not False:
+            return _mark_dirty(self)
+
+        return self.flush()
+
+    async def asave(self):
+        """non-blocking save(). serialization and disk io happen in a worker thread"""
+        self._track_journal_save()
+        _publish(self, list(self))
+
+        if _write_behind["enabled"] and self.write_behind is not False:
+            return _mark_dirty(self)
+
+        return await self.aflush()
+
+    def _prepare_write(self, fsync=None, copy_data=False):
+        """
+        returns a function that serializes and writes the content as it is right now.
+        with copy_data=True it works on a snapshot, so it's safe to run in another thread
+        """
         match self.type:
-            case "json":
-                self._write(json.dumps(self, indent=2))
-            case "yaml":
-                self._write(yaml.dump(self, default_flow_style=False, sort_keys=False))
             case "msgpack":
-                self._write(msgpack.packb(self))
+                # packing already is the snapshot
+                content = msgpack.packb(list(self))
+                return lambda: self._write(content, fsync)
+            case "compressed":
+                content = msgpack.packb(list(self))
+                return lambda: self._write(_compress(content), fsync)
             case "text":
-                if len(self) > 0:
-                    self._write("\n".join(self))
+                if len(self) == 0:
+                    return lambda: True
+                content = "\n".join(self)
+                return lambda: self._write(content, fsync)
 
-    def load(self, data=None):
-        """load content from file or data argument"""
-        self.clear()
+        restore = _snapshot(list(self), copy_data)
+        file_type = self.type
 
-        if data:
-            self.extend(data)
-            return self
+        def write():
+            data = restore()
+            if file_type == "yaml":
+                return self._write(yaml.dump(data, default_flow_style=False, sort_keys=False), fsync)
+            return self._write(json.dumps(data, indent=2), fsync)
+
+        return write
+
+    def flush(self, fsync=None):
+        """write content to file right now"""
+        if self.type == "journal":
+            return self._flush_journal(fsync)
+
+        return _write_job(self, self._prepare_write(fsync))()
 
+    async def aflush(self, fsync=None):
+        """non-blocking flush()"""
+        if self.type == "journal":
+            if fsync is None:
+                fsync = _write_behind["fsync"] == "always"
+            if self._journal_full or not os.path.exists(self.path):
+                # a full snapshot rewrites the whole file, so it goes to the storage thread pool
+                return await _run_io(self._prepare_compaction(fsync))
+            # journal appends are only a few bytes, and have to land in order
+            return self._flush_journal(fsync)
+
+        return await _run_io(_write_job(self, self._prepare_write(fsync, copy_data=True)))
+
+    def _read_parsed(self):
+        """reads and parses the file. safe to run in a worker thread"""
         data = self._read()
         if not data:
             return None
 
         match self.type:
             case "json":
-                self.extend(json.loads(data))
+                return json.loads(data)
             case "yaml":
-                self.extend(yaml.load(data))
+                return yaml.safe_load(data)
             case "msgpack":
-                self.extend(msgpack.unpackb(data))
+                return msgpack.unpackb(data)
+            case "compressed":
+                return msgpack.unpackb(_decompress(data))
             case "text":
-                self.extend(data.split("\n"))
+                return data.split("\n")
+            case "journal":
+                items, valid_size, snapshot_size = _replay_journal_records(data)
+                if valid_size < len(data):
+                    # crashed in the middle of a write. drop the broken tail so new records don't end up after it
+                    core.log("warning", f"{self.name}: ignoring {len(data) - valid_size} bytes of incomplete journal data")
+                    with self._journal_lock:
+                        with open(self.path, "r+b") as f:
+                            f.truncate(valid_size)
+                return (items, valid_size, snapshot_size)
+
+    def _apply_loaded(self, parsed):
+        list.clear(self)
+        self._journal_ops = []
+        self._journal_ops_saved = 0
+
+        if parsed is None:
+            _publish(self, [])
+            return None
+
+        if self.type == "journal":
+            items, self._journal_size, self._journal_snapshot_size = parsed
+            list.extend(self, items)
+        else:
+            list.extend(self, parsed)
+
+        self._journal_remember()
+        _publish(self, list(self))
+        return self
+
+    def load(self, data=None):
+        """load content from file or data argument"""
+        if data:
+            self._apply_loaded(None)
+            list.extend(self, data)
+            self._journal_reset()
+            self._journal_remember()
+            _publish(self, list(self))
+            return self
+
+        return self._apply_loaded(self._read_parsed())
+
+    async def aload(self):
+        """non-blocking load(). reading and parsing happen in a worker thread"""
+        return self._apply_loaded(await _run_io(self._read_parsed))
+
+    async def aclose(self):
+        """
+        writes changes still waiting in the write-behind window, and waits for writes in progress.
+        use it before letting go of a StorageList whose file might get opened again
+        """
+        if _discard(self) or self._io_written < self._io_seq or self._io_lock.locked():
+            return await self.aflush()
+        return True
+
+    def delete(self):
+        """deletes the file. pending and in-flight writes are dropped, so they can't bring it back"""
+        _discard(self)
+        with self._io_lock:
+            self._io_written = float("inf")
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        _note_change(self)
+        return True
 
     def get(self, *args, **kwargs):
         if self.autoreload:
@@ -117,10 +928,34 @@ class StorageList(list):
         return super().get(*args, **kwargs)
 
 class StorageDict(dict):
-    """subclassed dict that handles storage of data. supports a variety of storage formats."""
-    def __init__(self, file_path, type: str, manager=None, data_dir=None, autoreload=False, *args):
+    """
+    subclassed dict that handles storage of data. supports a variety of storage formats.
+
+    with snapshots=True, every save and load also publishes an immutable Snapshot (see snapshot()),
+    for readers in other threads
+    """
+    def __init__(self, file_path, type: str, manager=None, data_dir=None, autoreload=False, autoreload_interval=500, write_behind=None, snapshots=False, *args):
         super().__init__(*args)
 
+        self.snapshots = snapshots
+        self._snapshot = None
+
+        # None follows the global setting (see configure()), False always writes immediately
+        self.write_behind = write_behind
+        self._io_lock = threading.Lock()
+        self._io_seq = 0
+        self._io_written = 0
+
+        # autoreload only re-parses the file when its mtime/size/inode changed,
+        # and only stats the file at most once every autoreload_interval milliseconds
+        self.autoreload_interval = autoreload_interval / 1000
+        self._file_stat = None
+        self._last_stat_check = 0.0
+
+        # bumped every time the in-memory data changes (load or save). subscribers can compare it cheaply
+        self.generation = 0
+        self._subscribers = []
+
         if not data_dir:
             data_dir = "data"
 
@@ -128,9 +963,10 @@ class StorageDict(dict):
         data_dir = core.get_path(data_dir)
 
         if not os.path.exists(data_dir):
-            os.mkdir(data_dir)
+            os.makedirs(data_dir, exist_ok=True)
 
         self.path = core.get_path(os.path.join(data_dir, file_path))
+        self.name = os.path.basename(self.path)
         self.binary = False
         self.autoreload = autoreload
 
@@ -165,11 +1001,9 @@ class StorageDict(dict):
         else:
             self.save()
 
-    def _write(self, content):
+    def _write(self, content, fsync=None):
         try:
-            write_mode = "wb" if self.binary else "w"
-            with open(self.path, write_mode) as f:
-                f.write(content)
+            _atomic_write(self.path, content, self.binary, fsync)
         except Exception as e:
             core.log("error", f"error writing {self.name}: {e}")
             return False
@@ -186,55 +1020,175 @@ class StorageDict(dict):
             core.log("error", f"error reading {self.name}: {e}")
             return False
 
+    def _stat(self):
+        """returns a signature of the file on disk that changes whenever the file does"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def changed_on_disk(self):
+        """checks if the file was modified outside of this object. rate limited by autoreload_interval"""
+        now = time.monotonic()
+        if now - self._last_stat_check < self.autoreload_interval:
+            return False
+        self._last_stat_check = now
+
+        return self._stat() != self._file_stat
+
+    def subscribe(self, callback):
+        """registers a callback(storage) that gets called whenever the data changes"""
+        if callback not in self._subscribers:
+            self._subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def __deepcopy__(self, memo):
+        # copies are plain dicts. the file, locks and pending writes belong to this object only
+        return copy.deepcopy(dict(self), memo)
+
+    def snapshot(self):
+        """returns the content as it was at the last save or load. safe to call from any thread"""
+        if not self.snapshots:
+            raise RuntimeError(f"{self.name} was opened without snapshots=True")
+        return self._snapshot
+
+    def _changed(self):
+        self.generation += 1
+        _publish(self, dict(self))
+        for callback in list(self._subscribers):
+            try:
+                callback(self)
+            except Exception as e:
+                core.log_error(f"error in change callback of {self.name}", e)
+
     def save(self):
-        """save content to file"""
+        """save content to file. with write-behind enabled, the write is delayed and merged with other saves"""
+        self._changed()
+
+        if _write_behind["enabled"] and self.write_behind is not False:
+            return _mark_dirty(self)
+
+        return self.flush()
+
+    async def asave(self):
+        """non-blocking save(). serialization and disk io happen in a worker thread"""
+        self._changed()
 
+        if _write_behind["enabled"] and self.write_behind is not False:
+            return _mark_dirty(self)
+
+        return await self.aflush()
+
+    def _prepare_write(self, fsync=None, copy_data=False):
+        """
+        returns a function that serializes and writes the content as it is right now.
+        with copy_data=True it works on a snapshot, so it's safe to run in another thread
+        """
         match self.type:
-            case "json":
-                self._write(json.dumps(dict(self), indent=2))
-            case "yaml":
-                self._write(yaml.dump(dict(self), default_flow_style=False, sort_keys=False))
             case "msgpack":
-                self._write(msgpack.packb(dict(self)))
+                content = msgpack.packb(dict(self))
+                serialize = lambda: content
             case "text":
-                if len(self) > 0:
-                    self._write("\n".join(dict(self)))
+                content = "\n".join(dict(self)) if len(self) > 0 else None
+                serialize = lambda: content
+            case "yaml":
+                restore = _snapshot(dict(self), copy_data)
+                serialize = lambda: yaml.dump(restore(), default_flow_style=False, sort_keys=False)
+            case _:
+                restore = _snapshot(dict(self), copy_data)
+                serialize = lambda: json.dumps(restore(), indent=2)
 
-    def load(self, data=None):
-        """load content from file or data argument"""
-        self.clear()
+        def write():
+            content = serialize()
+            result = self._write(content, fsync) if content is not None else True
+            # our own write shouldn't trigger a reload
+            self._file_stat = self._stat()
+            return result
 
-        if data:
-            self.update(data)
-            return True
+        return write
+
+    def flush(self, fsync=None):
+        """write content to file right now"""
+        return _write_job(self, self._prepare_write(fsync))()
 
+    async def aflush(self, fsync=None):
+        """non-blocking flush()"""
+        return await _run_io(_write_job(self, self._prepare_write(fsync, copy_data=True)))
+
+    def _read_parsed(self):
+        """reads and parses the file. safe to run in a worker thread. returns (file_stat, parsed)"""
+        file_stat = self._stat()
         data = self._read()
         if not data:
-            return None
+            return file_stat, None
 
         match self.type:
             case "json":
-                self.update(json.loads(data))
+                parsed = json.loads(data)
             case "yaml":
-                self.update(yaml.safe_load(data))
+                parsed = yaml.safe_load(data)
             case "msgpack":
-                self.update(msgpack.unpackb(data))
+                parsed = msgpack.unpackb(data)
             case "text":
-                self.update(data.split("\n"))
+                parsed = data.split("\n")
+
+        return file_stat, parsed
+
+    def _apply_loaded(self, loaded):
+        file_stat, parsed = loaded
+        if parsed is None:
+            self.clear()
+            _publish(self, {})
+            return None
+
+        # parsed before clearing, so other threads never see a half-loaded dict
+        self.clear()
+        self.update(parsed)
+        self._file_stat = file_stat
+        self._changed()
 
         return True
 
+    def load(self, data=None):
+        """load content from file or data argument"""
+        if data:
+            self.clear()
+            self.update(data)
+            self._changed()
+            return True
+
+        return self._apply_loaded(self._read_parsed())
+
+    async def aload(self):
+        """non-blocking load(). reading and parsing happen in a worker thread"""
+        return self._apply_loaded(await _run_io(self._read_parsed))
+
+    def reload(self):
+        """reloads from disk, but only if the file changed since it was last loaded or saved"""
+        if self.changed_on_disk():
+            self.load()
+            return True
+        return False
+
     def get(self, *args, **kwargs):
         if self.autoreload:
-            self.load()
+            self.reload()
 
         return super().get(*args, **kwargs)
 
 class StorageText:
     """simple class that saves its content to a text file"""
-    def __init__(self, file_path, manager=None, data_dir=None, autoreload=False, *args):
+    def __init__(self, file_path, manager=None, data_dir=None, autoreload=False, write_behind=None, *args):
         super().__init__(*args)
 
+        # None follows the global setting (see configure()), False always writes immediately
+        self.write_behind = write_behind
+
         if not data_dir:
             data_dir = "data"
 
@@ -242,12 +1196,16 @@ class StorageText:
         data_dir = core.get_path(data_dir)
 
         if not os.path.exists(data_dir):
-            os.mkdir(data_dir)
+            os.makedirs(data_dir, exist_ok=True)
 
         self._data = ""
         self.autoreload = autoreload
+        self._io_lock = threading.Lock()
+        self._io_seq = 0
+        self._io_written = 0
 
         self.path = core.get_path(os.path.join(data_dir, file_path))
+        self.name = os.path.basename(self.path)
         if os.path.exists(self.path):
             self.load()
         else:
@@ -258,22 +1216,399 @@ class StorageText:
 
     def set(self, new_data: str):
         self._data = str(new_data)
+        _note_change(self)
         self.save()
+    async def aset(self, new_data: str):
+        self._data = str(new_data)
+        _note_change(self)
+        await self.asave()
     def get(self):
         if self.autoreload:
             self.load()
         return str(self._data)
 
-    def load(self):
+    def _read(self):
         try:
             with open(self.path, "r") as f:
-                self._data = f.read()
+                return f.read()
         except Exception as e:
             core.log("error", f"error while loading text storage: {e}")
+            return None
+
+    def load(self):
+        data = self._read()
+        if data is not None and data != self._data:
+            self._data = data
+            _note_change(self)
+        return self
+
+    async def aload(self):
+        """non-blocking load()"""
+        data = await _run_io(self._read)
+        if data is not None and data != self._data:
+            self._data = data
+            _note_change(self)
         return self
 
     def save(self):
-        with open(self.path, "w") as f:
-            f.write(self._data)
+        if _write_behind["enabled"] and self.write_behind is not False:
+            _mark_dirty(self)
+            return self
+
+        self.flush()
+        return self
+
+    async def asave(self):
+        """non-blocking save()"""
+        if _write_behind["enabled"] and self.write_behind is not False:
+            _mark_dirty(self)
+            return self
 
+        await self.aflush()
         return self
+
+    def _prepare_write(self, fsync=None):
+        # strings are immutable, so the current string already is a snapshot
+        content = self._data
+
+        def write():
+            try:
+                _atomic_write(self.path, content, fsync=fsync)
+            except Exception as e:
+                core.log("error", f"error writing {self.name}: {e}")
+                return False
+            return True
+
+        return write
+
+    def flush(self, fsync=None):
+        return _write_job(self, self._prepare_write(fsync))()
+
+    async def aflush(self, fsync=None):
+        """non-blocking flush()"""
+        return await _run_io(_write_job(self, self._prepare_write(fsync)))
+
+# --- sqlite ---
+_databases = {}
+_databases_lock = threading.Lock()
+
+class _Database:
+    """a shared sqlite connection in WAL mode. readers don't block the writer and vice versa"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS items (
+            collection TEXT NOT NULL,
+            id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            updated TEXT NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY (collection, id)
+        );
+        CREATE INDEX IF NOT EXISTS items_position ON items (collection, position);
+        CREATE INDEX IF NOT EXISTS items_updated ON items (collection, updated);
+        CREATE TABLE IF NOT EXISTS item_tags (
+            collection TEXT NOT NULL,
+            id TEXT NOT NULL,
+            tag TEXT NOT NULL,
+            PRIMARY KEY (collection, id, tag)
+        );
+        CREATE INDEX IF NOT EXISTS item_tags_tag ON item_tags (collection, tag);
+        CREATE TABLE IF NOT EXISTS migrations (
+            name TEXT PRIMARY KEY,
+            migrated TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.RLock()
+
+        # the sqlite3 module keeps a cache of prepared statements per connection,
+        # so reusing the same SQL strings skips re-parsing them
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, cached_statements=256)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+
+    def execute(self, sql: str, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def transaction(self):
+        return _Transaction(self)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+class _Transaction:
+    def __init__(self, db: _Database):
+        self.db = db
+
+    def __enter__(self):
+        self.db.lock.acquire()
+        self.db.conn.execute("BEGIN IMMEDIATE")
+        return self.db.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.db.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.db.lock.release()
+        return False
+
+def get_database(name: str = "opticlaw", data_dir=None):
+    """returns the shared connection to data/{name}.db"""
+    data_dir = core.get_path(data_dir or "data")
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir, exist_ok=True)
+
+    path = os.path.join(data_dir, f"{name}.db")
+    with _databases_lock:
+        if path not in _databases:
+            _databases[path] = _Database(path)
+        return _databases[path]
+
+def _close_databases():
+    with _databases_lock:
+        for db in _databases.values():
+            try:
+                db.close()
+            except Exception:
+                pass
+        _databases.clear()
+
+atexit.register(_close_databases)
+
+class StorageCollection:
+    """
+    keyed collection of dicts, stored in an sqlite database (data/opticlaw.db).
+
+    every item is its own row, so reading, adding or changing one item never touches the others.
+    behaves like a dict of {key: item}, in insertion order. changes are written immediately,
+    there's no save(). to change part of an item, use patch() or assign the whole item again.
+    """
+    def __init__(self, name: str, manager=None, database: str = "opticlaw", data_dir=None):
+        self.name = name
+        self.db = get_database(database, data_dir)
+
+        if manager:
+            self.manager = manager
+
+    def _encode(self, item):
+        return msgpack.packb(item)
+
+    def _decode(self, data):
+        return msgpack.unpackb(data)
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM items WHERE collection = ?", (self.name,))[0][0]
+
+    def __bool__(self):
+        return bool(self.db.execute("SELECT 1 FROM items WHERE collection = ? LIMIT 1", (self.name,)))
+
+    def __contains__(self, key):
+        return bool(self.db.execute("SELECT 1 FROM items WHERE collection = ? AND id = ?", (self.name, str(key))))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __getitem__(self, key):
+        rows = self.db.execute("SELECT data FROM items WHERE collection = ? AND id = ?", (self.name, str(key)))
+        if not rows:
+            raise KeyError(key)
+        return self._decode(rows[0][0])
+
+    def __setitem__(self, key, item):
+        self.put(key, item)
+
+    def __delitem__(self, key):
+        if not self.delete(key):
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        rows = self.db.execute("SELECT id FROM items WHERE collection = ? ORDER BY position", (self.name,))
+        return [row[0] for row in rows]
+
+    def values(self):
+        rows = self.db.execute("SELECT data FROM items WHERE collection = ? ORDER BY position", (self.name,))
+        return [self._decode(row[0]) for row in rows]
+
+    def items(self):
+        rows = self.db.execute("SELECT id, data FROM items WHERE collection = ? ORDER BY position", (self.name,))
+        return [(row[0], self._decode(row[1])) for row in rows]
+
+    def recent(self, limit: int = None):
+        """returns items ordered by when they were last changed, newest first"""
+        rows = self.db.execute(
+            "SELECT data FROM items WHERE collection = ? ORDER BY updated DESC LIMIT ?",
+            (self.name, -1 if limit is None else int(limit))
+        )
+        return [self._decode(row[0]) for row in rows]
+
+    def find_tag(self, tag: str):
+        """returns all items that have this exact tag"""
+        rows = self.db.execute(
+            "SELECT items.data FROM item_tags JOIN items ON items.collection = item_tags.collection AND items.id = item_tags.id "
+            "WHERE item_tags.collection = ? AND item_tags.tag = ? ORDER BY items.position",
+            (self.name, str(tag))
+        )
+        return [self._decode(row[0]) for row in rows]
+
+    def put(self, key, item: dict):
+        """adds or replaces an item. replaced items keep their position"""
+        return self._put_encoded(str(key), self._encode(item))
+
+    def _put_encoded(self, key: str, data: bytes):
+        # works from the encoded bytes only, so it's safe to run in a worker thread while the item keeps changing
+        now = datetime.datetime.now().isoformat()
+        with self.db.transaction() as conn:
+            self._put(conn, key, self._decode(data), data, now)
+        _note_change(self)
+        return True
+
+    def _put(self, conn, key: str, item: dict, data: bytes, now: str):
+        conn.execute(
+            "INSERT INTO items (collection, id, position, updated, data) "
+            "VALUES (?, ?, (SELECT COALESCE(MAX(position), 0) + 1 FROM items WHERE collection = ?), ?, ?) "
+            "ON CONFLICT (collection, id) DO UPDATE SET updated = excluded.updated, data = excluded.data",
+            (self.name, key, self.name, now, data)
+        )
+        conn.execute("DELETE FROM item_tags WHERE collection = ? AND id = ?", (self.name, key))
+        tags = item.get("tags") if isinstance(item, dict) else None
+        if tags and isinstance(tags, (list, tuple)):
+            conn.executemany(
+                "INSERT OR IGNORE INTO item_tags (collection, id, tag) VALUES (?, ?, ?)",
+                [(self.name, key, str(tag)) for tag in tags]
+            )
+
+    def patch(self, key, **fields):
+        """changes only the given fields of an item. returns the updated item, or None if it doesn't exist"""
+        key = str(key)
+        with self.db.transaction() as conn:
+            rows = conn.execute("SELECT data FROM items WHERE collection = ? AND id = ?", (self.name, key)).fetchall()
+            if not rows:
+                return None
+            item = self._decode(rows[0][0])
+            item.update(fields)
+            self._put(conn, key, item, self._encode(item), datetime.datetime.now().isoformat())
+        _note_change(self)
+        return item
+
+    def delete(self, key):
+        key = str(key)
+        with self.db.transaction() as conn:
+            deleted = conn.execute("DELETE FROM items WHERE collection = ? AND id = ?", (self.name, key)).rowcount
+            conn.execute("DELETE FROM item_tags WHERE collection = ? AND id = ?", (self.name, key))
+        _note_change(self)
+        return deleted > 0
+
+    def pop(self, key, *default):
+        item = self.get(key, _MISSING)
+        if item is _MISSING:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        self.delete(key)
+        return item
+
+    def clear(self):
+        with self.db.transaction() as conn:
+            conn.execute("DELETE FROM items WHERE collection = ?", (self.name,))
+            conn.execute("DELETE FROM item_tags WHERE collection = ?", (self.name,))
+        _note_change(self)
+        return True
+
+    # --- async variants. these run the query in the storage thread pool, so they never block the event loop ---
+    async def aget(self, key, default=None):
+        return await _run_io(self.get, key, default)
+
+    async def acontains(self, key):
+        return await _run_io(self.__contains__, key)
+
+    async def alen(self):
+        return await _run_io(self.__len__)
+
+    async def akeys(self):
+        return await _run_io(self.keys)
+
+    async def avalues(self):
+        return await _run_io(self.values)
+
+    async def aitems(self):
+        return await _run_io(self.items)
+
+    async def arecent(self, limit: int = None):
+        return await _run_io(self.recent, limit)
+
+    async def afind_tag(self, tag: str):
+        return await _run_io(self.find_tag, tag)
+
+    async def aput(self, key, item: dict):
+        # encoding happens here, so later changes to item don't end up in the database halfway
+        return await _run_io(self._put_encoded, str(key), self._encode(item))
+
+    async def apatch(self, key, **fields):
+        return await _run_io(functools.partial(self.patch, key, **copy.deepcopy(fields)))
+
+    async def adelete(self, key):
+        return await _run_io(self.delete, key)
+
+    async def apop(self, key, *default):
+        return await _run_io(self.pop, key, *default)
+
+    async def aclear(self):
+        return await _run_io(self.clear)
+
+    def migrate(self, file_path: str, types=("json",), key: str = "id", data_dir=None):
+        """
+        one-shot import of an old StorageList/StorageDict file into this collection.
+        lists are keyed by each item's `key` field, dicts by their own keys.
+        the old file gets renamed to *.migrated afterwards, so it's only ever imported once
+        """
+        migration_name = f"{self.name}:{file_path}"
+        if self.db.execute("SELECT 1 FROM migrations WHERE name = ?", (migration_name,)):
+            return False
+
+        base_path = core.get_path(os.path.join(data_dir or "data", file_path))
+        extensions = {"json": "json", "yaml": "yml", "msgpack": "mp", "journal": "jrn"}
+
+        for file_type in types:
+            legacy_path = f"{base_path}.{extensions[file_type]}"
+            if not os.path.exists(legacy_path):
+                continue
+
+            if file_type in ("json", "yaml") and isinstance(self._peek_json(legacy_path, file_type), dict):
+                legacy = StorageDict(file_path, file_type, data_dir=data_dir, write_behind=False)
+                entries = list(legacy.items())
+            else:
+                legacy = StorageList(file_path, file_type, data_dir=data_dir, write_behind=False)
+                entries = [(item.get(key), item) for item in legacy if isinstance(item, dict) and item.get(key) is not None]
+
+            now = datetime.datetime.now().isoformat()
+            with self.db.transaction() as conn:
+                for item_key, item in entries:
+                    self._put(conn, str(item_key), item, self._encode(item), now)
+                conn.execute("INSERT INTO migrations (name, migrated) VALUES (?, ?)", (migration_name, now))
+            _note_change(self)
+
+            os.replace(legacy_path, f"{legacy_path}.migrated")
+            core.log("storage", f"migrated {len(entries)} items from {os.path.basename(legacy_path)} to the {self.name} collection")
+            return True
+
+        return False
+
+    def _peek_json(self, path: str, file_type: str):
+        with open(path, "r") as f:
+            data = f.read()
+        if not data.strip():
+            return None
+        return json.loads(data) if file_type == "json" else yaml.safe_load(data)
+
+_MISSING = object()
+
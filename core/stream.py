@@ -0,0 +1,99 @@
+"""
+helpers for the streaming pipeline between the API and the channels.
+
+a fast backend streams hundreds of tokens per second, and every one of them used to travel on its own
+through the channel and become its own frame. coalesce() batches them into fewer, bigger pieces:
+everything that arrives within a time window, or until a size limit is reached
+"""
+
+import core
+import asyncio
+import json
+
+# token types that can be merged with the next token of the same type. everything else passes through as is
+MERGEABLE = ("content", "reasoning")
+
+async def coalesce(tokens, window_ms: float = 0, max_bytes: int = 4096):
+    """
+    merges consecutive content and reasoning tokens of a token stream. a batch is sent once it's window_ms old,
+    once it holds max_bytes, or when any other kind of token comes along. with window_ms 0 tokens pass straight through
+    """
+    if not window_ms or window_ms <= 0:
+        async for token in tokens:
+            yield token
+        return
+
+    loop = asyncio.get_running_loop()
+    batches = asyncio.Queue()
+    end = object()
+    # [type, parts, size, timer that sends it]
+    batch = None
+
+    def flush():
+        nonlocal batch
+        if batch is not None:
+            batch[3].cancel()
+            batches.put_nowait(_merged(batch))
+            batch = None
+
+    async def pump():
+        """reads the source in a task of its own, so a batch can be sent while waiting for the next token"""
+        nonlocal batch
+        try:
+            async for token in tokens:
+                token_type = token.get("type")
+                content = token.get("content")
+                if token_type not in MERGEABLE or not isinstance(content, str):
+                    flush()
+                    batches.put_nowait(token)
+                    continue
+
+                if batch is not None and batch[0] != token_type:
+                    flush()
+                if batch is None:
+                    batch = [token_type, [], 0, loop.call_later(window_ms / 1000, flush)]
+                batch[1].append(content)
+                # limits like discord's are in bytes, and non-ascii characters take more than one
+                batch[2] += len(content.encode())
+
+                if batch[2] >= max_bytes:
+                    flush()
+            flush()
+            batches.put_nowait(end)
+        except Exception as e:
+            flush()
+            batches.put_nowait(e)
+
+    task = asyncio.create_task(pump())
+    try:
+        while True:
+            item = await batches.get()
+            if item is end:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        if batch is not None:
+            batch[3].cancel()
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        if hasattr(tokens, "aclose"):
+            await tokens.aclose()
+
+def _merged(batch: list) -> dict:
+    return {"type": batch[0], "content": "".join(batch[1])}
+
+def settings_for(channel) -> tuple:
+    """(window_ms, max_bytes) of a channel, from channels.settings.{name} in the config. no batching by default"""
+    settings = core.config.settings()
+    prefix = f"channels.settings.{channel.name}"
+    return (
+        float(settings.get(f"{prefix}.stream_window_ms", 0) or 0),
+        int(settings.get(f"{prefix}.stream_max_bytes", 4096) or 4096)
+    )
+
+def sse_frame(data: dict) -> bytes:
+    """a server-sent events frame, encoded once so it can be written as is"""
+    return b"data: " + json.dumps(data).encode() + b"\n\n"
@@ -0,0 +1,326 @@
+"""
+tokenizer registry. resolves one tokenizer per model and caches it.
+
+looks in the tokenizer folder (tokenizer.dir in the config, data/tokenizers by default) for:
+- huggingface tokenizer.json files, in a subfolder named after the model (needs the tokenizers package).
+  the subfolder with the longest name that appears in the model name wins, so a "qwen2.5" folder
+  matches "Qwen2.5-7B-Instruct-Q4_K_M.gguf"
+- tiktoken BPE files: either {encoding}.tiktoken, or tiktoken's own cache files
+  (the folder doubles as TIKTOKEN_CACHE_DIR). only for openai models, or models mapped to an encoding
+  in tokenizer.models, since other models' tokenizers count very differently
+
+nothing is ever downloaded. if no tokenizer file is found, counts are estimated from the text length.
+tokenizers load in a background thread, and counts are estimated until they're ready, so the event loop never waits on one
+
+local counts never match the server exactly (chat templates, tool schemas, or no tokenizer file at all),
+so every prompt_tokens count the API reports is compared to the local count of the same request.
+that gives a correction factor per model, see calibrate() and correction()
+"""
+
+import core
+import abc
+import os
+import shutil
+import hashlib
+import threading
+import concurrent.futures
+
+# tiktoken looks for its BPE files here before downloading them
+TIKTOKEN_URL = "https://openaipublic.blob.core.windows.net/encodings/{name}.tiktoken"
+
+# below this many texts, batch encoding isn't worth starting threads for
+BATCH_THRESHOLD = 64
+
+# how much a single request moves the correction factor. smooths out odd requests
+CALIBRATION_WEIGHT = 0.3
+# never correct local counts by more than this factor in either direction
+CALIBRATION_LIMIT = 4.0
+
+_tokenizers = {}
+_loading = {}
+_lock = threading.Lock()
+# TIKTOKEN_CACHE_DIR is only set while tiktoken loads an encoding, see _load_tiktoken()
+_env_lock = threading.Lock()
+_calibration = None
+
+class Tokenizer(abc.ABC):
+    """common interface of all tokenizers"""
+    name = "tokenizer"
+
+    @abc.abstractmethod
+    def encode(self, text: str) -> list:
+        """the token IDs of a text"""
+
+    def count(self, text: str) -> int:
+        return len(self.encode(text))
+
+    def encode_batch(self, texts: list, threads: int = None) -> list:
+        """encodes many texts at once. uses multiple threads for big batches"""
+        if threads is None:
+            threads = _threads()
+        if len(texts) < BATCH_THRESHOLD or threads <= 1:
+            return [self.encode(text) for text in texts]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix="tokenizer") as pool:
+            return list(pool.map(self.encode, texts, chunksize=max(1, len(texts) // (threads * 4))))
+
+    def count_batch(self, texts: list, threads: int = None) -> list:
+        return [len(tokens) for tokens in self.encode_batch(texts, threads)]
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.name}>"
+
+class TiktokenTokenizer(Tokenizer):
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.name = f"tiktoken:{encoding.name}"
+
+    def encode(self, text: str) -> list:
+        # special tokens in chat messages are just text to us
+        return self.encoding.encode_ordinary(text)
+
+    def encode_batch(self, texts: list, threads: int = None) -> list:
+        if threads is None:
+            threads = _threads()
+        if len(texts) < BATCH_THRESHOLD:
+            return [self.encode(text) for text in texts]
+        # tiktoken releases the GIL while encoding, so its own thread pool scales well
+        return self.encoding.encode_ordinary_batch(texts, num_threads=max(1, threads))
+
+class HuggingFaceTokenizer(Tokenizer):
+    def __init__(self, tokenizer, name: str):
+        self.tokenizer = tokenizer
+        self.name = f"hf:{name}"
+
+    def encode(self, text: str) -> list:
+        return self.tokenizer.encode(text, add_special_tokens=False).ids
+
+    def encode_batch(self, texts: list, threads: int = None) -> list:
+        # the tokenizers library parallelizes batches by itself
+        return [encoding.ids for encoding in self.tokenizer.encode_batch(texts, add_special_tokens=False)]
+
+class EstimateTokenizer(Tokenizer):
+    """used when there's no tokenizer file for a model. most BPE tokenizers average about 4 characters per token on english text"""
+    name = "estimate"
+    CHARS_PER_TOKEN = 4
+
+    def encode(self, text: str) -> list:
+        return [0] * self.count(text)
+
+    def count(self, text: str) -> int:
+        return -(-len(text) // self.CHARS_PER_TOKEN)
+
+    def count_batch(self, texts: list, threads: int = None) -> list:
+        return [self.count(text) for text in texts]
+
+# what get() returns while the real tokenizer is loading
+_estimate = EstimateTokenizer()
+
+def _threads() -> int:
+    return max(1, int(core.config.settings().get("tokenizer.threads", 4)))
+
+def _options() -> dict:
+    """reads the settings up front, so loading can happen in another thread"""
+    settings = core.config.settings().get("tokenizer")
+    overrides = settings.get("models")
+
+    tokenizer_dir = core.get_path(os.path.expanduser(settings.get("dir", "data/tokenizers")))
+    if not os.path.exists(tokenizer_dir):
+        os.makedirs(tokenizer_dir, exist_ok=True)
+
+    return {
+        "dir": tokenizer_dir,
+        "overrides": overrides.to_dict() if overrides else {}
+    }
+
+def get(model: str, wait: bool = False) -> Tokenizer:
+    """
+    returns the tokenizer for a model. the first call per model starts loading it in the background,
+    and until it's loaded the estimate is returned. wait=True loads it right away instead, which blocks,
+    so it's only meant for threads and scripts
+    """
+    model = str(model or "")
+    tokenizer = _tokenizers.get(model)
+    if tokenizer is not None:
+        return tokenizer
+
+    if wait:
+        return _get(model, _options())
+
+    warm_up(model)
+    return _estimate
+
+def _get(model: str, options: dict) -> Tokenizer:
+    tokenizer = _tokenizers.get(model)
+    if tokenizer is not None:
+        return tokenizer
+
+    with _lock:
+        tokenizer = _tokenizers.get(model)
+        if tokenizer is not None:
+            return tokenizer
+        loading = _loading.get(model)
+        if loading is None:
+            loading = _loading[model] = concurrent.futures.Future()
+            owner = True
+        else:
+            owner = False
+
+    if not owner:
+        # being loaded by warm_up() right now, just wait for it
+        return loading.result()
+
+    try:
+        tokenizer = _resolve(model, options)
+    except Exception as e:
+        core.log_error(f"error loading tokenizer for {model}", e)
+        tokenizer = EstimateTokenizer()
+
+    with _lock:
+        _tokenizers[model] = tokenizer
+        _loading.pop(model, None)
+    loading.set_result(tokenizer)
+
+    core.log("tokenizer", f"using {tokenizer.name} for {model or 'unknown model'}")
+    return tokenizer
+
+def warm_up(*models):
+    """loads the tokenizers of these models in a background thread, so the first token count doesn't have to wait"""
+    models = [str(model) for model in models if model and str(model) not in _tokenizers and str(model) not in _loading]
+    if not models:
+        return None
+
+    options = _options()
+    thread = threading.Thread(target=lambda: [_get(model, options) for model in models], name="tokenizer-warmup", daemon=True)
+    thread.start()
+    return thread
+
+def forget():
+    """drops all cached tokenizers, e.g. after new tokenizer files were added"""
+    with _lock:
+        _tokenizers.clear()
+
+def _resolve(model: str, options: dict) -> Tokenizer:
+    tokenizer_dir = options["dir"]
+
+    # explicitly configured in tokenizer.models: model name -> folder or tiktoken encoding name
+    override = options["overrides"].get(model)
+
+    tokenizer = _load_huggingface(tokenizer_dir, override or model, exact=bool(override))
+    if tokenizer:
+        return tokenizer
+
+    tokenizer = _load_tiktoken(tokenizer_dir, override or model)
+    if tokenizer:
+        return tokenizer
+
+    return EstimateTokenizer()
+
+def _load_huggingface(tokenizer_dir: str, model: str, exact: bool = False):
+    candidates = []
+    for name in os.listdir(tokenizer_dir):
+        path = os.path.join(tokenizer_dir, name, "tokenizer.json")
+        if not os.path.isfile(path):
+            continue
+        if name.lower() == model.lower() or (not exact and name.lower() in model.lower()):
+            candidates.append((len(name), name, path))
+
+    if not candidates:
+        return None
+
+    _, name, path = max(candidates)
+    try:
+        import tokenizers
+    except ImportError:
+        core.log("tokenizer", f"found {path}, but the tokenizers package isn't installed")
+        return None
+
+    return HuggingFaceTokenizer(tokenizers.Tokenizer.from_file(path), name)
+
+def _load_tiktoken(tokenizer_dir: str, model: str):
+    # the user's own tiktoken cache folder wins
+    cache_dir = os.environ.get("TIKTOKEN_CACHE_DIR") or tokenizer_dir
+
+    import tiktoken
+    import tiktoken.model
+
+    try:
+        encoding_name = tiktoken.model.encoding_name_for_model(model)
+    except KeyError:
+        # not an openai model. an encoding can still be named directly (in tokenizer.models),
+        # otherwise an openai encoding would be off by too much, and estimating is just as good
+        if model not in tiktoken.list_encoding_names():
+            return None
+        encoding_name = model
+
+    cache_path = os.path.join(cache_dir, hashlib.sha1(TIKTOKEN_URL.format(name=encoding_name).encode()).hexdigest())
+    plain_path = os.path.join(tokenizer_dir, f"{encoding_name}.tiktoken")
+    if not os.path.exists(cache_path) and os.path.exists(plain_path):
+        # put a plain .tiktoken file where tiktoken expects its cached download
+        shutil.copyfile(plain_path, cache_path)
+
+    if not os.path.exists(cache_path):
+        # tiktoken would try to download it
+        return None
+
+    # tiktoken reads its cache folder from the environment. only set it while loading,
+    # so it doesn't leak into the rest of the process and its subprocesses
+    with _env_lock:
+        previous = os.environ.get("TIKTOKEN_CACHE_DIR")
+        os.environ["TIKTOKEN_CACHE_DIR"] = cache_dir
+        try:
+            encoding = tiktoken.get_encoding(encoding_name)
+        finally:
+            if previous is None:
+                del os.environ["TIKTOKEN_CACHE_DIR"]
+            else:
+                os.environ["TIKTOKEN_CACHE_DIR"] = previous
+
+    return TiktokenTokenizer(encoding)
+
+def _calibration_data():
+    global _calibration
+    if _calibration is None:
+        _calibration = core.storage.StorageDict("token_calibration", "json")
+    return _calibration
+
+async def calibrate(model: str, estimated: int, actual: int) -> float:
+    """
+    compares a local token count with the prompt_tokens the API reported for the same request,
+    and updates the correction factor of that model. returns the new factor
+    """
+    model = str(model or "")
+    if not estimated or not actual or estimated <= 0 or actual <= 0:
+        return correction(model)
+
+    tokenizer = get(model)
+    ratio = min(CALIBRATION_LIMIT, max(1 / CALIBRATION_LIMIT, actual / estimated))
+
+    data = _calibration_data()
+    entry = data.get(model)
+    if not entry or entry.get("tokenizer") != tokenizer.name:
+        # first sample, or the tokenizer changed since, so the old factor means nothing
+        factor = ratio
+        samples = 1
+    else:
+        factor = entry["factor"] + (ratio - entry["factor"]) * CALIBRATION_WEIGHT
+        samples = entry.get("samples", 0) + 1
+
+    data[model] = {
+        "tokenizer": tokenizer.name,
+        "factor": round(factor, 4),
+        "samples": samples,
+        "estimated": int(estimated),
+        "actual": int(actual)
+    }
+    # called for every request, so the file is written in the storage thread pool (or with the next write-behind flush)
+    await data.asave()
+    return data[model]["factor"]
+
+def correction(model: str) -> float:
+    """factor to multiply local token counts of this model by. 1.0 until the API reported any usage"""
+    model = str(model or "")
+    entry = _calibration_data().get(model)
+    if not entry or entry.get("tokenizer") != get(model).name:
+        return 1.0
+    return entry.get("factor", 1.0)
@@ -1,21 +1,28 @@
 import core
 import json
+import time
 import json_repair
 
 class ToolcallManager:
-    def __init__(self, channel):
+    def __init__(self, channel, priority=core.backends.INTERACTIVE):
         self.channel = channel
+        # priority of the follow-up requests, see core.backends
+        self.priority = priority
 
-    async def process(self, tool_calls, initial_content=""):
+    async def process(self, tool_calls, initial_content="", handle=None):
         """
         Process tool calls from a streamed response.
 
         Args:
             tool_calls: The tool calls to process
             initial_content: Content that was streamed before tool calls
+            handle: RequestHandle of the request the tool calls came from. cancelling it stops the whole chain
 
         Yields response tokens after executing tools.
         """
+        if handle is None:
+            handle = core.api_client.RequestHandle()
+
         # Fix broken JSON and convert to dicts
         repaired_tool_calls = []
 
@@ -88,6 +95,7 @@ class ToolcallManager:
 
                 core.log("toolcall", announce_string)
 
+                start = time.perf_counter()
                 try:
                     func_response = await func_callable(**tool_args)
                     tool_response = {
@@ -103,6 +111,7 @@ class ToolcallManager:
                         "content": f"error: {str(e)}"
                     }
 
+                core.profiler.record_tool(module_instance_display_name, tool_name, tool_response["content"], time.perf_counter() - start, self.channel.manager.API._model)
                 await self.channel.context.chat.add(tool_response)
             else:
                 core.log(
@@ -110,7 +119,7 @@ class ToolcallManager:
                     f"tried to call tool {tool_name} but couldn't find it"
                 )
 
-        if self.channel.manager.API.cancel_request:
+        if handle.cancelled:
             await self.channel.announce("toolcalling chain cancelled", "info")
             return
 
@@ -125,6 +134,8 @@ class ToolcallManager:
                 )
             }
         ] + context
+        # counted now, a recursive tool call adds to the chat before the usage of this request comes in
+        basis = self.channel.context.chat.usage_basis(prompt)
 
         final_content = []
         final_reasoning = []
@@ -133,7 +144,9 @@ class ToolcallManager:
         try:
             async for token in self.channel.manager.API.send_stream(
                 prompt,
-                tools=self.channel.manager.tools
+                tools=self.channel.manager.tools,
+                priority=self.priority,
+                handle=handle
             ):
                 token_type = token.get("type")
                 if token_type in ("content", "reasoning"):
@@ -148,11 +161,12 @@ class ToolcallManager:
                     # Pass accumulated content to recursive call
                     async for sub_token in self.process(
                         token.get("content"),
-                        initial_content="".join(final_content)
+                        initial_content="".join(final_content),
+                        handle=handle
                     ):
                         yield sub_token
-                elif token_type == "usage":
-                    pass
+                elif token_type == "token_usage":
+                    await self.channel.context.chat.record_usage(basis, token.get("content"))
 
             if not final_content:
                 final_content = final_reasoning
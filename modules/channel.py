@@ -1,6 +1,12 @@
 import core
 
 class Channel(core.module.Module):
+    prompt_volatility = "stable"
+    prompt_cache = {
+        "on_system_prompt": {"events": ("channel",)},
+        "on_end_prompt": {"events": ("channel",)}
+    }
+
     async def on_system_prompt(self):
         if not self.channel:
             return None
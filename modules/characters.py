@@ -3,10 +3,15 @@ import core
 class Characters(core.module.Module):
     """lets your AI embody different characters! inspired by characterAI, janitorAI, sillytavern, etc."""
 
+    prompt_volatility = "stable"
+    prompt_cache = {"on_system_prompt": {"events": ("storage", "config"), "ttl": 60}}
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.characters = core.storage.StorageDict("characters", type="json")
-        self.active_character = core.storage.StorageText("character_current")
+        self.characters = core.storage.StorageCollection("characters")
+        self.characters.migrate("characters", types=("json",))
+        # written immediately, since the identity module reads this file too
+        self.active_character = core.storage.StorageText("character_current", write_behind=False)
         self.user_profile = core.storage.StorageDict("character_user", "json")
         self._header = "Profiles"
 
@@ -15,11 +20,11 @@ class Characters(core.module.Module):
         """list all your characters"""
 
         # collect categories
-        if not self.characters:
+        if not await self.characters.alen():
             return "You have no characters yet"
 
         sorted_by_cat = {}
-        for character_name, character in self.characters.items():
+        for character_name, character in await self.characters.aitems():
             category = character.get("category", None)
 
             if category:
@@ -37,8 +42,7 @@ class Characters(core.module.Module):
         for category_name, category in sorted_by_cat.items():
             if not category:
                 # autoremove empty categories
-                if category_name in self.characters.keys():
-                    del(self.characters[category_name])
+                await self.characters.adelete(category_name)
 
             characters = ", ".join(category)
             char_list.append(f"{category_name}: {characters}")
@@ -60,17 +64,17 @@ class Characters(core.module.Module):
             else:
                 return "please provide a character name."
         elif name in("reset", "default"):
-                self.active_character.set("")
+                await self.active_character.aset("")
                 return "character has been reset to default"
 
-        character = self._find_character(name)
+        character = await self._find_character(name)
         if not character:
             return f"character {name} does not exist!"
         response = await self.switch(character)
         return f"character switched to {character}"
 
     async def on_system_prompt(self):
-        curr_char = self.characters.get(self.active_character.get())
+        curr_char = await self.characters.aget(self.active_character.get())
 
         tool_text = ""
         if core.config.get("model").get("use_tools", False):
@@ -82,7 +86,7 @@ class Characters(core.module.Module):
 
         character_text = ""
         character_name = self.active_character.get()
-        character_profile = self.characters.get(character_name, "").get("identity", "")
+        character_profile = curr_char.get("identity", "")
         character_text = f"Name: {character_name}\nProfile: {character_profile}\n\n"
 
         user_name = self.user_profile.get("name", "User")
@@ -97,16 +101,16 @@ class Characters(core.module.Module):
 
     async def switch(self, name: str):
         """Switches you to a different character. This will change your personality! Use this if user requests it."""
-        name = self._find_character(name)
+        name = await self._find_character(name)
         if not name:
             return self.result("character not found", False)
-        character = self.characters.get(name)
-        self.active_character.set(name)
+        character = await self.characters.aget(name)
+        await self.active_character.aset(name)
         return self.result(str({"instructions": f"Write your next reply as the character {name}.", "character": self._rewrite_character(name, character.get("identity"))}))
     
     async def switch_to_default(self):
         """Switches you back to your default identity."""
-        self.active_character.set("")
+        await self.active_character.aset("")
         return "success"
 
     def _case_insensitive_replace(self, text, old, new):
@@ -144,10 +148,10 @@ class Characters(core.module.Module):
 
         return "".join(result_parts)
 
-    def _find_character(self, name: str):
+    async def _find_character(self, name: str):
         """searches for a character, case insensitive"""
 
-        for character_name in self.characters.keys():
+        for character_name in await self.characters.akeys():
             if character_name.lower().strip() == name.lower().strip():
                 return character_name
         return None
@@ -189,18 +193,17 @@ class Characters(core.module.Module):
         if not name.strip():
             return self.result("character name cannot be empty", False)
 
-        exists = self._find_character(name)
+        exists = await self._find_character(name)
         if exists:
             return self.result("character already exists", False)
 
         if not character:
             return self.result("character must not be blank.")
 
-        self.characters[name] = {
+        await self.characters.aput(name, {
             "identity": character,
             "category": category.lower()
-        }
-        self.characters.save()
+        })
         return self.result("character added")
 
     async def edit(self, name: str, category: str = None, character: str = None):
@@ -208,16 +211,17 @@ class Characters(core.module.Module):
         Edits an existing character.
         Use ONLY if user explicitely requests it.
         """
-        name = self._find_character(name)
+        name = await self._find_character(name)
         if not name:
             return self.result("character doesn't exist!", False)
 
-        if not None and len(character) > 0:
-            self.characters[name]["identity"] = character
+        changes = {}
+        if character:
+            changes["identity"] = character
         if category:
-            self.characters[name]["category"] = category.lower()
+            changes["category"] = category.lower()
 
-        self.characters.save()
+        await self.characters.apatch(name, **changes)
         return self.result("character edited.")
 
     async def delete(self, name: str):
@@ -225,10 +229,8 @@ class Characters(core.module.Module):
         Deletes an character.
         Use ONLY if user explicitely requests it.
         """
-        name = self._find_character(name)
-        if name in self.characters.keys():
-            self.characters.pop(name, None)
-            self.characters.save()
+        name = await self._find_character(name)
+        if name and await self.characters.adelete(name):
             return self.result(f"character {name} deleted")
         return self.result("character doesn't exist!", False)
 
@@ -236,13 +238,13 @@ class Characters(core.module.Module):
         """sets the name and profile of the user"""
         self.user_profile["name"] = name
         self.user_profile["profile"] = profile
-        self.user_profile.save()
+        await self.user_profile.asave()
         return self.result("profile set")
     async def clear_user_profile(self):
         """clears the profile of the user. ONLY use if user explicitely asks for it!"""
         del(self.user_profile["name"])
         del(self.user_profile["profile"])
-        self.user_profile.save()
+        await self.user_profile.asave()
         return self.result("profile cleared")
 
     async def set_preferences(self, preferences: str):
@@ -251,7 +253,7 @@ class Characters(core.module.Module):
         e.g. "Write your replies in a short, easy to understand style, in at most 2 paragraphs."
         """
         self.user_profile["preferences"] = preferences
-        self.user_profile.save()
+        await self.user_profile.asave()
         return self.result("preferences set")
 
     # command version
@@ -263,7 +265,7 @@ class Characters(core.module.Module):
 
         pref = " ".join(args)
         self.user_profile["preferences"] = pref
-        self.user_profile.save()
+        await self.user_profile.asave()
         return "preferences set!"
 
     # async def list(self):
@@ -76,10 +76,12 @@ class Chats(core.module.Module):
         if not chats:
             return False
 
+        current_id = await self.channel.context.chat.get_id()
+
         found_chats = []
-        for index, chat in enumerate(chats):
+        for chat in chats:
             # do not search within current chat
-            if index == 0 or index == len(chats)-1:
+            if chat.get("id") == current_id:
                 continue
 
             # create a new chat dict so that we can include only the messages that contain the query
@@ -91,8 +93,8 @@ class Chats(core.module.Module):
                 found = True
 
             # search within content
-            for message in chat.get("messages", []):
-                if message.get("content", "").find(query) != -1:
+            for message in await self.channel.context.chat.get_messages(chat.get("id")) or []:
+                if str(message.get("content") or "").find(query) != -1:
                     filtered_chat["messages"].append({"role": message.get("role"), "content": message.get("content")})
                     found = True
 
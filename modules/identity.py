@@ -3,16 +3,23 @@ import core
 class Identity(core.module.Module):
     """manage your AI's personality"""
 
+    prompt_volatility = "stable"
+    # the characters module writes character_current, which counts as a storage change here too.
+    # the ttl picks up identity files edited by hand
+    prompt_cache = {"on_system_prompt": {"events": ("storage", "config"), "ttl": 60}}
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.identity = core.storage.StorageList("identity", type="text")
+        # write through like the characters module does, so a deferred write from this handle can't undo a character switch
+        self.active_character = core.storage.StorageText("character_current", write_behind=False)
 
     async def on_system_prompt(self):
         # dont use identity if the characters module is enabled and a character is currently active
         if "characters" in core.config.get("modules").get("enabled"):
-            active_character = core.storage.StorageText("character_current")
-            if active_character.get():
-                print(repr(active_character.get()))
+            # the characters module writes this file, so re-read it without blocking the event loop
+            await self.active_character.aload()
+            if self.active_character.get():
                 return None
 
         identity = self.identity[0] if len(self.identity) > 0 else None
@@ -34,7 +41,7 @@ class Identity(core.module.Module):
         """
         self.identity.clear()
         self.identity.append(content)
-        self.identity.save()
+        await self.identity.asave()
         return self.result(True)
 
     # command version
@@ -61,5 +68,5 @@ class Identity(core.module.Module):
         """Wipes your identity as an AI so you may start from scratch. USE WITH CAUTION!"""
         self.identity.clear()
         self.identity.append("")
-        self.identity.save()
+        await self.identity.asave()
         return self.result(True)
@@ -8,24 +8,23 @@ import ulid
 cached_mem = None
 
 class Memory(core.module.Module):
+    prompt_volatility = "stable"
+    prompt_cache = {"on_system_prompt": {"events": ("storage",)}}
+
     def __init__(self, *args, **kwargs):
         super().__init__( *args, **kwargs)
-        self._mem = core.storage.StorageList("memory", type="msgpack")
-        self._mem_deleted = core.storage.StorageList("deleted_memories", type="json")
+        # one row per memory, so changing a memory doesn't rewrite all the others
+        self._mem = core.storage.StorageCollection("memories")
+        self._mem.migrate("memory", types=("journal", "msgpack"))
+        # journal only appends what changed instead of rewriting all deleted memories on every save
+        self._mem_deleted = core.storage.StorageList("deleted_memories", type="journal")
         self.max_pinned = 10
 
-    def _get_index(self, ulid: str) -> int:
-        """checks if a memory with ID exists in memories"""
-        for index, mem in enumerate(self._mem):
-            if ulid.strip() == mem.get("id").strip():
-                return index
-        return -1
-
     async def on_system_prompt(self):
         # automatically put pinned memories in the prompt
         # TODO: limit to a max amount of pinned memories (configurable) and refuse pinning memories beyond that if it hits the max allowed, tell ai to unpin one so another can be pinned instead
         pinned_memories = []
-        for index, mem in enumerate(self._mem):
+        for mem in await self._mem.avalues():
             if mem.get("pinned"):
                 mem_filtered = {
                     mem.get("id"),
@@ -59,8 +58,7 @@ class Memory(core.module.Module):
             "pinned": pinned,
             "date_created": datetime.datetime.now().isoformat()
         }
-        self._mem.append(mem)
-        self._mem.save()
+        await self._mem.aput(mem["id"], mem)
         return self.result(True)
 
     async def edit(self, id: str, content: str = None, tags: list = None):
@@ -80,16 +78,18 @@ class Memory(core.module.Module):
             content: the contents of the memory
             tags: optional - leave blank to leave it as-is. a list of tags to associate with the memory for later lookup
         """
-        index = self._get_index(id)
-        if index == -1:
+        id = id.strip()
+        if not await self._mem.acontains(id):
             return self.result("memory with that ID not found!")
 
+        changes = {}
         if content:
-            self._mem[index]["content"] = content
+            changes["content"] = content
         if tags:
-            self._mem[index]["tags"] = tags
+            changes["tags"] = tags
 
-        return self.result(self._mem.save())
+        await self._mem.apatch(id, **changes)
+        return self.result(True)
 
     async def delete(self, id: str):
         """
@@ -101,35 +101,30 @@ class Memory(core.module.Module):
             - You've verified the ID
             - The user explicitely requested the deletion of the memory
         """
-        index = self._get_index(id)
-        if index == -1:
+        id = id.strip()
+        if not await self._mem.acontains(id):
             return self.result("memory with that ID not found!")
 
         # behind the scenes, this actually preserves the memory in a file the ai can't access
         # backups are useful!
-        self._mem_deleted.append(self._mem[index])
-        self._mem_deleted.save()
+        self._mem_deleted.append(await self._mem.apop(id))
+        await self._mem_deleted.asave()
 
-        self._mem.pop(index)
-        return self.result(self._mem.save())
+        return self.result(True)
 
     async def pin(self, id: str):
         """Pins a memory to the top of your context window. Makes it persistent across conversations."""
-        index = self._get_index(id)
-        if index == -1:
+        if not await self._mem.apatch(id.strip(), pinned=True):
             return self.result("memory with that ID not found!")
 
-        self._mem[index]["pinned"] = True
-        return self.result(self._mem.save())
+        return self.result(True)
 
     async def unpin(self, id: str):
         """Unpins a memory from the top of your context window. An unpinned memory can only be reached by manually searching for it."""
-        index = self._get_index(id)
-        if index == -1:
+        if not await self._mem.apatch(id.strip(), pinned=False):
             return self.result("memory with that ID not found!")
 
-        self._mem[index]["pinned"] = False
-        return self.result(self._mem.save())
+        return self.result(True)
 
     async def search(self, query: str, search_in_content: bool = False):
         """
@@ -139,7 +134,7 @@ class Memory(core.module.Module):
         results = []
         query_lower = query.lower()
 
-        for index, mem in enumerate(self._mem):
+        for mem in await self._mem.avalues():
             # Check tags: split tags into words and check if any word is in the query
             match_found = False
             tags = mem.get("tags", [])
@@ -3,6 +3,10 @@ import core
 class Models(core.module.Module):
     """switch between AI models"""
 
+    prompt_volatility = "stable"
+    # the model list is fetched once it's connected, so retry now and then until then
+    prompt_cache = {"on_system_prompt": {"events": ("config",), "ttl": 60}}
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.models = None
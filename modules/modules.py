@@ -1,6 +1,9 @@
 import core
 
 class Modules(core.module.Module):
+    prompt_volatility = "stable"
+    prompt_cache = {"on_system_prompt": {"events": ("config",)}}
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._header = "modules"
@@ -4,15 +4,38 @@ import core
 import ulid
 
 class Scheduler(core.module.Module):
+    # the prompt has countdowns to every job, so it changes every turn
+    prompt_volatility = "volatile"
+
+    # the loop sleeps until the next job is due, but wakes up at least this often, in case the clock changes
+    MAX_SLEEP_SECONDS = 60
+
     async def on_ready(self):
-        self.schedule = core.storage.StorageList("schedule", type="json")
-        self.tc_manager = core.toolcalls.ToolcallManager(self.channel)
+        self.schedule = core.storage.StorageCollection("schedule")
+        self.schedule.migrate("schedule", types=("json",))
+        self.tc_manager = core.toolcalls.ToolcallManager(self.channel, priority=core.backends.SCHEDULED)
+
+        # jobs are kept in memory, so the loop and the system prompt don't have to query the database.
+        # every change goes through _put_job() and _delete_job(), which keep both up to date
+        self._jobs = {job.get("id"): job for job in await self.schedule.avalues()}
+        self._jobs_changed = asyncio.Event()
+
+    async def _put_job(self, job: dict):
+        await self.schedule.aput(job["id"], job)
+        self._jobs[job["id"]] = job
+        self._jobs_changed.set()
+
+    async def _delete_job(self, id: str) -> bool:
+        deleted = await self.schedule.adelete(id)
+        self._jobs.pop(id, None)
+        self._jobs_changed.set()
+        return deleted
 
     async def on_background(self):
         """main loop"""
         core.log("init", "scheduler started")
         while True:
-            for job in list(self.schedule):
+            for job in list(self._jobs.values()):
                 trigger_time = datetime.datetime.fromisoformat(job.get("trigger_time"))
 
                 if datetime.datetime.now() >= trigger_time:
@@ -37,7 +60,8 @@ class Scheduler(core.module.Module):
                             response = await self.manager.API.send(
                                 [event_message],
                                 use_tools=True,
-                                tools=tools
+                                tools=tools,
+                                priority=core.backends.SCHEDULED
                             )
 
                             final_content = ""
@@ -63,8 +87,7 @@ class Scheduler(core.module.Module):
                                 if final_content:
                                     await self.channel.announce(final_content, "schedule")
 
-                            self.schedule.pop(self._get_index(job.get("id")))
-                            self.schedule.save()
+                            await self._delete_job(job.get("id"))
 
                             if job.get("recurring"):
                                 await self._reschedule_job(job)
@@ -72,7 +95,17 @@ class Scheduler(core.module.Module):
                     except Exception as e:
                         core.log("scheduler", f"error: {e}")
 
-            await asyncio.sleep(0.10)
+            # sleep until the next job is due, or until a job gets added, edited or removed
+            self._jobs_changed.clear()
+            timeout = self.MAX_SLEEP_SECONDS
+            if self._jobs:
+                next_time = min(datetime.datetime.fromisoformat(job.get("trigger_time")) for job in self._jobs.values())
+                # jobs that failed are retried, but not in a tight loop
+                timeout = min(timeout, max(0.1, (next_time - datetime.datetime.now()).total_seconds()))
+            try:
+                await asyncio.wait_for(self._jobs_changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
 
     async def _reschedule_job(self, job: dict):
         """Reschedules a recurring job based on its recurrence pattern."""
@@ -142,13 +175,6 @@ class Scheduler(core.module.Module):
             candidate += datetime.timedelta(days=1)
         return candidate
 
-    def _get_index(self, ulid: str):
-        """checks if an ID is stored in the job list"""
-        for index, job in enumerate(self.schedule):
-            if ulid == str(job.get("id")):
-                return index
-        return -1
-
     def _weekday_name(self, weekday: int) -> str:
         """Convert weekday number to name (0=Monday, 6=Sunday)"""
         days = [
@@ -159,8 +185,11 @@ class Scheduler(core.module.Module):
 
     def __str__(self):
         """displays schedule as a human-readable list"""
+        return self._describe(list(self._jobs.values()))
+
+    def _describe(self, jobs: list):
         result = []
-        for job in self.schedule:
+        for job in jobs:
             id = job.get("id")
 
             if job.get("recurring"):
@@ -215,8 +244,9 @@ class Scheduler(core.module.Module):
         return "\n".join(result)
 
     async def on_system_prompt(self):
-        if self.schedule:
-            return f"Your scheduler system will trigger these events at the specified times:\n{self}"
+        jobs = list(self._jobs.values())
+        if jobs:
+            return f"Your scheduler system will trigger these events at the specified times:\n{self._describe(jobs)}"
 
     async def add_job(
         self,
@@ -287,8 +317,7 @@ class Scheduler(core.module.Module):
                 "recurs_in": recur if recurring else None
             }
 
-            self.schedule.append(sched)
-            self.schedule.save()
+            await self._put_job(sched)
         except Exception as e:
             return self.result(f"error: {e}", False)
 
@@ -317,8 +346,7 @@ class Scheduler(core.module.Module):
             - You've verified the ID
             - User explicitly requested editing of the job
         """
-        index = self._get_index(id)
-        if index == -1:
+        if id not in self._jobs:
             return self.result("id does not exist", False)
 
         try:
@@ -340,16 +368,16 @@ class Scheduler(core.module.Module):
             if trigger_time is None:
                 return self.result("error: invalid schedule parameters (zero interval)", False)
 
+            # same id, so the job is replaced in one write and never missing in between
             sched = {
-                "id": str(ulid.ULID()),
+                "id": id,
                 "action": action,
                 "trigger_time": trigger_time.isoformat(),
                 "recurring": recurring,
                 "recurs_in": recur if recurring else None
             }
 
-            self.schedule[index] = sched
-            self.schedule.save()
+            await self._put_job(sched)
         except Exception as e:
             return self.result(f"error: {e}", False)
 
@@ -364,10 +392,7 @@ class Scheduler(core.module.Module):
             - User explicitly requested deletion of the job
         """
 
-        index = self._get_index(id)
-        if index == -1:
+        if not await self._delete_job(id):
             return self.result("id does not exist", False)
 
-        self.schedule.pop(index)
-        self.schedule.save()
         return self.result("job deleted")
@@ -5,6 +5,10 @@ import platform
 import datetime
 
 class System(core.module.Module):
+    # host details don't change while running
+    prompt_volatility = "static"
+    prompt_cache = {"on_system_prompt": {"static": True}}
+
     async def on_system_prompt(self):
         details = {
             "OS": sys.platform,